@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Throughput and latency of the fd broker.
+
+- `open, one per round trip`: `BrokerClient.open`, one file descriptor per request
+- `open, batched`: `request_many` with `--batch` requests per round trip
+- `listen (cached)`: `BrokerClient.listen` on the same port, served from the listener cache
+- `listen (reuseport)`: a new channel and its own `SO_REUSEPORT` socket per simulated worker
+  (on `--port` + 1)
+
+Must be run as root (or with the needed capabilities)::
+
+    python benchmarks/bench_broker.py -n 20000 --batch 64 --port 80
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from deescalate.broker import BrokerPolicy, start_broker
+
+
+def report(name, n, elapsed, stats=None):
+    line = "%-28s %10.0f fds/s" % (name, n / elapsed)
+    if stats is not None:
+        line += "   round trip mean %6.1f us  p50 %6.1f us  p99 %6.1f us" % (
+            stats.mean * 1e6, stats.p50 * 1e6, stats.p99 * 1e6
+        )
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fd broker throughput")
+    parser.add_argument('-n', '--iterations', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--workers', type=int, default=64, help="channels of the reuseport test")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='deescalate-bench-')
+    path = os.path.join(directory, 'resource')
+    with open(path, 'w') as f:
+        f.write('x')
+    policy = BrokerPolicy().allow_open(os.path.join(directory, '*')).allow_listen((args.port, args.port + 1), host='127.0.0.1')
+    broker = start_broker(policy)
+    try:
+        channel = broker.new_channel()
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            channel.open(path).close()
+        report('open, one per round trip', args.iterations, time.perf_counter() - start, channel.stats())
+        channel.close()
+
+        channel = broker.new_channel()
+        request = {'op': 'open', 'path': path}
+        start = time.perf_counter()
+        for _ in range(args.iterations // args.batch):
+            for fd in channel.request_many([request] * args.batch):
+                os.close(fd)
+        report('open, batched x%d' % args.batch, args.iterations // args.batch * args.batch,
+               time.perf_counter() - start, channel.stats())
+        channel.close()
+
+        channel = broker.new_channel()
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            channel.listen(args.port, host='127.0.0.1').close()
+        report('listen (cached)', args.iterations, time.perf_counter() - start, channel.stats())
+        channel.close()
+
+        start = time.perf_counter()
+        workers = []
+        for _ in range(args.workers):
+            worker = broker.new_channel()
+            worker.listen(args.port + 1, host='127.0.0.1', reuseport=True).close()
+            workers.append(worker)
+        report('listen (reuseport)', args.workers, time.perf_counter() - start)
+        for worker in workers:
+            worker.close()
+        print("broker: %s" % broker.server_stats())
+    finally:
+        broker.close()
+        broker.process.terminate()
+        broker.process.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
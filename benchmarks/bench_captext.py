@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of the libcap text format: `compile_text` and `to_text` against `cap_from_text` and `cap_to_text`.
+
+The texts are random combinations of clauses such as `cap_net_raw,cap_net_admin=eip cap_sys_chroot+p`. libcap is
+called through ctypes (each result is released with `cap_free`). `compile_text` is measured without its cache
+(every text compiled again) and with a warm cache, as a server parsing the same few policies again and again would
+see it. No privilege is needed.
+
+Run it with::
+
+    python benchmarks/bench_captext.py --texts 200 --rounds 20
+"""
+
+import time
+import random
+import ctypes
+import ctypes.util
+import argparse
+
+from deescalate import C, compile_text
+from deescalate import captext
+
+
+def random_texts(count, seed):
+    rng = random.Random(seed)
+    names = ['cap_' + name.decode('ascii') for name in C.INVERSE_SUPPORTED_CAPS.values()]
+    texts = []
+    for _ in range(count):
+        clauses = []
+        for index in range(rng.randint(1, 4)):
+            caps = ','.join(rng.sample(names, rng.randint(1, 5)))
+            op = '=' if index == 0 else rng.choice('+-')
+            clauses.append(caps + op + ''.join(rng.sample('eip', rng.randint(1, 3))))
+        texts.append(' '.join(clauses))
+    return texts
+
+
+def load_libcap():
+    path = ctypes.util.find_library('cap')
+    if path is None:
+        return None
+    lib = ctypes.CDLL(path)
+    lib.cap_from_text.restype = ctypes.c_void_p
+    lib.cap_from_text.argtypes = (ctypes.c_char_p,)
+    lib.cap_to_text.restype = ctypes.c_void_p
+    lib.cap_to_text.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
+    lib.cap_free.argtypes = (ctypes.c_void_p,)
+    return lib
+
+
+def measure(body, items, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            body(item)
+    return rounds * len(items) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compile_text and to_text against cap_from_text and cap_to_text")
+    parser.add_argument('--texts', type=int, default=200, help="number of distinct texts")
+    parser.add_argument('--rounds', type=int, default=20, help="passes over the texts")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    texts = random_texts(args.texts, args.seed)
+    compiled = [compile_text(text) for text in texts]
+    results = []
+    lib = load_libcap()
+    if lib is not None:
+        def from_text(text):
+            lib.cap_free(lib.cap_from_text(text))
+
+        def to_text(caps):
+            lib.cap_free(lib.cap_to_text(caps, None))
+
+        encoded = [text.encode('ascii') for text in texts]
+        results.append(('cap_from_text (libcap)', measure(from_text, encoded, args.rounds)))
+        handles = [lib.cap_from_text(text) for text in encoded]
+        results.append(('cap_to_text (libcap)', measure(to_text, handles, args.rounds)))
+        for handle in handles:
+            lib.cap_free(handle)
+    else:
+        print("libcap not found: only deescalate is measured")
+
+    results.append(('compile_text, uncached', measure(captext._compile, texts, args.rounds)))
+    captext.clear_cache()
+    results.append(('compile_text, cached', measure(compile_text, texts, args.rounds)))
+    results.append(('CapText.to_text', measure(lambda caps: caps.to_text(), compiled, args.rounds)))
+
+    print("%d texts, %d rounds, cache %s" % (args.texts, args.rounds, captext.cache_info()))
+    for name, rate in results:
+        print("%-26s %12.0f ops/s %10.2f us/op" % (name, rate, 1e6 / rate))
+
+
+if __name__ == '__main__':
+    main()
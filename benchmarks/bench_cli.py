@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cold start of the `deescalate` command, and throughput of the manifest mode.
+
+- cold start: median time of `deescalate <options> /bin/true`, minus the median time of a bare interpreter. The
+  benchmark exits with status 1 when it is above the budget (`--budget`, in milliseconds).
+
+- manifest: time to run `-n` locked down `/bin/true` children, one at a time (`-j 1`) and with `--jobs` children
+  at once.
+
+Must be run as root (or with the needed capabilities)::
+
+    python benchmarks/bench_cli.py -n 50 --budget 50 --jobs 8
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+def median_time(command, n, env):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.check_call(command, env=env)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="deescalate command line cold start and manifest throughput")
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('-c', '--capabilities', default='net_bind_service')
+    parser.add_argument('-u', '--user', default='nobody')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--budget', type=float, default=50.0, help="cold start budget, in milliseconds")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    cli = [sys.executable, '-m', 'deescalate.script']
+
+    baseline = median_time([sys.executable, '-c', 'pass'], args.iterations, env)
+    cold_start = median_time(cli + ['-u', args.user, '-c', args.capabilities, '/bin/true'], args.iterations, env)
+    cold_start -= baseline
+    print("%-24s %8.2f ms (budget %.2f ms)" % ('cold start', cold_start * 1e3, args.budget))
+
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as manifest:
+        for _ in range(args.iterations):
+            manifest.write('{"command": "/bin/true"}\n')
+    try:
+        for jobs in (1, args.jobs):
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(
+                    cli + ['-u', args.user, '-c', args.capabilities, '-m', manifest.name, '-j', str(jobs)],
+                    env=env, stdout=devnull
+                )
+            elapsed = time.perf_counter() - start
+            print("%-24s %8.2f ms for %d commands (%.0f launches/s)" % (
+                'manifest -j %d' % jobs, elapsed * 1e3, args.iterations, args.iterations / elapsed
+            ))
+    finally:
+        os.unlink(manifest.name)
+
+    if cold_start * 1e3 > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
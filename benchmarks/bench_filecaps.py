@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Walk and bulk set times of `deescalate.filecaps` on a generated tree.
+
+The fixture has `--files` empty files, `--per-directory` per directory in a two levels tree, and every `--every`th
+file gets a file capability (CAP_SETFCAP is needed, and a filesystem with extended attributes).
+
+- `getcap -r`: the libcap tool, when it is installed
+- `naive`: `os.walk` and one `os.getxattr` per file, in the calling thread
+- `walk(workers=N)`: `filecaps.walk`
+- `setcap`: one `setcap` process per file, on the first `--setcap` files only
+- `apply_manifest(workers=N)`: `filecaps.apply_manifest`, setting the capabilities of every `--every`th file
+
+Run it on a tmpfs::
+
+    python benchmarks/bench_filecaps.py --files 1000000 --dir /dev/shm
+"""
+
+import os
+import time
+import errno
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from deescalate.filecaps import FileCaps, XATTR_NAME, walk, apply_manifest, set_file_caps
+
+CAPS = [FileCaps.from_text(text) for text in ('cap_net_bind_service=ep', 'cap_net_raw,cap_net_admin=ep',
+                                              'cap_dac_read_search=p', 'cap_sys_ptrace=ei')]
+
+
+def make_fixture(directory, files, per_directory, every):
+    paths = []
+    for index in range(files):
+        parent = os.path.join(directory, '%03d' % (index // (per_directory * per_directory)),
+                              '%03d' % (index // per_directory % per_directory))
+        if index % per_directory == 0:
+            os.makedirs(parent, exist_ok=True)
+        path = os.path.join(parent, 'f%d' % index)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o755))
+        if index % every == 0:
+            paths.append(path)
+            set_file_caps(path, CAPS[index // every % len(CAPS)])
+    return paths
+
+
+def naive(root):
+    found = []
+    for parent, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(parent, name)
+            try:
+                found.append((path, FileCaps.from_bytes(os.getxattr(path, XATTR_NAME, follow_symlinks=False))))
+            except OSError as ex:
+                if ex.errno != errno.ENODATA:
+                    raise
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="file capabilities walk and bulk set")
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--per-directory', type=int, default=100)
+    parser.add_argument('--every', type=int, default=1000, help="one file in EVERY has capabilities")
+    parser.add_argument('--dir', default=None, help="where to build the fixture (a tmpfs is best)")
+    parser.add_argument('--workers', default='1,4,8,16', help="comma-separated pool sizes to compare")
+    parser.add_argument('--setcap', type=int, default=200, help="files set with one setcap process each")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='deescalate-filecaps-', dir=args.dir)
+    try:
+        start = time.perf_counter()
+        paths = make_fixture(directory, args.files, args.per_directory, args.every)
+        print("fixture: %d files, %d with capabilities, built in %.1f s" % (
+            args.files, len(paths), time.perf_counter() - start
+        ))
+
+        def run(name, function, count=args.files, unit='files'):
+            start = time.perf_counter()
+            found = function()
+            elapsed = time.perf_counter() - start
+            print("%-32s %8.3f s %10.0f %s/s  (%d found)" % (name, elapsed, count / elapsed, unit, found))
+
+        getcap = shutil.which('getcap') or shutil.which('getcap', path='/usr/sbin:/sbin')
+        if getcap is not None:
+            run('getcap -r', lambda: len(subprocess.check_output([getcap, '-r', directory]).splitlines()))
+        run('naive', lambda: len(naive(directory)))
+        workers_list = [int(value) for value in args.workers.split(',')]
+        for workers in workers_list:
+            run('walk(workers=%d)' % workers, lambda: sum(1 for _ in walk(directory, workers=workers)))
+
+        setcap = shutil.which('setcap') or shutil.which('setcap', path='/usr/sbin:/sbin')
+        if setcap is not None:
+            subset = paths[:args.setcap]
+            run('setcap', lambda: sum(
+                subprocess.call([setcap, 'cap_kill=ep', path]) == 0 for path in subset
+            ), len(subset), 'sets')
+        manifest = [{'path': path, 'caps': 'cap_kill=ep'} for path in paths]
+        for workers in workers_list:
+            run('apply_manifest(workers=%d)' % workers, lambda: sum(
+                'error' not in result for result in apply_manifest(manifest, workers=workers)
+            ), len(manifest), 'sets')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
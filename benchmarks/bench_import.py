@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cost of importing deescalate in a short-lived process.
+
+Each sample is a fresh interpreter. The baseline (`python -c pass`) is subtracted from the other measures:
+
+- `import`: `import deescalate`, the capability table is not computed
+- `import + table`: `import deescalate` and a first use of the capability table (probed from the kernel)
+- `import + table (disk cache)`: same, with the table read from a disk cache (`DEESCALATE_CACHE_DIR`)
+
+The in-process cost of computing the table is also measured, with and without the disk cache::
+
+    python benchmarks/bench_import.py -n 200
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+CASES = (
+    ('import', 'import deescalate', False),
+    ('import + table', 'import deescalate; deescalate.C.SUPPORTED_CAPS', False),
+    ('import + table (disk cache)', 'import deescalate; deescalate.C.SUPPORTED_CAPS', True),
+)
+
+
+def spawn_time(code, n, env):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-S', '-c', code], env=env)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="deescalate import time")
+    parser.add_argument('-n', '--iterations', type=int, default=100)
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='deescalate-bench-')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    env.pop('DEESCALATE_CACHE_DIR', None)
+    cached_env = dict(env, DEESCALATE_CACHE_DIR=cache_dir)
+
+    baseline = spawn_time('pass', args.iterations, env)
+    print("%-30s %8.2f ms (median)" % ('interpreter', baseline * 1e3))
+    for name, code, cached in CASES:
+        elapsed = spawn_time(code, args.iterations, cached_env if cached else env)
+        print("%-30s %8.2f ms (median, interpreter excluded)" % (name, (elapsed - baseline) * 1e3))
+
+    from deescalate.constants import load_table
+    for name, directory in (('table (probe)', None), ('table (disk cache)', cache_dir)):
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            load_table(directory, force=True)
+        elapsed = time.perf_counter() - start
+        print("%-30s %8.2f us" % (name, elapsed * 1e6 / args.iterations))
+
+
+if __name__ == '__main__':
+    main()
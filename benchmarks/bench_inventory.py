@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Scan time of `deescalate.inventory` on a synthetic `/proc`-style tree.
+
+The fixture has `--processes` processes of `--threads` threads each (`PID/status` and `PID/task/TID/status`),
+with status files copied from the running kernel and a few distinct capability sets and users.
+
+- `naive`: a plain Python walk (`os.listdir`, text reads, line by line parsing, one `int(mask, 16)` and one name
+  lookup per mask)
+- `scan(workers=N)`: `inventory.scan`, with and without the NumPy decoder when NumPy is installed
+
+Run it on a tmpfs::
+
+    python benchmarks/bench_inventory.py --processes 5000 --threads 10 --dir /dev/shm
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from deescalate.constants import C
+from deescalate.inventory import scan, numpy
+
+MASKS = [0, 1 << 10, (1 << 10) | (1 << 13), (1 << 41) - 1, ((1 << 41) - 1) & ~(1 << 24)]
+
+
+def make_fixture(directory, processes, threads):
+    with open('/proc/self/status', 'rb') as f:
+        template = f.read().decode('ascii', 'replace').split('\n')
+    for pid in range(1, processes + 1):
+        uid = (0, 33, 65534, 1000 + pid % 50)[pid % 4]
+        mask = MASKS[pid % len(MASKS)] if uid else MASKS[-2]
+        values = {
+            'Pid': str(pid), 'Tgid': str(pid), 'Uid': '\t'.join([str(uid)] * 4), 'Gid': '\t'.join([str(uid)] * 4),
+            'CapInh': '%016x' % 0, 'CapPrm': '%016x' % mask, 'CapEff': '%016x' % mask,
+            'CapBnd': '%016x' % MASKS[-2], 'CapAmb': '%016x' % 0, 'Name': 'worker-%d' % (pid % 7),
+        }
+        lines = []
+        for line in template:
+            key = line.partition(':')[0]
+            lines.append('%s:\t%s' % (key, values[key]) if key in values else line)
+        content = '\n'.join(lines).encode('ascii')
+        base = os.path.join(directory, str(pid))
+        os.makedirs(os.path.join(base, 'task'))
+        with open(os.path.join(base, 'status'), 'wb') as f:
+            f.write(content)
+        for tid in range(pid * 1000, pid * 1000 + threads):
+            os.mkdir(os.path.join(base, 'task', str(tid)))
+            with open(os.path.join(base, 'task', str(tid), 'status'), 'wb') as f:
+                f.write(content)
+
+
+def naive(root):
+    inverse = C.INVERSE_SUPPORTED_CAPS
+    records = []
+    for pid in os.listdir(root):
+        if not pid.isdigit():
+            continue
+        for tid in os.listdir(os.path.join(root, pid, 'task')):
+            with open(os.path.join(root, pid, 'task', tid, 'status')) as f:
+                record = {'pid': int(pid), 'tid': int(tid)}
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key.startswith('Cap'):
+                        mask = int(value.strip(), 16)
+                        record[key] = [inverse.get(i, i) for i in range(64) if (mask >> i) & 1]
+                    elif key in ('Uid', 'Gid'):
+                        record[key] = [int(i) for i in value.split()]
+                    elif key in ('NoNewPrivs', 'Seccomp', 'Name'):
+                        record[key] = value.strip()
+                records.append(record)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/proc inventory scan")
+    parser.add_argument('--processes', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--dir', default=None, help="where to build the fixture (a tmpfs is best)")
+    parser.add_argument('--workers', default='1,4', help="comma-separated pool sizes to compare")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='deescalate-proc-', dir=args.dir)
+    try:
+        start = time.perf_counter()
+        make_fixture(directory, args.processes, args.threads)
+        print("fixture: %d processes, %d threads, built in %.1f s" % (
+            args.processes, args.processes * args.threads, time.perf_counter() - start
+        ))
+        C.INVERSE_SUPPORTED_CAPS
+
+        def run(name, function):
+            start = time.perf_counter()
+            count = function()
+            elapsed = time.perf_counter() - start
+            print("%-32s %8.3f s %10.0f threads/s" % (name, elapsed, count / elapsed))
+
+        run('naive', lambda: len(naive(directory)))
+        for workers in (int(value) for value in args.workers.split(',')):
+            for use_numpy in ((False, True) if numpy is not None else (False,)):
+                run('scan(workers=%d, numpy=%s)' % (workers, use_numpy),
+                    lambda: sum(1 for _ in scan(directory, workers=workers, use_numpy=use_numpy)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
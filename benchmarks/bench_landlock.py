@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cost of a Landlock stage in prefork workers: ruleset built once in the master, against built in every worker.
+
+The ruleset allows reading a number of directories (the first subdirectories of /usr/share by default). The
+master builds it once; every worker then only calls `landlock_restrict_self` after `no_new_privs`. The baseline
+builds the whole ruleset again in every worker, before restricting itself. No privilege is needed.
+
+Run it with::
+
+    python benchmarks/bench_landlock.py --workers 200 --paths 100
+"""
+
+import os
+import json
+import time
+import argparse
+
+from deescalate import set_no_new_privs
+from deescalate.landlock import LandlockRuleset, ABI
+
+
+def ruleset_for(paths):
+    ruleset = LandlockRuleset()
+    for path in paths:
+        ruleset.allow(path, 'r')
+    return ruleset
+
+
+def worker(prebuilt, paths):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_end)
+            start = time.perf_counter()
+            set_no_new_privs()
+            ruleset = prebuilt if prebuilt is not None else ruleset_for(paths).build()
+            restrict = ruleset.restrict()
+            total = time.perf_counter() - start
+            os.write(write_end, json.dumps([total, restrict]).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    data = os.read(read_end, 4096)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads(data.decode('ascii'))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Landlock ruleset built once against built per worker")
+    parser.add_argument('--workers', type=int, default=200, help="number of forked workers per mode")
+    parser.add_argument('--paths', type=int, default=100, help="number of rules in the ruleset")
+    parser.add_argument('--root', default='/usr/share', help="the rules allow the subdirectories of this directory")
+    args = parser.parse_args()
+    if ABI <= 0:
+        parser.error("Landlock is not supported by the running kernel")
+
+    paths = sorted(
+        os.path.join(args.root, name) for name in os.listdir(args.root)
+        if os.path.isdir(os.path.join(args.root, name))
+    )[:args.paths]
+    prebuilt = ruleset_for(paths).build()
+    print("Landlock ABI %d, %d rules, built in %.1f us in the master" % (ABI, len(paths), prebuilt.build_time * 1e6))
+
+    print("\n%-12s %14s %14s %14s" % ('mode', 'median', 'p99', 'restrict'))
+    for mode, ruleset in (('prebuilt', prebuilt), ('per worker', None)):
+        results = [worker(ruleset, paths) for _ in range(args.workers)]
+        totals = [total for total, _ in results]
+        restricts = [restrict for _, restrict in results]
+        print("%-12s %11.1f us %11.1f us %11.1f us" % (
+            mode, percentile(totals, 0.5) * 1e6, percentile(totals, 0.99) * 1e6, percentile(restricts, 0.5) * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-worker lockdown cost in a prefork server.
+
+The master forks workers; each worker locks itself down, either with `lockdown_account` (users are resolved and
+capabilities normalized again in every worker) or with a `NativePlan` compiled once in the master. Each worker
+reports the time the lockdown took, and how many private pages it dirtied (copy-on-write breaks) doing so.
+
+Must be run as root::
+
+    python benchmarks/bench_prefork.py -n 200 -u nobody -c net_bind_service
+"""
+
+import argparse
+import json
+import os
+import time
+
+from deescalate import lockdown_account, plan_lockdown
+
+
+def private_dirty_kb():
+    with open('/proc/self/smaps_rollup', 'rb') as f:
+        for line in f:
+            if line.startswith(b'Private_Dirty:'):
+                return int(line.split()[1])
+    return 0
+
+
+def worker(mode, native_plan, args, wfd):
+    dirty_before = private_dirty_kb()
+    start = time.perf_counter()
+    if mode == 'native':
+        native_plan.apply()
+    else:
+        lockdown_account(args.user, args.group, args.capabilities)
+    elapsed = time.perf_counter() - start
+    dirty_after = private_dirty_kb()
+    os.write(wfd, json.dumps({'elapsed': elapsed, 'dirty_kb': dirty_after - dirty_before}).encode('ascii') + b'\n')
+
+
+def run(mode, native_plan, args):
+    rfd, wfd = os.pipe()
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close(rfd)
+                worker(mode, native_plan, args, wfd)
+            except BaseException:
+                status = 1
+            os._exit(status)
+        os.waitpid(pid, 0)
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as f:
+        results = [json.loads(line) for line in f]
+    if len(results) != args.workers:
+        raise RuntimeError("%d workers failed" % (args.workers - len(results)))
+    return results
+
+
+def report(mode, results):
+    timings = sorted(result['elapsed'] * 1e6 for result in results)
+    dirty = [result['dirty_kb'] for result in results]
+    print("%-18s median %8.1f us   p99 %8.1f us   dirtied %6.1f KiB/worker" % (
+        mode, timings[len(timings) // 2], timings[int(len(timings) * 0.99)], float(sum(dirty)) / len(dirty)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per-worker lockdown cost: lockdown_account vs NativePlan")
+    parser.add_argument('-n', '--workers', type=int, default=200)
+    parser.add_argument('-u', '--user', default='nobody')
+    parser.add_argument('-g', '--group', default=None)
+    parser.add_argument('-c', '--capabilities', default='net_bind_service')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    native_plan = plan_lockdown(args.user, args.group, args.capabilities).compile()
+    print("plan compiled in the master in %.1f us: %r" % ((time.perf_counter() - start) * 1e6, native_plan))
+    for mode in ('lockdown_account', 'native'):
+        report(mode, run(mode, native_plan, args))
+
+
+if __name__ == '__main__':
+    main()
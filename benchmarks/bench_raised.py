@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cost of raising a capability in the effective set for the duration of an operation.
+
+Compares the operator path (`effective += cap` ... `effective -= cap`) with the `effective.raised(cap)` context
+manager, created inline or hoisted out of the loop.
+
+Must be run with the capability in the permitted set (e.g. as root)::
+
+    python benchmarks/bench_raised.py -n 100000 -c net_admin
+"""
+
+import argparse
+import time
+
+from deescalate import effective, caps_to_mask
+
+
+def bench_operators(cap, n):
+    for _ in range(n):
+        effective.__iadd__(cap)
+        effective.__isub__(cap)
+
+
+def bench_raised_inline(cap, n):
+    for _ in range(n):
+        with effective.raised(cap):
+            pass
+
+
+def bench_raised_hoisted(cap, n):
+    raised = effective.raised(caps_to_mask(cap))
+    for _ in range(n):
+        with raised:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="effective += / -= vs effective.raised()")
+    parser.add_argument('-n', '--iterations', type=int, default=100000)
+    parser.add_argument('-c', '--capability', default='net_admin')
+    args = parser.parse_args()
+
+    cap = args.capability.encode('ascii')
+    effective.__isub__(cap)
+    for name, bench in (('operators', bench_operators), ('raised (inline)', bench_raised_inline),
+                        ('raised (hoisted)', bench_raised_hoisted)):
+        start = time.perf_counter()
+        bench(cap, args.iterations)
+        elapsed = time.perf_counter() - start
+        print("%-18s %8.2f us per raise/lower cycle" % (name, elapsed * 1e6 / args.iterations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-syscall overhead of the seccomp filters compiled by `deescalate.seccomp`, linear chain against decision tree.
+
+The policy is a container-style allow list: every system call of the architecture except a few dangerous ones,
+with EPERM as the default. Each filter is installed in its own child (a filter can not be removed), after
+`no_new_privs`, so no privilege is needed. The children time a few system calls from Python, at the start (fstat),
+in the middle (getppid) and at the end (getrandom) of the linear chain; the overhead is the difference with a child
+without filter.
+
+Since linux 5.11, the kernel does not run the filter for the system calls it always allows whatever the arguments
+(the filters of `deescalate.seccomp` never look at the arguments): on those kernels both filters cost the same for
+the allowed system calls, and the tree only shortens the denied ones and the filters of older kernels. The
+`insns` columns give the instructions each filter executes for the system call.
+
+Run it with::
+
+    python benchmarks/bench_seccomp.py --calls 1000000
+"""
+
+import os
+import json
+import time
+import argparse
+
+from deescalate import set_no_new_privs
+from deescalate.seccomp import SeccompPolicy, evaluate, _programs
+from deescalate.syscalls import SYSCALLS, machine
+
+DENIED = ('ptrace', 'mount', 'umount2', 'kexec_load', 'kexec_file_load', 'reboot', 'init_module', 'finit_module',
+          'delete_module', 'bpf', 'unshare', 'setns', 'swapon', 'swapoff', 'pivot_root', 'acct')
+
+
+def calls(count):
+    fd = os.open('/dev/null', os.O_RDONLY)
+    getppid, fstat, getrandom = os.getppid, os.fstat, os.getrandom
+    tests = {
+        'fstat': lambda: fstat(fd),
+        'getppid': getppid,
+        'getrandom': lambda: getrandom(0),
+    }
+    results = {}
+    for name, function in tests.items():
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            for _ in range(count):
+                function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best / count * 1e9
+    return results
+
+
+def measure(program, count):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_end)
+            if program is not None:
+                set_no_new_privs()
+                program.install()
+            os.write(write_end, json.dumps(calls(count)).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads(b''.join(chunks).decode('ascii'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="seccomp filter overhead, linear against tree")
+    parser.add_argument('--calls', type=int, default=1000000, help="system calls timed per test")
+    args = parser.parse_args()
+
+    table = SYSCALLS[machine()]
+    policy = SeccompPolicy(default='errno').allow([name for name in table if name not in DENIED])
+    programs = {}
+    for method in ('linear', 'tree'):
+        _programs.clear()
+        start = time.perf_counter()
+        programs[method] = policy.compile(method)
+        compiled = time.perf_counter() - start
+        start = time.perf_counter()
+        policy.compile(method)
+        cached = time.perf_counter() - start
+        print("%-6s %4d instructions, compiled in %.2f ms, from the cache in %.1f us" % (
+            method, programs[method].instructions, compiled * 1e3, cached * 1e6
+        ))
+
+    baseline = measure(None, args.calls)
+    print("\n%-10s %12s %22s %22s" % ('syscall', 'no filter', 'linear', 'tree'))
+    results = dict((method, measure(program, args.calls)) for method, program in programs.items())
+    for name in sorted(baseline):
+        cells = []
+        for method in ('linear', 'tree'):
+            executed = evaluate(programs[method], table[name])[1]
+            cells.append('%+7.1f ns (%3d insns)' % (results[method][name] - baseline[name], executed))
+        print("%-10s %9.1f ns %22s %22s" % (name, baseline[name], cells[0], cells[1]))
+
+
+if __name__ == '__main__':
+    main()
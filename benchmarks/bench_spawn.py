@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Spawn rate of locked down children.
+
+Each iteration starts `/bin/true` in a locked down child and waits for it:
+
+- `preexec_fn=lockdown_account`: the lockdown is computed and applied in the forked child
+- `preexec_fn=plan.apply`: a compiled `NativePlan` applied in the forked child
+- `spawn(plan=...)`: the `clone(CLONE_VM|CLONE_VFORK)` exec trampoline of deescalate
+
+`preexec_fn` forces subprocess to fork the parent, so the cost grows with the memory of the parent: use `--rss`
+to allocate some memory first. Must be run as root (or with the needed capabilities)::
+
+    python benchmarks/bench_spawn.py -n 500 -u nobody -c net_bind_service --rss 512
+"""
+
+import time
+import argparse
+import subprocess
+
+from deescalate import lockdown_account, plan_lockdown, spawn
+
+
+def bench_preexec_lockdown(args, n):
+    for _ in range(n):
+        subprocess.Popen(
+            ['/bin/true'], preexec_fn=lambda: lockdown_account(args.user, args.group, args.capabilities)
+        ).wait()
+
+
+def bench_preexec_plan(args, n):
+    plan = plan_lockdown(args.user, args.group, args.capabilities).compile()
+    for _ in range(n):
+        subprocess.Popen(['/bin/true'], preexec_fn=plan.apply).wait()
+
+
+def bench_spawn(args, n):
+    plan = plan_lockdown(args.user, args.group, args.capabilities).compile()
+    for _ in range(n):
+        spawn(['/bin/true'], plan=plan).wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="preexec_fn vs spawn()")
+    parser.add_argument('-n', '--iterations', type=int, default=500)
+    parser.add_argument('-u', '--user', default='nobody')
+    parser.add_argument('-g', '--group', default=None)
+    parser.add_argument('-c', '--capabilities', default='net_bind_service')
+    parser.add_argument('--rss', type=int, default=0, help="MiB of memory to allocate in the parent")
+    args = parser.parse_args()
+
+    ballast = bytearray(args.rss << 20)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+
+    for name, bench in (('preexec_fn=lockdown_account', bench_preexec_lockdown),
+                        ('preexec_fn=plan.apply', bench_preexec_plan), ('spawn(plan=...)', bench_spawn)):
+        start = time.perf_counter()
+        bench(args, args.iterations)
+        elapsed = time.perf_counter() - start
+        print("%-28s %8.0f spawns/s %8.1f us per spawn" % (
+            name, args.iterations / elapsed, elapsed * 1e6 / args.iterations
+        ))
+
+
+if __name__ == '__main__':
+    main()
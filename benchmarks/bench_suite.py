@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Regression suite: latency and system calls of the main operations, stored as JSON to compare commits.
+
+The suite re-executes itself inside a new user namespace (see `tests/userns.py`), as a mapped root with every
+capability, so it runs on a plain Linux box without real root. Set `DEESCALATE_NO_USERNS=1` to run it in the
+current namespace.
+
+Each benchmark reports the median and the 90th percentile of its latency, and the number of system calls of one
+operation, counted by tracing a child with `ptrace` (`PTRACE_GET_SYSCALL_INFO`, linux 5.3). The operations that
+change the privileges for good (bounding set drops, `lockdown_account`) run in fresh forked children. The CLI
+cold start counts the system calls of the whole `deescalate` process, interpreter startup and `/bin/true`
+included.
+
+Run it, then compare a later run with the first one (the exit status is 1 when something regressed)::
+
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --output after.json --compare before.json --threshold 10
+"""
+
+import os
+import sys
+import json
+import time
+import ctypes
+import signal
+import argparse
+import platform
+import subprocess
+
+# the user namespace helper of the test suite (appended: the installed deescalate must come first)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from tests.userns import reexec_in_user_namespace, in_user_namespace
+
+PTRACE_TRACEME = 0
+PTRACE_SYSCALL = 24
+PTRACE_SETOPTIONS = 0x4200
+PTRACE_GET_SYSCALL_INFO = 0x420e
+PTRACE_O_TRACESYSGOOD = 0x1
+PTRACE_O_EXITKILL = 0x100000
+PTRACE_SYSCALL_INFO_ENTRY = 1
+
+# the traced child brackets the measured operations with getpgid(MARK) and getpgid(MARK + 1)
+MARK = 0x7ffffff0
+
+
+class _SyscallInfo(ctypes.Structure):
+    _fields_ = [
+        ('op', ctypes.c_uint8), ('pad', ctypes.c_uint8 * 3), ('arch', ctypes.c_uint32),
+        ('instruction_pointer', ctypes.c_uint64), ('stack_pointer', ctypes.c_uint64),
+        ('nr', ctypes.c_uint64), ('args', ctypes.c_uint64 * 6), ('padding', ctypes.c_uint64 * 4),
+    ]
+
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.ptrace.argtypes = (ctypes.c_long, ctypes.c_long, ctypes.c_void_p, ctypes.c_void_p)
+_libc.ptrace.restype = ctypes.c_long
+
+
+def _ptrace(request, pid=0, addr=None, data=None):
+    if _libc.ptrace(request, pid, addr, data) == -1:
+        code = ctypes.get_errno()
+        raise OSError(code, "ptrace(0x%x): %s" % (request, os.strerror(code)))
+
+
+def _mark(value):
+    try:
+        os.getpgid(value)
+    except OSError:
+        pass
+
+
+def count_syscalls(body, iterations=1, marked=True):
+    """
+    Count the system calls of `body(iterations)`, run in a traced child.
+
+    Returns
+    -------
+    2-uple (float, dict)
+        system calls per iteration, and the number of calls of each system call
+    """
+    from deescalate.syscalls import SYSCALLS, machine
+    names = dict((number, name) for name, number in SYSCALLS.get(machine(), {}).items())
+    getpgid = SYSCALLS.get(machine(), {}).get('getpgid')
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _ptrace(PTRACE_TRACEME)
+            os.kill(os.getpid(), signal.SIGSTOP)
+            if marked:
+                _mark(MARK)
+            body(iterations)
+            if marked:
+                _mark(MARK + 1)
+        finally:
+            os._exit(0)
+
+    os.waitpid(pid, 0)
+    _ptrace(PTRACE_SETOPTIONS, pid, None, PTRACE_O_TRACESYSGOOD | PTRACE_O_EXITKILL)
+    info = _SyscallInfo()
+    counting = not marked
+    calls = {}
+    deliver = 0
+    while True:
+        _ptrace(PTRACE_SYSCALL, pid, None, deliver)
+        _, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+            break
+        deliver = 0
+        if os.WSTOPSIG(status) != (signal.SIGTRAP | 0x80):
+            # the SIGTRAP that follows an execve is not delivered
+            if os.WSTOPSIG(status) != signal.SIGTRAP:
+                deliver = os.WSTOPSIG(status)
+            continue
+        _libc.ptrace(PTRACE_GET_SYSCALL_INFO, pid, ctypes.c_void_p(ctypes.sizeof(info)), ctypes.byref(info))
+        if info.op != PTRACE_SYSCALL_INFO_ENTRY:
+            continue
+        if marked and info.nr == getpgid and info.args[0] in (MARK, MARK + 1):
+            counting = info.args[0] == MARK
+        elif counting:
+            name = names.get(info.nr, str(info.nr))
+            calls[name] = calls.get(name, 0) + 1
+    return float(sum(calls.values())) / iterations, calls
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+
+
+def time_loop(body, iterations, repeat):
+    """
+    Time `body(iterations)` `repeat` times: the samples are nanoseconds per iteration.
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body(iterations)
+        samples.append((time.perf_counter() - start) / iterations * 1e9)
+    return samples
+
+
+def time_in_children(body, children):
+    """
+    Run `body()` in `children` fresh forked children: `body` returns nanoseconds per operation, sent back.
+    """
+    samples = []
+    for _ in range(children):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                os.write(write_end, json.dumps(body()).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        data = os.read(read_end, 4096)
+        os.close(read_end)
+        os.waitpid(pid, 0)
+        samples.append(json.loads(data.decode('ascii')))
+    return samples
+
+
+def benchmarks(args):
+    from deescalate import C, CapMask, effective, bounding_set, lockdown_account, enable_cache, plan_lockdown
+    from deescalate import get_securebits, set_keep_caps
+
+    cap = b'net_admin'
+    clear, set_ = C.FLAG_VALUES[b'clear'], C.FLAG_VALUES[b'set']
+    all_caps = list(bounding_set)
+
+    def membership(n):
+        for _ in range(n):
+            cap in effective
+
+    def cached_membership(n):
+        enable_cache(True)
+        try:
+            membership(n)
+        finally:
+            enable_cache(False)
+
+    def iteration(n):
+        for _ in range(n):
+            list(effective)
+
+    def modify(n):
+        for _ in range(n):
+            effective._modify([cap], clear)
+            effective._modify([cap], set_)
+
+    def securebits_get(n):
+        for _ in range(n):
+            get_securebits()
+
+    def securebits_set(n):
+        for _ in range(n):
+            set_keep_caps(locked=False)
+
+    def drop_all(n):
+        for i in all_caps[:n]:
+            bounding_set.__isub__(CapMask(1 << i))
+
+    def timed_drops():
+        start = time.perf_counter()
+        drop_all(len(all_caps))
+        return (time.perf_counter() - start) / len(all_caps) * 1e9
+
+    def lockdown(n):
+        lockdown_account(caps_to_keep=b'net_bind_service')
+
+    def timed_lockdown():
+        # the plan is computed in the parent first: the children do not pay the first calls of the imports
+        start = time.perf_counter()
+        lockdown(1)
+        return (time.perf_counter() - start) * 1e9
+
+    loops = [
+        ('capset.membership', membership, 2),
+        ('capset.membership_cached', cached_membership, 2),
+        ('capset.iteration', iteration, 1),
+        ('capset.modify', modify, 0.5),
+        ('securebits.get', securebits_get, 2),
+        ('securebits.set', securebits_set, 1),
+    ]
+    for name, body, factor in loops:
+        n = max(1, int(args.iterations * factor))
+        yield name, lambda body=body, n=n: (time_loop(body, n, args.repeat), count_syscalls(body, 100))
+    # the operations that can not be undone run in fresh children
+    yield 'bounding.drop', lambda: (
+        time_in_children(timed_drops, args.children), count_syscalls(drop_all, len(all_caps))
+    )
+    plan_lockdown(caps_to_keep=b'net_bind_service')
+    yield 'lockdown_account', lambda: (time_in_children(timed_lockdown, args.children), count_syscalls(lockdown, 1))
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    cli = [sys.executable, '-m', 'deescalate.script', '-c', 'net_bind_service', '/bin/true']
+
+    def cold_start():
+        samples = []
+        for _ in range(args.cli_runs):
+            start = time.perf_counter()
+            subprocess.check_call(cli, env=env)
+            samples.append((time.perf_counter() - start) * 1e9)
+        return samples
+
+    def run_cli(n):
+        os.execve(sys.executable, cli, env)
+    yield 'cli.cold_start', lambda: (cold_start(), count_syscalls(run_cli, 1, marked=False))
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', 'HEAD'], stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    print("\n%-28s %12s %12s %8s %10s %10s" % ('benchmark', 'before', 'after', 'change', 'syscalls', 'before'))
+    for name, result in sorted(results.items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            print("%-28s %12s %9.0f ns" % (name, '-', result['median_ns']))
+            continue
+        change = (result['median_ns'] - before['median_ns']) / before['median_ns'] * 100
+        regressed = change > threshold or result['syscalls'] > before['syscalls']
+        regressions += regressed
+        print("%-28s %9.0f ns %9.0f ns %+7.1f%% %10.1f %10.1f%s" % (
+            name, before['median_ns'], result['median_ns'], change, result['syscalls'], before['syscalls'],
+            '  REGRESSION' if regressed else ''
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="deescalate regression benchmarks, stored as JSON")
+    parser.add_argument('-n', '--iterations', type=int, default=20000, help="iterations of each timed loop")
+    parser.add_argument('-r', '--repeat', type=int, default=7, help="timed loops per benchmark")
+    parser.add_argument('--children', type=int, default=50, help="forked children of the irreversible benchmarks")
+    parser.add_argument('--cli-runs', type=int, default=20, help="runs of the CLI cold start")
+    parser.add_argument('-o', '--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', metavar='JSON', help="compare with the results of an earlier run")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="latency increase (in percent) reported as a regression")
+    parser.add_argument('--only', help="run the benchmarks whose name contains this string")
+    args = parser.parse_args()
+    reexec_in_user_namespace([os.path.abspath(__file__)] + sys.argv[1:])
+
+    results = {}
+    print("%-28s %12s %12s %10s" % ('benchmark', 'median', 'p90', 'syscalls'))
+    for name, run in benchmarks(args):
+        if args.only and args.only not in name:
+            continue
+        samples, (syscalls, calls) = run()
+        median, p90 = _percentiles(samples)
+        results[name] = {'median_ns': median, 'p90_ns': p90, 'syscalls': syscalls, 'calls': calls}
+        print("%-28s %9.0f ns %9.0f ns %10.1f" % (name, median, p90, syscalls))
+
+    report = {
+        'meta': {
+            'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'kernel': platform.release(), 'machine': platform.machine(), 'user_namespace': in_user_namespace(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-event latency of the proc connector watcher.
+
+`--processes` children (`sleep`, kept alive so that their status can be read) are started by a thread while a
+`Watcher` checks every exec, UID, GID and fork event. The latency is measured from the kernel timestamp of the
+event to the end of its check.
+
+Must be run as root (`CAP_NET_ADMIN` is needed by the proc connector)::
+
+    python benchmarks/bench_watcher.py --processes 2000
+"""
+
+import time
+import asyncio
+import argparse
+import threading
+
+from deescalate import spawn
+from deescalate.watcher import Watcher, WatchPolicy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="proc connector watcher latency")
+    parser.add_argument('--processes', type=int, default=2000)
+    args = parser.parse_args()
+    policy = WatchPolicy(default={'effective': ''}).allow(user=0)
+
+    async def run():
+        children = []
+
+        def start_children():
+            for _ in range(args.processes):
+                children.append(spawn(['sleep', '5']))
+
+        checked = 0
+        async with Watcher(policy) as watcher:
+            starter = threading.Thread(target=start_children)
+            start = time.perf_counter()
+            starter.start()
+            while starter.is_alive() or checked < watcher.stats().checked:
+                try:
+                    await asyncio.wait_for(watcher.__anext__(), 1.0)
+                    checked += 1
+                except asyncio.TimeoutError:
+                    break
+            elapsed = time.perf_counter() - start
+            stats = watcher.stats()
+        for child in children:
+            child.kill()
+            child.wait()
+        print("%d events, %d checked, %d vanished, %d overruns in %.2f s (%.0f events/s)" % (
+            stats.events, stats.checked, stats.vanished, stats.overruns, elapsed, stats.events / elapsed
+        ))
+        print("latency mean %.0f us  p50 %.0f us  p99 %.0f us  max %.0f us" % (
+            stats.mean * 1e6, stats.p50 * 1e6, stats.p99 * 1e6, stats.max * 1e6
+        ))
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Launches per second of short python tasks, through the `deescalate` command and through a zygote.
+
+- `cli`: `deescalate -u USER -c CAPS python -c pass`, one at a time
+- `zygote exec`: `python -c pass` started by the zygote, one at a time
+- `zygote module`: an empty module run in the forked zygote, one at a time
+- `zygote module (async)`: the same, with `--concurrency` launches in flight
+
+Must be run as root (or with the needed capabilities)::
+
+    python benchmarks/bench_zygote.py -n 200 -u nobody -c net_bind_service --concurrency 16 --python /usr/bin/python3
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from deescalate.zygote import ZygoteClient, AsyncZygoteClient
+
+
+def check(status):
+    if status != 0:
+        raise RuntimeError("task failed with status %s" % status)
+
+
+def report(name, n, elapsed):
+    print("%-24s %8.0f launches/s %8.2f ms per launch" % (name, n / elapsed, elapsed * 1e3 / n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="deescalate command vs zygote")
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('-u', '--user', default='nobody')
+    parser.add_argument('-c', '--capabilities', default='net_bind_service')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--python', default=sys.executable,
+                        help="interpreter of the tasks (it must be executable by the user)")
+    args = parser.parse_args()
+
+    # the tasks import their module after the lockdown
+    directory = tempfile.mkdtemp(prefix='deescalate-bench-')
+    os.chmod(directory, 0o755)
+    with open(os.path.join(directory, 'bench_task.py'), 'w') as task:
+        task.write('pass\n')
+    socket_path = os.path.join(directory, 'zygote.sock')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([directory] + sys.path))
+    zygote = subprocess.Popen([sys.executable, '-m', 'deescalate.script', '--zygote', socket_path], env=env)
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        task = [args.python, '-c', 'pass']
+        lockdown = dict(user=args.user, capabilities=args.capabilities)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            subprocess.check_call(
+                [sys.executable, '-m', 'deescalate.script', '-u', args.user, '-c', args.capabilities, ' '.join(task)],
+                env=env
+            )
+        report('cli', args.iterations, time.perf_counter() - start)
+
+        with ZygoteClient(socket_path) as client:
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                check(client.launch(task, wait=True, **lockdown))
+            report('zygote exec', args.iterations, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                check(client.launch(['bench_task'], module='bench_task', wait=True, **lockdown))
+            report('zygote module', args.iterations, time.perf_counter() - start)
+
+        async def launch_all():
+            client = await AsyncZygoteClient.connect(socket_path)
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def launch():
+                async with semaphore:
+                    return await client.launch(['bench_task'], module='bench_task', wait=True, **lockdown)
+
+            try:
+                return await asyncio.gather(*(launch() for _ in range(args.iterations)))
+            finally:
+                client.close()
+
+        start = time.perf_counter()
+        for status in asyncio.run(launch_all()):
+            check(status)
+        report('zygote module (async)', args.iterations, time.perf_counter() - start)
+    finally:
+        zygote.terminate()
+        zygote.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,15 @@
 __author__ = 'stephane.martin_github@vesperal.eu'
 
 from .main import lockdown_account
+from .main import get_capabilities, set_capabilities
 from .main import get_securebits, set_noroot, set_keep_caps, set_no_setuid_fixup, set_no_new_privs
-from .main import permitted, inheritable, effective, bounding_set, CapabilitySet, BoundingSet
+from .main import permitted, inheritable, effective, bounding_set, ambient, CapabilitySet, BoundingSet, AmbientSet
+from .main import enable_cache
+from .main import enable_stats, get_stats, reset_stats, add_stats_hook, remove_stats_hook
 from .constants import C
+from .capmask import CapMask, caps_to_mask, normalize_many
+from .state import snapshot, CapState
+from .plan import plan_lockdown, LockdownPlan, NativePlan
+from .identity import Identity, IdentityCache, identities, resolve_identity
+from .process import spawn, SpawnedProcess, PIPE, DEVNULL
+from .captext import CapText, compile_text
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# asyncio counterpart of deescalate.process (python 3 only, so it is not imported by the package)
+
+import os
+import asyncio
+
+from .process import spawn, PIPE, DEVNULL
+
+
+class AsyncProcess(object):
+    """
+    A child started by `create_subprocess_exec`.
+
+    Attributes
+    ----------
+    pid: int
+        PID of the child
+    stdin: asyncio.StreamWriter or None
+    stdout, stderr: asyncio.StreamReader or None
+    returncode: int or None
+        exit status of the child once it is terminated (`-N` when killed by signal `N`), else None
+    """
+
+    def __init__(self, process, loop, stdin=None, stdout=None, stderr=None):
+        self._process = process
+        self._loop = loop
+        self._waiter = None
+        self.pid = process.pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        # a pidfd refers to the child itself, even if its PID is reused after it is reaped
+        try:
+            self._pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            self._pidfd = None
+
+    @property
+    def returncode(self):
+        return self._process.returncode
+
+    def _on_exit(self):
+        self._loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        self._pidfd = None
+        self._process.wait()
+        if not self._waiter.done():
+            self._waiter.set_result(self._process.returncode)
+
+    async def wait(self):
+        """
+        Wait for the child to terminate, without blocking the event loop.
+
+        Returns
+        -------
+        int
+            the `returncode`
+        """
+        if self._process.returncode is not None:
+            return self._process.returncode
+        if self._pidfd is None:
+            # kernel without pidfd: wait in a thread
+            return await self._loop.run_in_executor(None, self._process.wait)
+        if self._waiter is None:
+            self._waiter = self._loop.create_future()
+            self._loop.add_reader(self._pidfd, self._on_exit)
+        return await asyncio.shield(self._waiter)
+
+    async def communicate(self, input=None):
+        """
+        Send `input` to the child, read its output until EOF, and wait for it to terminate.
+
+        Returns
+        -------
+        2-uple (stdout data or None, stderr data or None)
+        """
+        async def feed():
+            if self.stdin is None:
+                return
+            if input:
+                self.stdin.write(input)
+                try:
+                    await self.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            self.stdin.close()
+
+        async def read(stream):
+            return None if stream is None else await stream.read()
+
+        _, stdout, stderr = await asyncio.gather(feed(), read(self.stdout), read(self.stderr))
+        await self.wait()
+        return stdout, stderr
+
+    def send_signal(self, signum):
+        self._process.send_signal(signum)
+
+    def terminate(self):
+        self._process.terminate()
+
+    def kill(self):
+        self._process.kill()
+
+    def __repr__(self):
+        return '<AsyncProcess pid=%s returncode=%s>' % (self.pid, self.returncode)
+
+
+async def create_subprocess_exec(program, *args, plan=None, uid=None, gid=None, caps_to_keep=None, ambient=False,
+                                 env=None, cwd=None, stdin=None, stdout=None, stderr=None, limit=2 ** 16):
+    """
+    Run a command in a locked down child, the asyncio way.
+
+    Same as `asyncio.create_subprocess_exec`, with the lockdown parameters of `spawn`. The child is started by the
+    exec trampoline of `spawn`, which does not fork the parent and never blocks the event loop for long.
+
+    Parameters
+    ----------
+    program, args:
+        the command
+    plan: NativePlan or LockdownPlan, optional
+        the lockdown of the child (see `spawn`)
+    uid, gid, caps_to_keep, ambient: optional
+        see `lockdown_account`
+    env, cwd: optional
+        environment and working directory of the child
+    stdin, stdout, stderr: None, PIPE, DEVNULL, file descriptor or file object
+        standard streams of the child; with `PIPE`, the matching attribute of the result is an asyncio stream
+    limit: int
+        buffer limit of the stream readers
+
+    Returns
+    -------
+    AsyncProcess
+
+    Examples
+    --------
+    >>> plan = plan_lockdown('nobody', 'nogroup', caps_to_keep=None).compile()
+    >>> child = await create_subprocess_exec('ls', '-l', plan=plan, stdout=PIPE)
+    >>> output, _ = await child.communicate()
+    """
+    loop = asyncio.get_running_loop()
+    process = spawn(
+        (program,) + args, plan=plan, uid=uid, gid=gid, caps_to_keep=caps_to_keep, ambient=ambient, env=env,
+        cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr
+    )
+    streams = []
+    for pipe in (process.stdout, process.stderr):
+        if pipe is None:
+            streams.append(None)
+            continue
+        reader = asyncio.StreamReader(limit=limit, loop=loop)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), pipe)
+        streams.append(reader)
+    writer = None
+    if process.stdin is not None:
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader(loop=loop), loop=loop), process.stdin
+        )
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    return AsyncProcess(process, loop, writer, streams[0], streams[1])
+
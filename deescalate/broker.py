@@ -0,0 +1,669 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Broker: a small privileged helper that opens the resources allowed by a policy and passes their file descriptors
+# to locked down workers (python 3 only, so it is not imported by the package).
+
+import os
+import stat
+import time
+import errno
+import fnmatch
+import socket
+import selectors
+import threading
+from collections import namedtuple, deque
+
+from .fdpass import MAX_FDS, MAX_MESSAGE, send_message, recv_message
+from .utils import percentiles
+from .cd import openat2, RESOLVE_NO_SYMLINKS, RESOLVE_NO_MAGICLINKS
+
+#: latency statistics of a `BrokerClient` (the latencies are in seconds, per round trip)
+BrokerStats = namedtuple('BrokerStats', ('requests', 'batches', 'denied', 'errors', 'mean', 'p50', 'p99', 'max'))
+
+_OPEN_FLAGS = {
+    'r': os.O_RDONLY,
+    'w': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+    'a': os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+    'r+': os.O_RDWR,
+    'w+': os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+    'a+': os.O_RDWR | os.O_CREAT | os.O_APPEND,
+}
+_OPEN_ACCESS = {'r': 'r', 'w': 'w', 'a': 'w', 'r+': 'rw', 'w+': 'rw', 'a+': 'rw'}
+_SOCKET_TYPES = {'tcp': socket.SOCK_STREAM, 'udp': socket.SOCK_DGRAM}
+# cleared at the first ENOSYS
+_openat2_available = True
+
+
+def _open_mode(mode):
+    mode = mode.replace('b', '').replace('t', '')
+    if mode not in _OPEN_FLAGS:
+        raise ValueError("invalid mode: %r" % mode)
+    return mode
+
+
+def _open_no_symlinks(path, flags):
+    global _openat2_available
+    if _openat2_available:
+        try:
+            # openat2 refuses a mode without O_CREAT
+            mode = 0o666 if flags & os.O_CREAT else 0
+            return openat2(os.fsencode(path), flags, mode, RESOLVE_NO_SYMLINKS | RESOLVE_NO_MAGICLINKS)
+        except OSError as ex:
+            if ex.errno not in (errno.ENOSYS, errno.EPERM):
+                raise
+            # old kernel, or openat2 refused by a seccomp filter
+            _openat2_available = False
+    return os.open(path, flags | os.O_NOFOLLOW, 0o666)
+
+
+def _channel_socket(fd):
+    # the file descriptor sent by a worker must be a Unix SOCK_SEQPACKET socket
+    try:
+        sock = socket.socket(fileno=fd)
+    except OSError:
+        os.close(fd)
+        raise ValueError("the channel is not a socket")
+    if sock.family != socket.AF_UNIX or sock.type != socket.SOCK_SEQPACKET:
+        sock.close()
+        raise ValueError("the channel is not a Unix SOCK_SEQPACKET socket")
+    return sock
+
+
+def _family(value):
+    if isinstance(value, int):
+        return value
+    return getattr(socket, 'AF_' + value.upper())
+
+
+def _denied(description):
+    return OSError(errno.EACCES, "%s is not allowed by the broker policy" % description)
+
+
+class BrokerPolicy(object):
+    """
+    Allow-list of the resources a `Broker` may open.
+
+    Nothing is allowed by default. The rules are added with `allow_listen`, `allow_raw` and `allow_open`, or loaded
+    with `from_dict`.
+
+    Examples
+    --------
+    >>> policy = BrokerPolicy().allow_listen(443).allow_listen((8000, 8099), host='127.0.0.1')
+    >>> policy.allow_open('/etc/ssl/private/*.pem')
+    >>> policy.capabilities()
+    [b'net_bind_service', b'dac_read_search']
+    """
+
+    def __init__(self):
+        self._listen = []
+        self._raw = []
+        self._open = []
+
+    def allow_listen(self, ports, host=None, type='tcp'):
+        """
+        Allow listening sockets.
+
+        Parameters
+        ----------
+        ports: int or 2-uple of int
+            a port, or an inclusive range of ports
+        host: str, optional
+            the only address the sockets may be bound to (default: any address)
+        type: str
+            'tcp' or 'udp'
+        """
+        if type not in _SOCKET_TYPES:
+            raise ValueError("invalid socket type: %r" % type)
+        low, high = (ports, ports) if isinstance(ports, int) else (int(ports[0]), int(ports[1]))
+        self._listen.append((type, host, low, high))
+        return self
+
+    def allow_raw(self, family=socket.AF_INET, protocol=None):
+        """
+        Allow raw sockets (`SOCK_RAW`).
+
+        Parameters
+        ----------
+        family: int or str
+            address family, such as `socket.AF_INET` or 'packet'
+        protocol: int, optional
+            the only protocol allowed (default: any protocol)
+        """
+        self._raw.append((_family(family), protocol))
+        return self
+
+    def allow_open(self, pattern, mode='r'):
+        """
+        Allow opening files.
+
+        Parameters
+        ----------
+        pattern: str
+            shell pattern (see `fnmatch`) of the absolute paths, matched after the resolution of the symbolic links;
+            `*` also matches `/`
+        mode: str
+            'r' for reading, 'w' for writing (the files may be created, truncated or appended), 'rw' for both
+        """
+        if not mode or set(mode) - set('rw'):
+            raise ValueError("invalid mode: %r" % mode)
+        self._open.append((pattern, frozenset(mode)))
+        return self
+
+    @classmethod
+    def from_dict(cls, rules):
+        """
+        Build a policy from a dictionary (typically loaded from a JSON or YAML file).
+
+        Examples
+        --------
+        >>> BrokerPolicy.from_dict({
+        ...     'listen': [{'port': 80}, {'ports': [8000, 8099], 'host': '127.0.0.1', 'type': 'udp'}],
+        ...     'raw': [{'family': 'inet', 'protocol': 1}],
+        ...     'open': [{'path': '/var/log/app/*.log', 'mode': 'w'}],
+        ... })
+        """
+        policy = cls()
+        for rule in rules.get('listen', ()):
+            policy.allow_listen(rule['ports'] if 'ports' in rule else rule['port'], rule.get('host'),
+                                rule.get('type', 'tcp'))
+        for rule in rules.get('raw', ()):
+            policy.allow_raw(rule.get('family', socket.AF_INET), rule.get('protocol'))
+        for rule in rules.get('open', ()):
+            policy.allow_open(rule['path'], rule.get('mode', 'r'))
+        return policy
+
+    def capabilities(self):
+        """
+        The capabilities the broker needs to open the allowed resources.
+
+        Returns
+        -------
+        list of bytes
+        """
+        caps = []
+        if any(low < 1024 for _, _, low, _ in self._listen):
+            caps.append(b'net_bind_service')
+        if self._raw:
+            caps.append(b'net_raw')
+        if any('w' in modes for _, modes in self._open):
+            caps.append(b'dac_override')
+        elif self._open:
+            caps.append(b'dac_read_search')
+        return caps
+
+    def check_listen(self, type, host, port):
+        for allowed_type, allowed_host, low, high in self._listen:
+            if type == allowed_type and allowed_host in (None, host) and low <= port <= high:
+                return
+        raise _denied("listening on %s %s:%s" % (type, host, port))
+
+    def check_raw(self, family, protocol):
+        for allowed_family, allowed_protocol in self._raw:
+            if family == allowed_family and allowed_protocol in (None, protocol):
+                return
+        raise _denied("raw socket (family %s, protocol %s)" % (family, protocol))
+
+    def check_open(self, path, mode):
+        """
+        Raises
+        ------
+        OSError
+            EACCES if opening the absolute and resolved `path` with `mode` is not allowed
+        """
+        needed = set(_OPEN_ACCESS[mode])
+        for pattern, modes in self._open:
+            if needed <= modes and fnmatch.fnmatchcase(path, pattern):
+                return
+        raise _denied("opening %s with mode %r" % (path, mode))
+
+
+class Broker(object):
+    """
+    Server side of the broker: opens the resources requested by the workers, after checking the policy.
+
+    Usually started by `start_broker`.
+
+    Parameters
+    ----------
+    policy: BrokerPolicy
+        what the workers may request
+    sock: socket.socket
+        first channel (a `SOCK_SEQPACKET` Unix socket); more channels are added by the workers
+
+    Notes
+    -----
+    - Each message is a JSON object with an `id`. A batch (`{"id": 1, "batch": [request, ...]}`) is answered by
+      `{"id": 1, "results": [...]}`: one result per request, either `{"fd": true}` or `{"error": ..., "errno": ...}`,
+      and the file descriptors of the successful requests are attached in order (`SCM_RIGHTS`). A batch has at most
+      253 requests (`SCM_MAX_FD`).
+
+    - The requests are `{"op": "listen", "port": 443, "host": "0.0.0.0", "type": "tcp", "backlog": 128,
+      "reuseport": false, "cache": true}`, `{"op": "raw", "family": 2, "protocol": 1}` and
+      `{"op": "open", "path": "/etc/ssl/private/key.pem", "mode": "r"}`.
+
+    - Listening sockets are cached: every worker asking for the same address gets the same socket. With
+      `reuseport`, each channel gets its own `SO_REUSEPORT` socket, dropped from the cache when the channel is
+      closed, so that the kernel balances the connections between the workers.
+
+    - The broker exits when its last channel is closed.
+    """
+
+    def __init__(self, policy, sock):
+        self.policy = policy
+        self._selector = selectors.DefaultSelector()
+        self._listeners = {}
+        self._channel_listeners = {}
+        self._requests = self._batches = self._denied = self._errors = self._fds = 0
+        self._service_times = deque(maxlen=4096)
+        self._add_channel(sock)
+
+    def _add_channel(self, sock):
+        sock.setblocking(True)
+        self._selector.register(sock, selectors.EVENT_READ)
+        self._channel_listeners[sock] = []
+
+    def _drop_channel(self, sock):
+        self._selector.unregister(sock)
+        for key in self._channel_listeners.pop(sock):
+            listener = self._listeners.pop(key, None)
+            if listener is not None:
+                listener.close()
+        sock.close()
+
+    def serve_forever(self):
+        """
+        Handle the requests until every channel is closed.
+        """
+        while self._channel_listeners:
+            for key, _ in self._selector.select():
+                self._handle(key.fileobj)
+        for listener in self._listeners.values():
+            listener.close()
+        self._listeners.clear()
+        self._selector.close()
+
+    def stats(self):
+        """
+        Server side counters, and service times in seconds (per message).
+        """
+        mean, p50, p99, maximum = percentiles(self._service_times)
+        return {
+            'requests': self._requests, 'batches': self._batches, 'denied': self._denied, 'errors': self._errors,
+            'fds': self._fds, 'channels': len(self._channel_listeners), 'listeners': len(self._listeners),
+            'mean': mean, 'p50': p50, 'p99': p99, 'max': maximum,
+        }
+
+    def _handle(self, sock):
+        try:
+            message, fds = recv_message(sock, 1)
+        except (OSError, ValueError):
+            message, fds = None, []
+        if not isinstance(message, dict):
+            for fd in fds:
+                os.close(fd)
+            self._drop_channel(sock)
+            return
+        start = time.perf_counter()
+        response, sent, owned = {'id': message.get('id')}, [], []
+        try:
+            if 'batch' in message:
+                response['results'] = self._batch(sock, message['batch'], sent, owned)
+            elif message.get('op') == 'channel' and len(fds) == 1:
+                self._add_channel(_channel_socket(fds.pop()))
+                response['channel'] = True
+            elif message.get('op') == 'stats':
+                response['stats'] = self.stats()
+            else:
+                raise ValueError("invalid message")
+        except (OSError, ValueError, TypeError, AttributeError) as ex:
+            self._errors += 1
+            code = ex.errno if isinstance(ex, OSError) and ex.errno else errno.EINVAL
+            response, sent = {'id': response['id'], 'error': str(ex), 'errno': code}, []
+        try:
+            send_message(sock, response, sent)
+        except OSError:
+            # the worker went away
+            pass
+        finally:
+            for fd in fds + owned:
+                os.close(fd)
+        self._service_times.append(time.perf_counter() - start)
+
+    def _batch(self, sock, requests, sent, owned):
+        if len(requests) > MAX_FDS:
+            raise ValueError("too many requests in a batch (%d > %d)" % (len(requests), MAX_FDS))
+        self._batches += 1
+        results = []
+        for request in requests:
+            self._requests += 1
+            try:
+                fd, close = self._open(sock, request)
+            except (OSError, ValueError, KeyError, TypeError) as ex:
+                code = ex.errno if isinstance(ex, OSError) and ex.errno else errno.EINVAL
+                if code == errno.EACCES:
+                    self._denied += 1
+                else:
+                    self._errors += 1
+                results.append({'error': ex.strerror if isinstance(ex, OSError) and ex.strerror else str(ex),
+                                'errno': code})
+                continue
+            sent.append(fd)
+            if close:
+                owned.append(fd)
+            results.append({'fd': True})
+        self._fds += len(sent)
+        return results
+
+    def _open(self, sock, request):
+        # returns the file descriptor, and True if it must be closed once sent
+        operation = request['op']
+        if operation == 'listen':
+            listener, cached = self._listener(sock, request)
+            return (listener.fileno(), False) if cached else (listener.detach(), True)
+        if operation == 'raw':
+            family, protocol = _family(request.get('family', socket.AF_INET)), int(request.get('protocol', 0))
+            self.policy.check_raw(family, protocol)
+            return socket.socket(family, socket.SOCK_RAW, protocol).detach(), True
+        if operation == 'open':
+            return self._open_file(request['path'], _open_mode(request.get('mode', 'r'))), True
+        raise ValueError("invalid operation: %r" % operation)
+
+    def _listener(self, sock, request):
+        kind, host, port = request.get('type', 'tcp'), request.get('host', '0.0.0.0'), int(request['port'])
+        if kind not in _SOCKET_TYPES:
+            raise ValueError("invalid socket type: %r" % kind)
+        self.policy.check_listen(kind, host, port)
+        reuseport = bool(request.get('reuseport'))
+        key = (kind, host, port, sock if reuseport else None)
+        listener = self._listeners.get(key)
+        if listener is not None:
+            return listener, True
+        listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, _SOCKET_TYPES[kind])
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuseport:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listener.bind((host, port))
+            if kind == 'tcp':
+                listener.listen(int(request.get('backlog', 128)))
+        except BaseException:
+            listener.close()
+            raise
+        if port == 0 or not request.get('cache', True):
+            return listener, False
+        self._listeners[key] = listener
+        if reuseport:
+            self._channel_listeners[sock].append(key)
+        return listener, True
+
+    def _open_file(self, path, mode):
+        if not os.path.isabs(path):
+            raise ValueError("path must be absolute: %r" % path)
+        resolved = os.path.realpath(path)
+        self.policy.check_open(resolved, mode)
+        # the resolved path has no symbolic link left: openat2 refuses a link swapped in meanwhile in any component
+        # (O_NOFOLLOW only protects the last one on older kernels), and the path of the opened file is checked
+        # again before the file is truncated
+        flags = _OPEN_FLAGS[mode]
+        fd = _open_no_symlinks(resolved, (flags & ~os.O_TRUNC) | os.O_NOCTTY | os.O_CLOEXEC)
+        try:
+            try:
+                opened = os.readlink('/proc/self/fd/%d' % fd)
+            except OSError:
+                info, opened = os.stat(resolved), resolved
+                if (info.st_dev, info.st_ino) != (os.fstat(fd).st_dev, os.fstat(fd).st_ino):
+                    raise _denied("opening %s" % path)
+            self.policy.check_open(opened, mode)
+            if flags & os.O_TRUNC and stat.S_ISREG(os.fstat(fd).st_mode):
+                os.ftruncate(fd, 0)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+
+class BrokerClient(object):
+    """
+    Client of a `Broker`, over one channel.
+
+    A channel carries one request at a time: the threads of a worker share it (a lock serializes the round trips),
+    but each worker process needs its own channel. Create it with `new_channel` before forking the worker.
+
+    Attributes
+    ----------
+    sock: socket.socket
+        the channel
+    process: SpawnedProcess or None
+        the broker process, for the client returned by `start_broker`
+    """
+
+    def __init__(self, sock, process=None):
+        self.sock = sock
+        self.process = process
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._requests = self._batches = self._denied = self._errors = 0
+        self._latencies = deque(maxlen=4096)
+
+    def _call(self, message, fds=()):
+        with self._lock:
+            self._next_id += 1
+            message['id'] = self._next_id
+            start = time.perf_counter()
+            send_message(self.sock, message, fds)
+            response, received = recv_message(self.sock)
+            self._latencies.append(time.perf_counter() - start)
+        if response is None:
+            raise RuntimeError("the broker closed the channel")
+        if 'error' in response:
+            for fd in received:
+                os.close(fd)
+            raise OSError(response.get('errno') or errno.EINVAL, response['error'])
+        return response, received
+
+    def request_many(self, requests):
+        """
+        Send many requests, in as few round trips as possible.
+
+        Parameters
+        ----------
+        requests: list of dict
+            requests (see `Broker`), such as `{'op': 'listen', 'port': 443}`
+
+        Returns
+        -------
+        list
+            for each request, the received file descriptor (int) or the `OSError` that made it fail
+        """
+        results = []
+        chunk, size = [], 0
+        for request in list(requests) + [None]:
+            encoded = len(repr(request)) if request is not None else 0
+            if chunk and (request is None or len(chunk) == MAX_FDS or size + encoded > MAX_MESSAGE // 2):
+                results.extend(self._send_batch(chunk))
+                chunk, size = [], 0
+            if request is not None:
+                chunk.append(request)
+                size += encoded
+        return results
+
+    def _send_batch(self, requests):
+        response, fds = self._call({'batch': requests})
+        self._batches += 1
+        self._requests += len(requests)
+        fds.reverse()
+        results = []
+        for result in response['results']:
+            if 'error' in result:
+                if result.get('errno') == errno.EACCES:
+                    self._denied += 1
+                else:
+                    self._errors += 1
+                results.append(OSError(result.get('errno') or errno.EINVAL, result['error']))
+            else:
+                results.append(fds.pop())
+        return results
+
+    def request(self, request):
+        """
+        Send one request.
+
+        Returns
+        -------
+        int
+            the received file descriptor
+
+        Raises
+        ------
+        OSError
+            EACCES if the policy of the broker does not allow it, or the error of the broker
+        """
+        result = self.request_many([request])[0]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def listen(self, port, host='0.0.0.0', type='tcp', backlog=128, reuseport=False, cache=True):
+        """
+        Get a listening socket (bound, and listening for TCP).
+
+        Parameters
+        ----------
+        port: int
+        host: str
+        type: str
+            'tcp' or 'udp'
+        backlog: int
+            backlog of a new TCP socket
+        reuseport: bool
+            get a `SO_REUSEPORT` socket of this channel, instead of the socket shared by every channel
+        cache: bool
+            if False, always create a new socket
+
+        Returns
+        -------
+        socket.socket
+        """
+        return socket.socket(fileno=self.request({
+            'op': 'listen', 'port': port, 'host': host, 'type': type, 'backlog': backlog, 'reuseport': reuseport,
+            'cache': cache,
+        }))
+
+    def raw_socket(self, family=socket.AF_INET, protocol=socket.IPPROTO_ICMP):
+        """
+        Get a raw socket (`SOCK_RAW`).
+
+        Returns
+        -------
+        socket.socket
+        """
+        return socket.socket(fileno=self.request({'op': 'raw', 'family': family, 'protocol': protocol}))
+
+    def open(self, path, mode='r', buffering=-1):
+        """
+        Open a file through the broker (`mode` as in `open`).
+
+        Returns
+        -------
+        file object
+        """
+        return os.fdopen(self.request({'op': 'open', 'path': path, 'mode': _open_mode(mode)}), mode, buffering)
+
+    def new_channel(self):
+        """
+        Open a new channel to the broker.
+
+        Returns
+        -------
+        BrokerClient
+        """
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._call({'op': 'channel'}, [theirs.fileno()])
+        except BaseException:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        return BrokerClient(ours)
+
+    def stats(self):
+        """
+        Client side counters and round trip latencies (the last 4096 round trips).
+
+        Returns
+        -------
+        BrokerStats
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+        return BrokerStats(self._requests, self._batches, self._denied, self._errors, *percentiles(latencies))
+
+    def server_stats(self):
+        """
+        Counters and service times of the broker (see `Broker.stats`).
+
+        Returns
+        -------
+        dict
+        """
+        return self._call({'op': 'stats'})[0]['stats']
+
+    def close(self):
+        """
+        Close the channel. The broker exits when its last channel is closed.
+        """
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def start_broker(policy, lockdown=True):
+    """
+    Fork a broker process. Call it before `lockdown_account`, and before starting threads.
+
+    Parameters
+    ----------
+    policy: BrokerPolicy
+        what the workers may request
+    lockdown: bool
+        if True, the broker keeps its identity but drops every capability that the policy does not need (see
+        `BrokerPolicy.capabilities`)
+
+    Returns
+    -------
+    BrokerClient
+        the first channel to the broker
+
+    Examples
+    --------
+    >>> broker = start_broker(BrokerPolicy().allow_listen(443, type='tcp'))
+    >>> lockdown_account('www-data', 'www-data')
+    >>> server = broker.listen(443)
+    """
+    from .process import SpawnedProcess
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    pid = os.fork()
+    if pid != 0:
+        theirs.close()
+        return BrokerClient(ours, SpawnedProcess(pid, ['deescalate-broker']))
+    code = 1
+    try:
+        ours.close()
+        if lockdown:
+            from .main import lockdown_account
+            lockdown_account(caps_to_keep=policy.capabilities())
+        Broker(policy, theirs).serve_forever()
+        code = 0
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        os._exit(code)
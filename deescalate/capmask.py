@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+from .constants import C
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+#: all the bits of a 64 bits capability mask
+FULL_MASK = (1 << 64) - 1
+
+# caches of already normalized capability strings (str or bytes -> mask), for the lax and the strict modes
+_string_caches = ({}, {})
+_STRING_CACHE_SIZE = 4096
+
+
+class CapMask(int):
+    """
+    Immutable set of capabilities, stored as a 64 bits mask: bit `n` is set when capability `n` belongs to the set.
+
+    Notes
+    -----
+    - Union, intersection, difference, membership and length are O(1)::
+
+        m = CapMask.from_caps(b'net_raw,net_admin')
+        m | CapMask.from_caps(b'setuid')
+        m - CapMask.from_caps(b'net_raw')
+        b'net_admin' in m
+        len(m)
+
+    - A CapMask is iterable and yields the capability values, like the sets returned by `normalize_list_of_caps`.
+
+    - A CapMask is an int, so it is hashable and can be stored or compared as such. In the operators, an int is a
+      raw mask, like in `CapMask(value)`; in `in`, it is a capability value.
+    """
+    __slots__ = ()
+
+    def __new__(cls, value=0):
+        value = int(value)
+        if value < 0 or value > FULL_MASK:
+            raise ValueError("a capability mask must fit in 64 bits")
+        return int.__new__(cls, value)
+
+    @classmethod
+    def from_caps(cls, caps, strict=False):
+        """
+        Build a mask from capabilities (see `caps_to_mask`).
+        """
+        return caps_to_mask(caps, strict)
+
+    def __or__(self, other):
+        return CapMask(int(self) | _as_mask(other))
+    __ror__ = __or__
+    __add__ = __or__
+    __radd__ = __or__
+
+    def __and__(self, other):
+        return CapMask(int(self) & _as_mask(other))
+    __rand__ = __and__
+
+    def __xor__(self, other):
+        return CapMask(int(self) ^ _as_mask(other))
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        return CapMask(int(self) & ~_as_mask(other))
+
+    def __rsub__(self, other):
+        return CapMask(_as_mask(other) & ~int(self))
+
+    def __invert__(self):
+        return CapMask(~int(self) & FULL_MASK)
+
+    def __contains__(self, item):
+        if isinstance(item, int):
+            return 0 <= item < 64 and bool((int(self) >> item) & 1)
+        bit = _lookup_name(item)
+        return bit is not None and bool(int(self) & bit)
+
+    def __iter__(self):
+        m = int(self)
+        while m:
+            low = m & -m
+            yield low.bit_length() - 1
+            m ^= low
+
+    def __len__(self):
+        return bin(int(self)).count('1')
+
+    def __bool__(self):
+        return int(self) != 0
+    __nonzero__ = __bool__
+
+    def issubset(self, other):
+        return (int(self) & ~_as_mask(other)) == 0
+
+    def issuperset(self, other):
+        return (_as_mask(other) & ~int(self)) == 0
+
+    def names(self):
+        """
+        Return the names of the capabilities in the mask.
+
+        Returns
+        -------
+        list of bytes
+        """
+        return [C.INVERSE_SUPPORTED_CAPS.get(i, str(i).encode('ascii')) for i in self]
+
+    def __repr__(self):
+        return "CapMask(0x%016x)" % int(self)
+
+    def __str__(self):
+        return ','.join(name.decode('ascii') for name in self.names())
+
+    def __reduce__(self):
+        return CapMask, (int(self),)
+
+
+#: the empty mask
+EMPTY = CapMask(0)
+
+
+def _lookup_name(name):
+    bit = C.CAPS_BITS.get(name)
+    if bit is None:
+        if isinstance(name, unicode):
+            name = name.encode('ascii')
+        if isinstance(name, bytes):
+            bit = C.CAPS_BITS.get(name.lower().strip())
+    return bit
+
+
+def _as_mask(other):
+    if isinstance(other, int):
+        return int(other)
+    return int(caps_to_mask(other))
+
+
+def _mask_of_tokens(tokens, strict):
+    m = 0
+    supported = C.SUPPORTED_CAPS_MASK
+    bits = C.CAPS_BITS
+    for cap in tokens:
+        if isinstance(cap, int):
+            bit = (1 << cap) if 0 <= cap < 64 else 0
+            if not bit & supported:
+                bit = None
+        else:
+            bit = bits.get(cap)
+            if bit is None:
+                bit = _lookup_name(cap)
+        if bit is None:
+            if strict:
+                raise ValueError("unsupported capability: %r" % (cap,))
+            continue
+        m |= bit
+    return m
+
+
+def caps_to_mask(caps, strict=False):
+    """
+    Normalize some capabilities into a mask.
+
+    Parameters
+    ----------
+    caps: CapMask, bytes, str, or iterable of bytes/str/int
+        capabilities given as a comma-separated string, a list of names or values, or an existing `CapMask`
+    strict: bool
+        if True, raise `ValueError` on unsupported capabilities instead of ignoring them
+
+    Returns
+    -------
+    CapMask
+
+    Raises
+    ------
+    TypeError
+        if `caps` is a bare int: it could be a mask or a capability value, so wrap it as `CapMask(mask)` or `[value]`
+    """
+    if caps is None:
+        return EMPTY
+    if isinstance(caps, CapMask):
+        return caps
+    if isinstance(caps, int):
+        raise TypeError("ambiguous capabilities %r: use CapMask(%r) for a mask, or [%r] for a capability" % (
+            caps, caps, caps))
+    if isinstance(caps, (basestring, bytes)):
+        cache = _string_caches[bool(strict)]
+        cached = cache.get(caps)
+        if cached is not None:
+            return cached
+        tokens = caps.split(b',' if isinstance(caps, bytes) else u',')
+        result = CapMask(_mask_of_tokens([token for token in tokens if token.strip()], strict))
+        if len(cache) >= _STRING_CACHE_SIZE:
+            cache.clear()
+        cache[caps] = result
+        return result
+    return CapMask(_mask_of_tokens(caps, strict))
+
+
+def normalize_many(lists_of_caps, strict=False):
+    """
+    Normalize many lists of capabilities at once.
+
+    Identical entries are only normalized once, so that validating thousands of configurations stays cheap.
+
+    Parameters
+    ----------
+    lists_of_caps: iterable
+        each item is anything accepted by `caps_to_mask`
+    strict: bool
+        if True, raise `ValueError` on unsupported capabilities
+
+    Returns
+    -------
+    list of CapMask
+    """
+    memo = {}
+    results = []
+    for caps in lists_of_caps:
+        try:
+            key = caps if isinstance(caps, (basestring, bytes, int)) or caps is None else tuple(caps)
+            hash(key)
+        except TypeError:
+            results.append(caps_to_mask(caps, strict))
+            continue
+        mask = memo.get(key)
+        if mask is None:
+            mask = memo[key] = caps_to_mask(key if isinstance(key, tuple) else caps, strict)
+        results.append(mask)
+    return results
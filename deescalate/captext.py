@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Compiler of the libcap text form of capability states (cap_from_text(3) and cap_to_text(3)), such as
+# `cap_net_raw,cap_net_admin=eip cap_sys_chroot+p`.
+
+import re
+import threading
+from collections import namedtuple, OrderedDict
+
+from .constants import C
+from .capmask import CapMask
+
+# flags of a capability, as libcap numbers them (1 << CAP_EFFECTIVE, CAP_PERMITTED, CAP_INHERITABLE): cap_to_text
+# orders its clauses and breaks ties with these values
+_EFFECTIVE, _PERMITTED, _INHERITABLE = 1, 2, 4
+_FLAG_BITS = {'e': _EFFECTIVE, 'i': _INHERITABLE, 'p': _PERMITTED}
+
+_OPERATIONS = re.compile(r'([=+-])([eip]*)')
+_MAX_CAP = 63
+
+#: maximum number of compiled strings kept by `compile_text`
+CACHE_SIZE = 1024
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = [0, 0]
+
+
+class CapText(namedtuple('CapText', ('effective', 'permitted', 'inheritable'))):
+    """
+    The three capability sets described by a libcap text, as masks.
+
+    Build it with `compile_text`. It is immutable and hashable, and `apply` sets the three sets of the calling
+    thread with a single `capset`.
+
+    Attributes
+    ----------
+    effective: CapMask
+    permitted: CapMask
+    inheritable: CapMask
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Same as `compile_text`.
+        """
+        return compile_text(text)
+
+    @classmethod
+    def current(cls):
+        """
+        The capabilities of the calling thread.
+        """
+        from .main import get_capabilities
+        return cls(*get_capabilities())
+
+    def to_text(self):
+        """
+        The shortest libcap text, exactly as `cap_to_text` formats it.
+        """
+        return to_text(self.effective, self.permitted, self.inheritable)
+
+    def apply(self):
+        """
+        Make the sets of the calling thread exactly these ones, with a single `capset`.
+
+        Raises
+        ------
+        RuntimeError
+            if the kernel refuses the new sets (nothing is changed then)
+        """
+        from .main import set_capabilities
+        set_capabilities(self.effective, self.permitted, self.inheritable)
+
+    def __str__(self):
+        return self.to_text()
+
+
+def _names_mask(names, clause):
+    mask = 0
+    bits = C.CAPS_BITS
+    for name in names.split(','):
+        lowered = name.lower()
+        if lowered == 'all':
+            # like libcap, `all` replaces the capabilities listed before it
+            mask = C.SUPPORTED_CAPS_MASK
+            continue
+        if lowered.isdigit() and int(lowered) <= _MAX_CAP:
+            mask |= 1 << int(lowered)
+            continue
+        bit = bits.get(lowered[4:].encode('ascii')) if lowered.startswith('cap_') else None
+        if bit is None:
+            raise ValueError("unknown capability %r in %r" % (name, clause))
+        mask |= bit
+    return mask
+
+
+def _compile(text):
+    if isinstance(text, bytes):
+        text = text.decode('ascii')
+    sets = [0, 0, 0]
+    for clause in text.split():
+        position = len(clause)
+        for op in '=+-':
+            found = clause.find(op)
+            if found != -1 and found < position:
+                position = found
+        names, rest = clause[:position], clause[position:]
+        if not rest:
+            raise ValueError("missing operator in %r" % clause)
+        operations = _OPERATIONS.findall(rest)
+        if ''.join(op + flags for op, flags in operations) != rest:
+            raise ValueError("invalid flags in %r" % clause)
+        if names:
+            mask = _names_mask(names, clause)
+        elif len(operations) == 1 and operations[0][0] == '=':
+            # `=ep` applies to every capability (and takes no other operator)
+            mask = C.SUPPORTED_CAPS_MASK
+        else:
+            raise ValueError("missing capabilities in %r" % clause)
+        for index, (op, flags) in enumerate(operations):
+            if op == '=' and index:
+                raise ValueError("'=' must be the first operator of %r" % clause)
+            if op != '=' and not flags:
+                raise ValueError("missing flags in %r" % clause)
+            flag_bits = 0
+            for flag in flags:
+                flag_bits |= _FLAG_BITS[flag]
+            if op == '=':
+                sets = [value & ~mask for value in sets]
+            for i, bit in enumerate((_EFFECTIVE, _PERMITTED, _INHERITABLE)):
+                if flag_bits & bit:
+                    sets[i] = (sets[i] & ~mask) if op == '-' else (sets[i] | mask)
+    return CapText(CapMask(sets[0]), CapMask(sets[1]), CapMask(sets[2]))
+
+
+def compile_text(text):
+    """
+    Compile a capability state in the libcap text form (see `cap_from_text(3)`).
+
+    The text is made of space separated clauses: a comma separated list of capabilities (`cap_` names, numbers,
+    `all`, or nothing before `=` for all), then operators and flags. `=` clears the listed capabilities in the
+    three sets and sets the given flags, `+` sets and `-` clears flags, and the flags are `e`, `i` and `p`. The
+    compiled texts are kept in an LRU cache of `CACHE_SIZE` entries.
+
+    Parameters
+    ----------
+    text: str or bytes
+        such as `cap_net_raw,cap_net_admin=eip cap_sys_chroot+p`
+
+    Returns
+    -------
+    CapText
+
+    Raises
+    ------
+    ValueError
+        if the text is not valid, or names an unknown capability
+
+    Examples
+    --------
+    >>> compile_text('cap_net_raw,cap_net_admin=eip cap_sys_chroot+p').apply()
+    """
+    with _cache_lock:
+        result = _cache.pop(text, None)
+        if result is not None:
+            _cache[text] = result
+            _cache_stats[0] += 1
+            return result
+    result = _compile(text)
+    with _cache_lock:
+        _cache_stats[1] += 1
+        _cache[text] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def cache_info():
+    """
+    Returns
+    -------
+    dict
+        hits, misses and current size of the cache of `compile_text`
+    """
+    return {'hits': _cache_stats[0], 'misses': _cache_stats[1], 'size': len(_cache)}
+
+
+def clear_cache():
+    """
+    Empty the cache of `compile_text`.
+    """
+    with _cache_lock:
+        _cache.clear()
+        _cache_stats[0] = _cache_stats[1] = 0
+
+
+def _flags(bits):
+    return ''.join(flag for flag, bit in (('e', _EFFECTIVE), ('i', _INHERITABLE), ('p', _PERMITTED)) if bits & bit)
+
+
+def _names(mask):
+    names = C.INVERSE_SUPPORTED_CAPS
+    result = []
+    while mask:
+        low = mask & -mask
+        i = low.bit_length() - 1
+        name = names.get(i)
+        result.append('cap_' + name.decode('ascii') if name else str(i))
+        mask ^= low
+    return result
+
+
+def to_text(effective=0, permitted=0, inheritable=0):
+    """
+    Format capability sets in the libcap text form, like `cap_to_text` does.
+
+    The most common combination of flags among the capabilities of the kernel becomes the `=` base, and the other
+    capabilities are grouped by combination, with the flags to add (`+`) and to remove (`-`).
+
+    Returns
+    -------
+    str
+        such as `cap_net_admin,cap_net_raw=eip cap_sys_chroot+p`, or `=` for no capability
+    """
+    effective, permitted, inheritable = int(effective), int(permitted), int(inheritable)
+    every = (1 << (_MAX_CAP + 1)) - 1
+    supported = C.SUPPORTED_CAPS_MASK
+    # the capabilities that have each combination of flags, as masks
+    combinations = []
+    for bits in range(8):
+        mask = every
+        for flag, value in ((_EFFECTIVE, effective), (_PERMITTED, permitted), (_INHERITABLE, inheritable)):
+            mask &= value if bits & flag else ~value
+        combinations.append(mask)
+    counts = [bin(mask & supported).count('1') for mask in combinations]
+    # the most common combination (the lowest one on a tie)
+    base = 7
+    for bits in range(6, -1, -1):
+        if counts[bits] >= counts[base]:
+            base = bits
+    clauses = ['=' + _flags(base)]
+    for bits in range(7, -1, -1):
+        if bits == base or not counts[bits]:
+            continue
+        clause = ','.join(_names(combinations[bits] & supported))
+        added, removed = bits & ~base, ~bits & base
+        if added:
+            if clauses == ['=']:
+                # `= cap_a+e` is written `cap_a=e`
+                clauses = []
+                clause += '=' + _flags(added)
+            else:
+                clause += '+' + _flags(added)
+        if removed:
+            clause += '-' + _flags(removed)
+        clauses.append(clause)
+    # the capabilities the kernel does not know are not part of the base
+    for bits in range(7, 0, -1):
+        unknown = combinations[bits] & ~supported
+        if unknown:
+            clauses.append(','.join(_names(unknown)) + '+' + _flags(bits))
+    return ' '.join(clauses)
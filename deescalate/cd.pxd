@@ -4,63 +4,153 @@ IF UNAME_SYSNAME == "Linux":
     cdef extern from "sys/types.h" nogil:
         ctypedef unsigned int pid_t
 
+    cdef extern from "errno.h" nogil:
+        int errno
+
+    cdef extern from "unistd.h" nogil:
+        long syscall(long number, ...)
+
+    cdef extern from "sys/syscall.h" nogil:
+        long SYS_capget, SYS_capset
+
+    cdef extern from *:
+        """
+        #include <sys/syscall.h>
+        /* per-thread setresuid/setresgid/setgroups: the libc wrappers broadcast the change to every thread */
+        #ifdef SYS_setresuid32
+        #define DEESCALATE_SYS_SETRESUID SYS_setresuid32
+        #define DEESCALATE_SYS_SETRESGID SYS_setresgid32
+        #define DEESCALATE_SYS_SETGROUPS SYS_setgroups32
+        #else
+        #define DEESCALATE_SYS_SETRESUID SYS_setresuid
+        #define DEESCALATE_SYS_SETRESGID SYS_setresgid
+        #define DEESCALATE_SYS_SETGROUPS SYS_setgroups
+        #endif
+        """
+        long DEESCALATE_SYS_SETRESUID, DEESCALATE_SYS_SETRESGID, DEESCALATE_SYS_SETGROUPS
+
     cdef extern from "sys/prctl.h" nogil:
         int prctl(int option, unsigned long arg2, unsigned long arg3, unsigned long arg4, unsigned long arg5)
         int PR_GET_SECUREBITS, PR_SET_SECUREBITS, PR_SET_NO_NEW_PRIVS, PR_GET_NO_NEW_PRIVS
+        int PR_CAPBSET_READ, PR_CAPBSET_DROP
+        int PR_CAP_AMBIENT, PR_CAP_AMBIENT_IS_SET, PR_CAP_AMBIENT_RAISE, PR_CAP_AMBIENT_LOWER, PR_CAP_AMBIENT_CLEAR_ALL
 
-    cdef extern from "sys/capability.h" nogil:
-        ctypedef enum cap_flag_t:
-            CAP_EFFECTIVE,
-            CAP_PERMITTED,
-            CAP_INHERITABLE
-        ctypedef enum cap_flag_value_t:
-            CAP_CLEAR,
-            CAP_SET
-        ctypedef int cap_value_t
-        ctypedef struct cap_t:
-            pass
-
+    cdef extern from "linux/capability.h" nogil:
+        ctypedef unsigned int __u32
+        cdef struct __user_cap_header_struct:
+            __u32 version
+            int pid
+        cdef struct __user_cap_data_struct:
+            __u32 effective
+            __u32 permitted
+            __u32 inheritable
+        int _LINUX_CAPABILITY_VERSION_3
+        int _LINUX_CAPABILITY_U32S_3
         int CAP_LAST_CAP
-        int cap_valid(int)
-        int CAP_TO_INDEX(int)
-        int CAP_TO_MASK(int)
-
-        int     cap_free(void *)
-        cap_t   cap_init()
-        int     cap_get_flag(cap_t, cap_value_t, cap_flag_t, cap_flag_value_t *)
-        int     cap_set_flag(cap_t, cap_flag_t, int, const cap_value_t *, cap_flag_value_t)
-        int     cap_clear(cap_t)
-        int     cap_clear_flag(cap_t, cap_flag_t)
-        cap_t   cap_get_fd(int)
-        cap_t   cap_get_file(const char *)
-        int     cap_set_fd(int, cap_t)
-        int     cap_set_file(const char *, cap_t)
-        cap_t   cap_get_proc()
-        cap_t   cap_get_pid(pid_t)
-        int     cap_set_proc(cap_t)
-        int     cap_get_bound(cap_value_t)
-        int     cap_drop_bound(cap_value_t)
-        int     CAP_IS_SUPPORTED(cap_value_t cap)
-        cap_t   cap_from_text(const char *)
-        char *  cap_to_text(cap_t, ssize_t *)
-        int     cap_from_name(const char *, cap_value_t *)
-        char *  cap_to_name(cap_value_t)
-        int     cap_compare(cap_t, cap_t)
+
+    # raw capget/capset on the calling thread: the three sets are read or written at once
+    cdef int _capget(unsigned long long* effective, unsigned long long* permitted,
+                     unsigned long long* inheritable) noexcept nogil
+    cdef int _capset(unsigned long long effective, unsigned long long permitted,
+                     unsigned long long inheritable) noexcept nogil
+
+    # a compiled lockdown plan: every field is applied by _apply_plan without the GIL
+    ctypedef struct lockdown_plan_t:
+        bint raise_effective
+        unsigned long long raise_masks[3]
+        bint set_securebits
+        unsigned long securebits
+        bint set_groups
+        size_t ngroups
+        unsigned int* groups
+        bint set_gid
+        unsigned int gid
+        bint set_uid
+        unsigned int uid
+        unsigned long long drop_bounding
+        bint set_caps
+        unsigned long long masks[3]
+        unsigned long long raise_ambient
+        bint set_no_new_privs
+        bint set_landlock
+        int landlock_fd
+        bint set_seccomp
+        unsigned short filter_len
+        void* filter
+
+    # apply a plan to the calling thread: returns 0, or the number of the failed step (errno is set)
+    cdef int _apply_plan(const lockdown_plan_t* plan) noexcept nogil
+    # same, and store the duration of each step in times[step] while the instrumentation is on (times may be NULL)
+    cdef int _apply_plan_timed(const lockdown_plan_t* plan, unsigned long long* times) noexcept nogil
 
     cdef class C_CapabilitySet(object):
-        cdef cap_flag_t flag
+        cdef readonly int flag
+        cdef public bint cached
+        cdef public unsigned long long cache_hits, cache_misses
         cpdef _modify(self, caps_to_modify, flag_value)
+        cpdef _modify_mask(self, unsigned long long mask, flag_value)
+        cpdef _get_mask(self)
 
     cdef class C_BoundingSet(object):
+        cdef public bint cached
+        cdef public unsigned long long cache_hits, cache_misses
         cpdef _remove_one_cap(self, int cap)
+        cpdef _remove_mask(self, unsigned long long mask)
+        cpdef _get_mask(self)
+
+    cdef class C_AmbientSet(object):
+        cdef public bint cached
+        cdef public unsigned long long cache_hits, cache_misses
+        cpdef _get_mask(self)
+        cpdef _raise_mask(self, unsigned long long mask)
+        cpdef _lower_mask(self, unsigned long long mask)
+        cdef _change_mask(self, unsigned long long mask, int operation)
+        cpdef clear_all(self)
+
+    cdef class NativePlan(object):
+        cdef lockdown_plan_t plan
+        cdef readonly object caps
+        cdef readonly object landlock
+
+    cdef class RaisedCaps(object):
+        cdef unsigned long long mask
+        cdef object owner
+        cdef dict stacks
+        cdef tuple _state(self)
 
 ELSE:
     cdef class C_CapabilitySet(object):
-        cdef int flag
+        cdef readonly int flag
+        cdef public bint cached
+        cdef public unsigned long long cache_hits, cache_misses
         cpdef _modify(self, caps_to_modify, flag_value)
+        cpdef _modify_mask(self, unsigned long long mask, flag_value)
+        cpdef _get_mask(self)
 
     cdef class C_BoundingSet(object):
+        cdef public bint cached
+        cdef public unsigned long long cache_hits, cache_misses
         cpdef _remove_one_cap(self, int cap)
+        cpdef _remove_mask(self, unsigned long long mask)
+        cpdef _get_mask(self)
+
+    cdef class C_AmbientSet(object):
+        cdef public bint cached
+        cdef public unsigned long long cache_hits, cache_misses
+        cpdef _get_mask(self)
+        cpdef _raise_mask(self, unsigned long long mask)
+        cpdef _lower_mask(self, unsigned long long mask)
+        cpdef clear_all(self)
+
+    cdef class NativePlan(object):
+        cdef object operations
+        cdef readonly object caps
+
+    cdef class RaisedCaps(object):
+        cdef unsigned long long mask
 
 
 cpdef py_prctl(option, arg2, arg3, arg4, arg5)
+cpdef invalidate_thread_cache()
+cpdef py_capget()
+cpdef py_capset(effective, permitted, inheritable)
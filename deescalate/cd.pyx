@@ -1,161 +1,1631 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import threading
+from collections import namedtuple
+
+from libc.string cimport memset, memcpy
 from libc.stdlib cimport malloc, free
 from .constants import C
 from .utils import capset_string_to_flag
+from .capmask import CapMask, caps_to_mask
 
 IF UNAME_SYSNAME == "Linux":
 
-    cdef update_constants():
+    # Capability names, from the static table generated from linux/capability.h when the extension is compiled. libcap
+    # is only used to name the capabilities the kernel headers did not know about. When the extension is built with
+    # DEESCALATE_WITHOUT_LIBCAP, it does not link with libcap at all and the remaining names come from
+    # C.HARD_CODED_CAPS.
+    cdef extern from *:
+        """
+        #include <linux/capability.h>
+        static const char *const deescalate_static_cap_names[CAP_LAST_CAP + 1] = {
+            [CAP_CHOWN] = "chown", [CAP_DAC_OVERRIDE] = "dac_override", [CAP_DAC_READ_SEARCH] = "dac_read_search",
+            [CAP_FOWNER] = "fowner", [CAP_FSETID] = "fsetid", [CAP_KILL] = "kill", [CAP_SETGID] = "setgid",
+            [CAP_SETUID] = "setuid", [CAP_SETPCAP] = "setpcap", [CAP_LINUX_IMMUTABLE] = "linux_immutable",
+            [CAP_NET_BIND_SERVICE] = "net_bind_service", [CAP_NET_BROADCAST] = "net_broadcast",
+            [CAP_NET_ADMIN] = "net_admin", [CAP_NET_RAW] = "net_raw", [CAP_IPC_LOCK] = "ipc_lock",
+            [CAP_IPC_OWNER] = "ipc_owner", [CAP_SYS_MODULE] = "sys_module", [CAP_SYS_RAWIO] = "sys_rawio",
+            [CAP_SYS_CHROOT] = "sys_chroot", [CAP_SYS_PTRACE] = "sys_ptrace", [CAP_SYS_PACCT] = "sys_pacct",
+            [CAP_SYS_ADMIN] = "sys_admin", [CAP_SYS_BOOT] = "sys_boot", [CAP_SYS_NICE] = "sys_nice",
+            [CAP_SYS_RESOURCE] = "sys_resource", [CAP_SYS_TIME] = "sys_time", [CAP_SYS_TTY_CONFIG] = "sys_tty_config",
+            [CAP_MKNOD] = "mknod", [CAP_LEASE] = "lease", [CAP_AUDIT_WRITE] = "audit_write",
+            [CAP_AUDIT_CONTROL] = "audit_control", [CAP_SETFCAP] = "setfcap", [CAP_MAC_OVERRIDE] = "mac_override",
+            [CAP_MAC_ADMIN] = "mac_admin", [CAP_SYSLOG] = "syslog", [CAP_WAKE_ALARM] = "wake_alarm",
+        #ifdef CAP_BLOCK_SUSPEND
+            [CAP_BLOCK_SUSPEND] = "block_suspend",
+        #endif
+        #ifdef CAP_AUDIT_READ
+            [CAP_AUDIT_READ] = "audit_read",
+        #endif
+        #ifdef CAP_PERFMON
+            [CAP_PERFMON] = "perfmon",
+        #endif
+        #ifdef CAP_BPF
+            [CAP_BPF] = "bpf",
+        #endif
+        #ifdef CAP_CHECKPOINT_RESTORE
+            [CAP_CHECKPOINT_RESTORE] = "checkpoint_restore",
+        #endif
+        };
 
-        C.FLAGS.update({
-            b'effective': CAP_EFFECTIVE,
-            b'permitted': CAP_PERMITTED,
-            b'inheritable': CAP_INHERITABLE
-        })
+        #ifdef DEESCALATE_WITHOUT_LIBCAP
+        static int deescalate_cap_to_name(int cap, char *buf, int size) { return -1; }
+        #else
+        #include <string.h>
+        extern char *cap_to_name(int cap);
+        extern int cap_free(void *obj);
+        static int deescalate_cap_to_name(int cap, char *buf, int size) {
+            char *name = cap_to_name(cap);
+            int len;
+            if (name == NULL) return -1;
+            len = (int) strlen(name);
+            if (len >= size) len = size - 1;
+            memcpy(buf, name, len);
+            buf[len] = 0;
+            cap_free(name);
+            return len;
+        }
+        #endif
+        """
+        const char* deescalate_static_cap_names[]
+        int deescalate_cap_to_name(int cap, char *buf, int size)
 
-        C.FLAG_VALUES.update({
-            b'clear': CAP_CLEAR,
-            b'set': CAP_SET
-        })
+    cdef extern from "fcntl.h" nogil:
+        int open(const char *pathname, int flags)
+        int O_RDONLY
+
+    cdef extern from "unistd.h" nogil:
+        ssize_t read(int fd, void *buf, size_t count)
+        int close(int fd)
+
+    #: CAP_LAST_CAP of the kernel headers the extension was compiled with
+    COMPILED_CAP_LAST_CAP = CAP_LAST_CAP
+
+    cdef _cap_name(int i):
+        cdef char buf[64]
+        cdef int length
+        if i <= CAP_LAST_CAP and deescalate_static_cap_names[i] != NULL:
+            return <bytes> deescalate_static_cap_names[i]
+        length = deescalate_cap_to_name(i, buf, sizeof(buf))
+        if length < 0:
+            return C.HARD_CODED_CAPS[i] if i < C.NB_HARD_CODED else None
+        cap_name = (<bytes> buf[:length]).lower()
+        if not cap_name or cap_name.isdigit():
+            return None
+        return cap_name[4:] if cap_name.startswith(b'cap_') else cap_name
 
+    cdef int _kernel_cap_last_cap() noexcept nogil:
+        # one read of /proc/sys/kernel/cap_last_cap instead of a prctl per capability
+        cdef char buf[16]
+        cdef ssize_t length
+        cdef int fd = open("/proc/sys/kernel/cap_last_cap", O_RDONLY)
+        cdef int value = 0
+        cdef ssize_t digits = 0
+        if fd == -1:
+            return -1
+        length = read(fd, buf, sizeof(buf))
+        close(fd)
+        while digits < length and 48 <= buf[digits] <= 57:
+            value = value * 10 + (buf[digits] - 48)
+            digits += 1
+        return value if digits > 0 else -1
+
+    def probe_capabilities():
+        """
+        Find the capabilities supported by the running kernel.
+
+        Returns
+        -------
+        list of (int, bytes or None)
+            value and name of each supported capability (None when the capability can not be named)
+        """
+        cdef int last = _kernel_cap_last_cap()
+        if last < 0:
+            # without /proc: same as libcap CAP_IS_SUPPORTED, the supported capabilities are contiguous
+            last = -1
+            while last < 63 and prctl(PR_CAPBSET_READ, <unsigned long> (last + 1), 0, 0, 0) >= 0:
+                last += 1
+        return [(i, _cap_name(i)) for i in range(last + 1)]
+
+    cdef update_constants():
+        # no syscall here: the capability table itself is computed on first use (see constants.load_table)
         C.PRCTL.update({
             b'get_securebits': PR_GET_SECUREBITS,
             b'set_securebits': PR_SET_SECUREBITS,
             b'set_no_new_privs': PR_SET_NO_NEW_PRIVS,
-            b'get_no_new_privs': PR_GET_NO_NEW_PRIVS
+            b'get_no_new_privs': PR_GET_NO_NEW_PRIVS,
+            b'capbset_read': PR_CAPBSET_READ,
+            b'capbset_drop': PR_CAPBSET_DROP,
+            b'cap_ambient': PR_CAP_AMBIENT,
+            b'cap_ambient_is_set': PR_CAP_AMBIENT_IS_SET,
+            b'cap_ambient_raise': PR_CAP_AMBIENT_RAISE,
+            b'cap_ambient_lower': PR_CAP_AMBIENT_LOWER,
+            b'cap_ambient_clear_all': PR_CAP_AMBIENT_CLEAR_ALL
         })
 
-        C.SUPPORTED_CAPS.clear()
-        C.UNSUPPORTED_CAPS[:] = []
-        cdef char* temp
-        for i in range(CAP_LAST_CAP + 1):
-            if CAP_IS_SUPPORTED(<cap_value_t> i) == 1:
-                temp = cap_to_name(<cap_value_t> i)
-                if temp != NULL:
-                    cap_name = (<bytes>temp).lower()
-                    cap_free(<void*> temp)
-                    if cap_name and not cap_name.isdigit():
-                        cap_name = cap_name[4:]
-                        C.SUPPORTED_CAPS[cap_name] = i
-                        C.INVERSE_SUPPORTED_CAPS[i] = cap_name
-                    else:
-                        if i <= (C.NB_HARD_CODED - 1):
-                            C.UNSUPPORTED_CAPS.append(C.HARD_CODED_CAPS[i])
-                        else:
-                            C.UNSUPPORTED_CAPS.append(str(i))
-
-        C.SUPPORTED_CAPS_NAMES = set(C.SUPPORTED_CAPS.keys())
-        C.SUPPORTED_CAPS_VALUES = set(C.SUPPORTED_CAPS.values())
-
     update_constants()
 
 
+    # Instrumentation: counters of the system calls made by the extension, and durations of the lockdown steps.
+    # Everything is updated with relaxed atomics (the plans also run in signal handlers), and only while
+    # deescalate_counting is set: when the instrumentation is off, each call site costs a single predicted branch.
+    cdef extern from *:
+        """
+        #include <time.h>
+        #include <string.h>
+        #include <sys/prctl.h>
+        enum {
+            DEESCALATE_CAPGET, DEESCALATE_CAPSET, DEESCALATE_CAPBSET_READ, DEESCALATE_CAPBSET_DROP,
+            DEESCALATE_AMBIENT, DEESCALATE_SECUREBITS, DEESCALATE_NO_NEW_PRIVS, DEESCALATE_PRCTL_OTHER,
+            DEESCALATE_SETGROUPS, DEESCALATE_SETGID, DEESCALATE_SETUID, DEESCALATE_LANDLOCK, DEESCALATE_SECCOMP,
+            DEESCALATE_NB_COUNTERS
+        };
+        #define DEESCALATE_NB_STEPS 16
+        static volatile int deescalate_counting = 0;
+        static unsigned long long deescalate_counters[DEESCALATE_NB_COUNTERS];
+        static unsigned long long deescalate_step_count[DEESCALATE_NB_STEPS];
+        static unsigned long long deescalate_step_ns[DEESCALATE_NB_STEPS];
+        static unsigned long long deescalate_step_max_ns[DEESCALATE_NB_STEPS];
+
+        static inline void deescalate_count(int counter) {
+            if (__builtin_expect(deescalate_counting, 0))
+                __atomic_fetch_add(&deescalate_counters[counter], 1, __ATOMIC_RELAXED);
+        }
+
+        static inline int deescalate_prctl(int option, unsigned long arg2, unsigned long arg3, unsigned long arg4,
+                                           unsigned long arg5) {
+            if (__builtin_expect(deescalate_counting, 0)) {
+                int counter;
+                switch (option) {
+                case PR_CAPBSET_READ: counter = DEESCALATE_CAPBSET_READ; break;
+                case PR_CAPBSET_DROP: counter = DEESCALATE_CAPBSET_DROP; break;
+                case PR_GET_SECUREBITS: case PR_SET_SECUREBITS: counter = DEESCALATE_SECUREBITS; break;
+                case PR_GET_NO_NEW_PRIVS: case PR_SET_NO_NEW_PRIVS: counter = DEESCALATE_NO_NEW_PRIVS; break;
+        #ifdef PR_CAP_AMBIENT
+                case PR_CAP_AMBIENT: counter = DEESCALATE_AMBIENT; break;
+        #endif
+                default: counter = DEESCALATE_PRCTL_OTHER;
+                }
+                __atomic_fetch_add(&deescalate_counters[counter], 1, __ATOMIC_RELAXED);
+            }
+            return prctl(option, arg2, arg3, arg4, arg5);
+        }
+
+        static inline unsigned long long deescalate_now_ns(void) {
+            struct timespec ts;
+            clock_gettime(CLOCK_MONOTONIC, &ts);
+            return (unsigned long long) ts.tv_sec * 1000000000ULL + (unsigned long long) ts.tv_nsec;
+        }
+
+        /* returns 0 when the instrumentation is off: the step is then not recorded */
+        static inline unsigned long long deescalate_step_begin(void) {
+            if (__builtin_expect(!deescalate_counting, 1)) return 0;
+            return deescalate_now_ns();
+        }
+
+        static inline void deescalate_record_step(int step, unsigned long long elapsed) {
+            unsigned long long max;
+            if (step <= 0 || step >= DEESCALATE_NB_STEPS) return;
+            __atomic_fetch_add(&deescalate_step_count[step], 1, __ATOMIC_RELAXED);
+            __atomic_fetch_add(&deescalate_step_ns[step], elapsed, __ATOMIC_RELAXED);
+            max = __atomic_load_n(&deescalate_step_max_ns[step], __ATOMIC_RELAXED);
+            while (elapsed > max && !__atomic_compare_exchange_n(&deescalate_step_max_ns[step], &max, elapsed, 1,
+                                                                 __ATOMIC_RELAXED, __ATOMIC_RELAXED)) {
+            }
+        }
+
+        /* records the step, and its duration in times[step] when times is not NULL */
+        static inline void deescalate_step_end(int step, unsigned long long start, unsigned long long *times) {
+            unsigned long long elapsed;
+            if (start == 0) return;
+            elapsed = deescalate_now_ns() - start;
+            deescalate_record_step(step, elapsed);
+            if (times != NULL) times[step] = elapsed;
+        }
+
+        static void deescalate_reset_counters(void) {
+            memset(deescalate_counters, 0, sizeof(deescalate_counters));
+            memset(deescalate_step_count, 0, sizeof(deescalate_step_count));
+            memset(deescalate_step_ns, 0, sizeof(deescalate_step_ns));
+            memset(deescalate_step_max_ns, 0, sizeof(deescalate_step_max_ns));
+        }
+        """
+        int DEESCALATE_CAPGET, DEESCALATE_CAPSET, DEESCALATE_SETGROUPS, DEESCALATE_SETGID, DEESCALATE_SETUID
+        int DEESCALATE_LANDLOCK, DEESCALATE_SECCOMP, DEESCALATE_NB_COUNTERS, DEESCALATE_NB_STEPS
+        int deescalate_counting
+        unsigned long long deescalate_counters[]
+        unsigned long long deescalate_step_count[]
+        unsigned long long deescalate_step_ns[]
+        unsigned long long deescalate_step_max_ns[]
+        void deescalate_count(int counter) nogil
+        int deescalate_prctl(int option, unsigned long arg2, unsigned long arg3, unsigned long arg4,
+                             unsigned long arg5) nogil
+        unsigned long long deescalate_step_begin() nogil
+        void deescalate_record_step(int step, unsigned long long elapsed) nogil
+        void deescalate_step_end(int step, unsigned long long start, unsigned long long *times) nogil
+        void deescalate_reset_counters() nogil
+
+    #: names of the counters of `read_counters`, in the order of the C enum
+    COUNTERS = ('capget', 'capset', 'capbset_read', 'capbset_drop', 'ambient', 'securebits', 'no_new_privs',
+                'prctl_other', 'setgroups', 'setgid', 'setuid', 'landlock', 'seccomp')
+
+    #: callables called with (step, seconds) after a lockdown plan is applied, while the instrumentation is on
+    stats_hooks = []
+
+    def enable_counters(bint enabled):
+        """
+        Turn the system call counters and the step timings on or off.
+        """
+        global deescalate_counting
+        deescalate_counting = enabled
+
+    def counters_enabled():
+        return bool(deescalate_counting)
+
+    def read_counters():
+        """
+        Returns
+        -------
+        dict
+            number of system calls made by the extension since the last reset, by counter (see `COUNTERS`)
+        """
+        return dict((name, deescalate_counters[i]) for i, name in enumerate(COUNTERS))
+
+    def read_step_times():
+        """
+        Returns
+        -------
+        dict
+            for each lockdown step that ran: (count, total nanoseconds, maximum nanoseconds)
+        """
+        return dict(
+            (PLAN_STEPS[i], (deescalate_step_count[i], deescalate_step_ns[i], deescalate_step_max_ns[i]))
+            for i in range(1, len(PLAN_STEPS)) if deescalate_step_count[i]
+        )
+
+    def reset_counters():
+        deescalate_reset_counters()
+
+    def count_syscall(name):
+        """
+        Count a system call made outside of the extension (`os.setuid` in a Python plan, for example).
+        """
+        deescalate_count(COUNTERS.index(name))
+
+    def record_step(name, unsigned long long elapsed_ns):
+        """
+        Record the duration of a lockdown step applied outside of the extension.
+        """
+        if deescalate_counting:
+            deescalate_record_step(PLAN_STEPS.index(name), elapsed_ns)
+
+    cdef _call_stats_hooks(unsigned long long* times):
+        cdef int i
+        for i in range(1, len(PLAN_STEPS)):
+            if times[i]:
+                for hook in stats_hooks:
+                    hook(PLAN_STEPS[i], times[i] / 1e9)
+
+    cdef int _capget(unsigned long long* effective, unsigned long long* permitted,
+                     unsigned long long* inheritable) noexcept nogil:
+        cdef __user_cap_header_struct header
+        cdef __user_cap_data_struct data[2]
+        header.version = _LINUX_CAPABILITY_VERSION_3
+        header.pid = 0
+        deescalate_count(DEESCALATE_CAPGET)
+        if syscall(SYS_capget, &header, data) == -1:
+            return -1
+        effective[0] = data[0].effective | ((<unsigned long long> data[1].effective) << 32)
+        permitted[0] = data[0].permitted | ((<unsigned long long> data[1].permitted) << 32)
+        inheritable[0] = data[0].inheritable | ((<unsigned long long> data[1].inheritable) << 32)
+        return 0
+
+    cdef int _capset(unsigned long long effective, unsigned long long permitted,
+                     unsigned long long inheritable) noexcept nogil:
+        cdef __user_cap_header_struct header
+        cdef __user_cap_data_struct data[2]
+        header.version = _LINUX_CAPABILITY_VERSION_3
+        header.pid = 0
+        data[0].effective = <__u32> effective
+        data[1].effective = <__u32> (effective >> 32)
+        data[0].permitted = <__u32> permitted
+        data[1].permitted = <__u32> (permitted >> 32)
+        data[0].inheritable = <__u32> inheritable
+        data[1].inheritable = <__u32> (inheritable >> 32)
+        deescalate_count(DEESCALATE_CAPSET)
+        return <int> syscall(SYS_capset, &header, data)
+
+    # last capabilities read or written by each thread, used by the sets in cached mode
+    _thread_state = threading.local()
+    # bumped when the capabilities of every thread are changed at once (see NativePlan.apply_all_threads)
+    cdef unsigned long _cache_generation = 0
+
+    cdef object _cached(name):
+        if getattr(_thread_state, 'generation', _cache_generation) != _cache_generation:
+            _thread_state.__dict__.clear()
+            return None
+        return getattr(_thread_state, name, None)
+
+    cdef _cache(name, value):
+        _thread_state.generation = _cache_generation
+        setattr(_thread_state, name, value)
+
+    cdef tuple _read_proc_masks():
+        cdef unsigned long long effective, permitted, inheritable
+        if _capget(&effective, &permitted, &inheritable) == -1:
+            raise RuntimeError("impossible to get the current capabilities")
+        return (effective, permitted, inheritable)
+
+    cdef _write_proc_masks(unsigned long long effective, unsigned long long permitted,
+                           unsigned long long inheritable):
+        if _capset(effective, permitted, inheritable) == -1:
+            raise RuntimeError("error executing capset")
+        if _cached('caps') is not None:
+            # write-through: the thread now has exactly these capabilities
+            _cache('caps', (effective, permitted, inheritable))
+        ambient = _cached('ambient')
+        if ambient is not None:
+            # the kernel lowers the ambient capabilities that are not both permitted and inheritable anymore
+            _cache('ambient', ambient & permitted & inheritable)
+
+    cdef unsigned long long _read_bounding_mask():
+        cdef unsigned long long supported = C.SUPPORTED_CAPS_MASK
+        cdef unsigned long long mask = 0
+        cdef int i
+        for i in range(64):
+            if (supported >> i) & 1 and deescalate_prctl(PR_CAPBSET_READ, <unsigned long> i, 0, 0, 0) == 1:
+                mask |= (<unsigned long long> 1) << i
+        return mask
+
+    cdef unsigned long long _read_ambient_mask():
+        cdef unsigned long long supported = C.SUPPORTED_CAPS_MASK
+        cdef unsigned long long mask = 0
+        cdef int i
+        cdef int res
+        for i in range(64):
+            if (supported >> i) & 1:
+                res = deescalate_prctl(PR_CAP_AMBIENT, PR_CAP_AMBIENT_IS_SET, <unsigned long> i, 0, 0)
+                if res == -1:
+                    # kernel without ambient capabilities
+                    return 0
+                if res == 1:
+                    mask |= (<unsigned long long> 1) << i
+        return mask
+
+    cpdef invalidate_thread_cache():
+        """
+        Forget the capabilities cached for the calling thread.
+        """
+        _thread_state.__dict__.clear()
+
+    cpdef py_capget():
+        """
+        Read the effective, permitted and inheritable sets of the calling thread with a single capget.
+
+        Returns
+        -------
+        3-uple of CapMask (effective, permitted, inheritable)
+        """
+        cdef tuple state = _read_proc_masks()
+        if _cached('caps') is not None:
+            _cache('caps', state)
+        return CapMask(state[0]), CapMask(state[1]), CapMask(state[2])
+
+    cpdef py_capset(effective, permitted, inheritable):
+        """
+        Write the effective, permitted and inheritable sets of the calling thread with a single capset.
+        """
+        _write_proc_masks(effective, permitted, inheritable)
+
+
     cdef class C_CapabilitySet(object):
         def __init__(self, capset):
-            capset = capset_string_to_flag(capset)
-            self.flag = <cap_flag_t> capset
+            self.flag = capset_string_to_flag(capset)
+            self.cached = False
+            self.cache_hits = 0
+            self.cache_misses = 0
 
-        def __iter__(self):
-            cdef cap_flag_value_t flag_value
-            cdef int res
-            cdef cap_t current = cap_get_proc()
-            if <void*>current != NULL:
-                try:
-                    for i in C.SUPPORTED_CAPS_VALUES:
-                        res = cap_get_flag(current, <cap_value_t>i, self.flag, &flag_value)
-                        if res == -1:
-                            raise RuntimeError("error happened calling cap_get_flag")
-                        if flag_value == CAP_SET:
-                            yield i
-                finally:
-                    cap_free(<void*> current)
+        cpdef _get_mask(self):
+            cdef tuple state
+            if self.cached:
+                state = _cached('caps')
+                if state is None:
+                    self.cache_misses += 1
+                    state = _read_proc_masks()
+                    _cache('caps', state)
+                else:
+                    self.cache_hits += 1
             else:
-                raise RuntimeError("impossible to get the current capabilities")
+                state = _read_proc_masks()
+            return CapMask(state[<int> self.flag])
+
+        def refresh(self):
+            """
+            Read again the capabilities of the calling thread, and update the cache.
+            """
+            cdef tuple state = _read_proc_masks()
+            _cache('caps', state)
+            return CapMask(state[<int> self.flag])
+
+        def __iter__(self):
+            return iter(self._get_mask())
 
         def __contains__(self, item):
-            cdef cap_value_t cap = <cap_value_t> item if isinstance(item, int) else <cap_value_t> C.SUPPORTED_CAPS[bytes(item)]
-            cdef cap_t current = cap_get_proc()
-            cdef int res
-            cdef cap_flag_value_t flag_value
-            if <void*>current != NULL:
-                try:
-                    res = cap_get_flag(current, cap, self.flag, &flag_value)
-                    if res == -1:
-                        raise RuntimeError("error happened calling cap_get_flag")
-                    return flag_value == CAP_SET
-                finally:
-                    cap_free(<void*> current)
-            else:
-                raise RuntimeError("impossible to get the current capabilities")
+            cdef int cap = item if isinstance(item, int) else C.SUPPORTED_CAPS[bytes(item)]
+            return bool((<unsigned long long> self._get_mask() >> cap) & 1)
 
         cpdef _modify(self, caps_to_modify, flag_value):
-            if len(caps_to_modify) == 0:
+            return self._modify_mask(caps_to_mask(caps_to_modify), flag_value)
+
+        cpdef _modify_mask(self, unsigned long long mask, flag_value):
+            cdef unsigned long long masks[3]
+            if mask == 0:
                 return 0
-            cdef cap_value_t* norm_caps_to_modify = <cap_value_t*> malloc(len(caps_to_modify) * sizeof(cap_value_t))
-            cdef cap_t current
-            try:
-                current = cap_get_proc()
-                try:
-                    for idx, i in enumerate(caps_to_modify):
-                        norm_caps_to_modify[idx] = <cap_value_t> i
-                    res = cap_set_flag(current, self.flag, len(caps_to_modify), norm_caps_to_modify, <cap_flag_value_t> flag_value)
-                    if res == -1:
-                        raise RuntimeError("error executing cap_set_flag")
-                    res = cap_set_proc(current)
-                    if res == -1:
-                        raise RuntimeError("error executing cap_set_proc")
-                finally:
-                    if <void*> current:
-                        cap_free(<void*> current)
-            finally:
-                free(<void*> norm_caps_to_modify)
+            state = _cached('caps') if self.cached else None
+            if state is None:
+                state = _read_proc_masks()
+            masks[0], masks[1], masks[2] = state
+            if flag_value == C.FLAG_VALUES[b'set']:
+                masks[self.flag] |= mask
+            else:
+                masks[self.flag] &= ~mask
+            _write_proc_masks(masks[0], masks[1], masks[2])
+            return bin(mask).count('1')
+
+    cdef class C_AmbientSet(object):
+        def __init__(self):
+            self.cached = True
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+        cpdef _get_mask(self):
+            if self.cached:
+                ambient = _cached('ambient')
+                if ambient is None:
+                    self.cache_misses += 1
+                    ambient = _read_ambient_mask()
+                    _cache('ambient', ambient)
+                else:
+                    self.cache_hits += 1
+                return CapMask(ambient)
+            return CapMask(_read_ambient_mask())
+
+        def refresh(self):
+            """
+            Read again the ambient set of the calling thread, and update the cache.
+            """
+            ambient = _read_ambient_mask()
+            _cache('ambient', ambient)
+            return CapMask(ambient)
+
+        def __iter__(self):
+            return iter(self._get_mask())
+
+        def __contains__(self, item):
+            cdef int cap = item if isinstance(item, int) else C.SUPPORTED_CAPS[bytes(item)]
+            return bool((<unsigned long long> self._get_mask() >> cap) & 1)
+
+        cpdef _raise_mask(self, unsigned long long mask):
+            self._change_mask(mask, PR_CAP_AMBIENT_RAISE)
+
+        cpdef _lower_mask(self, unsigned long long mask):
+            self._change_mask(mask, PR_CAP_AMBIENT_LOWER)
+
+        cdef _change_mask(self, unsigned long long mask, int operation):
+            cdef unsigned long long done = 0
+            cdef int i
+            cdef int failed = -1
+            with nogil:
+                for i in range(64):
+                    if (mask >> i) & 1:
+                        if deescalate_prctl(PR_CAP_AMBIENT, operation, <unsigned long> i, 0, 0) == -1:
+                            failed = i
+                            break
+                        done |= (<unsigned long long> 1) << i
+            ambient = _cached('ambient')
+            if ambient is not None:
+                _cache('ambient', (ambient | done) if operation == PR_CAP_AMBIENT_RAISE else (ambient & ~done))
+            if failed != -1:
+                raise RuntimeError("error executing %s(%s)" % (
+                    'PR_CAP_AMBIENT_RAISE' if operation == PR_CAP_AMBIENT_RAISE else 'PR_CAP_AMBIENT_LOWER', failed
+                ))
+
+        cpdef clear_all(self):
+            """
+            Remove every capability from the ambient set, with a single `PR_CAP_AMBIENT_CLEAR_ALL`.
+            """
+            if deescalate_prctl(PR_CAP_AMBIENT, PR_CAP_AMBIENT_CLEAR_ALL, 0, 0, 0) == -1:
+                raise RuntimeError("error executing PR_CAP_AMBIENT_CLEAR_ALL")
+            if _cached('ambient') is not None:
+                _cache('ambient', 0)
+
+
+    cdef class RaisedCaps(object):
+        """
+        Context manager that raises some capabilities from the permitted set into the effective set, and drops them
+        on exit (see `CapabilitySet.raised`).
+
+        Notes
+        -----
+        - Each transition costs a single capset: the capabilities are normalized once, when the object is created.
+          The state of the thread is read with a capget, or taken from the per-thread cache when the set it was
+          created by is in cached mode (see `enable_cache`).
+
+        - The context manager is reentrant and nestable: only the capabilities that were not already effective are
+          raised, and only those are dropped on exit. What each `with` block raised is kept by the object, per
+          thread: the blocks of asyncio tasks sharing a thread may interleave.
+        """
+        def __init__(self, caps, owner=None):
+            self.mask = caps_to_mask(caps)
+            self.owner = owner
+            self.stacks = {}
+
+        cdef tuple _state(self):
+            if self.owner is None or not self.owner.cached:
+                return _read_proc_masks()
+            state = _cached('caps')
+            if state is None:
+                state = _read_proc_masks()
+                _cache('caps', state)
+            return state
+
+        def __enter__(self):
+            cdef tuple state = self._state()
+            cdef unsigned long long effective = state[0]
+            cdef unsigned long long permitted = state[1]
+            cdef unsigned long long to_raise = self.mask & ~effective
+            if to_raise & ~permitted:
+                raise RuntimeError("capabilities not in the permitted set: %s" % CapMask(to_raise & ~permitted))
+            if to_raise:
+                _write_proc_masks(effective | to_raise, permitted, state[2])
+            # the blocks of one thread share the mask: whatever their order of exit, the capabilities raised by
+            # the first one are dropped by the last one
+            self.stacks.setdefault(threading.get_ident(), []).append(to_raise)
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            ident = threading.get_ident()
+            stack = self.stacks[ident]
+            cdef unsigned long long to_lower = stack.pop()
+            if not stack:
+                del self.stacks[ident]
+            if to_lower:
+                state = self._state()
+                _write_proc_masks(state[0] & ~to_lower, state[1], state[2])
+            return False
+
+        def __repr__(self):
+            return '<RaisedCaps %r>' % CapMask(self.mask)
+
 
     cdef class C_BoundingSet(object):
         def __init__(self):
-            pass
+            self.cached = False
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+        cpdef _get_mask(self):
+            if self.cached:
+                bounding = _cached('bounding')
+                if bounding is None:
+                    self.cache_misses += 1
+                    bounding = _read_bounding_mask()
+                    _cache('bounding', bounding)
+                else:
+                    self.cache_hits += 1
+                return CapMask(bounding)
+            return CapMask(_read_bounding_mask())
+
+        def refresh(self):
+            """
+            Read again the bounding set of the calling thread, and update the cache.
+            """
+            bounding = _read_bounding_mask()
+            _cache('bounding', bounding)
+            return CapMask(bounding)
 
         def __iter__(self):
-            for i in C.SUPPORTED_CAPS_VALUES:
-                if cap_get_bound(<cap_value_t> i) == CAP_SET:
-                    yield i
+            return iter(self._get_mask())
 
         def __contains__(self, item):
-            cdef cap_value_t cap = <cap_value_t> item if isinstance(item, int) else <cap_value_t> C.SUPPORTED_CAPS[bytes(item)]
-            return cap_get_bound(<cap_value_t> cap) == CAP_SET
+            cdef int cap = item if isinstance(item, int) else C.SUPPORTED_CAPS[bytes(item)]
+            if self.cached:
+                return bool((<unsigned long long> self._get_mask() >> cap) & 1)
+            return deescalate_prctl(PR_CAPBSET_READ, <unsigned long> cap, 0, 0, 0) == 1
 
         cpdef _remove_one_cap(self, int cap):
-            cdef int res = cap_drop_bound(<cap_value_t> cap)
+            cdef int res = deescalate_prctl(PR_CAPBSET_DROP, <unsigned long> cap, 0, 0, 0)
             if res == -1:
-                raise RuntimeError("error executing cap_drop_bound(%s)" % cap)
+                raise RuntimeError("error executing PR_CAPBSET_DROP(%s)" % cap)
+            bounding = _cached('bounding')
+            if bounding is not None:
+                _cache('bounding', bounding & ~(1 << cap))
+
+        cpdef _remove_mask(self, unsigned long long mask):
+            cdef int i
+            for i in range(64):
+                if (mask >> i) & 1:
+                    self._remove_one_cap(i)
+
+    # installation of a seccomp filter (see deescalate.seccomp): seccomp(2), or prctl on kernels older than 3.17
+    cdef extern from *:
+        """
+        #include <errno.h>
+        #include <unistd.h>
+        #include <sys/prctl.h>
+        #include <sys/syscall.h>
+        #include <linux/filter.h>
+        #include <linux/seccomp.h>
+
+        static int deescalate_seccomp(unsigned short len, const void *filter) {
+            struct sock_fprog prog;
+            prog.len = len;
+            prog.filter = (struct sock_filter *) filter;
+            deescalate_count(DEESCALATE_SECCOMP);
+        #ifdef SYS_seccomp
+            if (syscall(SYS_seccomp, SECCOMP_SET_MODE_FILTER, 0, &prog) == 0) return 0;
+            if (errno != ENOSYS) return -1;
+        #endif
+            return prctl(PR_SET_SECCOMP, SECCOMP_MODE_FILTER, &prog, 0, 0);
+        }
+        """
+        int deescalate_seccomp(unsigned short length, const void* filter) nogil
+
+    def install_seccomp_filter(program):
+        """
+        Install a seccomp filter on the calling thread.
+
+        Parameters
+        ----------
+        program: bytes
+            a classic BPF program, as an array of `struct sock_filter` (see `SeccompProgram`)
+
+        Raises
+        ------
+        OSError
+            if the kernel refuses the filter (EACCES: `no_new_privs` is not set and `CAP_SYS_ADMIN` is not held)
+        """
+        cdef bytes data = bytes(program)
+        cdef const char* filter = data
+        cdef unsigned short length
+        cdef int res
+        if not data or len(data) % 8 or len(data) // 8 > 4096:
+            raise ValueError("invalid seccomp program")
+        length = len(data) // 8
+        with nogil:
+            res = deescalate_seccomp(length, filter)
+        if res == -1:
+            raise OSError(errno, "seccomp filter refused: %s" % os.strerror(errno))
+
+    # Landlock (see deescalate.landlock). The structures and the system call numbers (the same on every
+    # architecture) are defined here: the installed kernel headers may predate the ABI of the running kernel.
+    cdef extern from *:
+        """
+        #include <errno.h>
+        #include <stdint.h>
+        #include <string.h>
+        #include <unistd.h>
+        #include <sys/syscall.h>
+
+        #ifndef SYS_landlock_create_ruleset
+        #define SYS_landlock_create_ruleset 444
+        #define SYS_landlock_add_rule 445
+        #define SYS_landlock_restrict_self 446
+        #endif
+
+        struct deescalate_landlock_ruleset_attr {
+            uint64_t handled_access_fs;
+            uint64_t handled_access_net;
+            uint64_t scoped;
+        };
+
+        struct deescalate_landlock_path_beneath_attr {
+            uint64_t allowed_access;
+            int32_t parent_fd;
+        } __attribute__((packed));
+
+        static int deescalate_landlock_abi(void) {
+            /* LANDLOCK_CREATE_RULESET_VERSION */
+            long abi = syscall(SYS_landlock_create_ruleset, NULL, 0, 1U);
+            return abi < 0 ? 0 : (int) abi;
+        }
+
+        static int deescalate_landlock_create(uint64_t handled_access_fs, size_t size) {
+            struct deescalate_landlock_ruleset_attr attr;
+            memset(&attr, 0, sizeof(attr));
+            attr.handled_access_fs = handled_access_fs;
+            return (int) syscall(SYS_landlock_create_ruleset, &attr, size, 0U);
+        }
+
+        static int deescalate_landlock_add_path(int ruleset_fd, int parent_fd, uint64_t allowed_access) {
+            struct deescalate_landlock_path_beneath_attr attr;
+            attr.allowed_access = allowed_access;
+            attr.parent_fd = parent_fd;
+            /* LANDLOCK_RULE_PATH_BENEATH */
+            return (int) syscall(SYS_landlock_add_rule, ruleset_fd, 1, &attr, 0U);
+        }
+
+        static int deescalate_landlock_restrict(int ruleset_fd) {
+            deescalate_count(DEESCALATE_LANDLOCK);
+            return (int) syscall(SYS_landlock_restrict_self, ruleset_fd, 0U);
+        }
+        """
+        int deescalate_landlock_abi() nogil
+        int deescalate_landlock_create(unsigned long long handled_access_fs, size_t size) nogil
+        int deescalate_landlock_add_path(int ruleset_fd, int parent_fd, unsigned long long allowed_access) nogil
+        int deescalate_landlock_restrict(int ruleset_fd) nogil
+
+    def landlock_abi():
+        """
+        The Landlock ABI version of the running kernel (0 when Landlock is not supported or disabled).
+        """
+        return deescalate_landlock_abi()
+
+    def landlock_create_ruleset(unsigned long long handled_access_fs, int abi):
+        """
+        Create a Landlock ruleset handling some filesystem rights.
+
+        Returns
+        -------
+        int
+            the ruleset file descriptor (close-on-exec)
+        """
+        # the size of struct landlock_ruleset_attr grew with handled_access_net (ABI 4) and scoped (ABI 6)
+        cdef size_t size = 8 if abi < 4 else (16 if abi < 6 else 24)
+        cdef int fd = deescalate_landlock_create(handled_access_fs, size)
+        if fd == -1:
+            raise OSError(errno, "landlock_create_ruleset failed: %s" % os.strerror(errno))
+        return fd
+
+    def landlock_add_path_rule(int ruleset_fd, int parent_fd, unsigned long long allowed_access):
+        """
+        Allow some rights beneath a file or directory, opened with `O_PATH` as `parent_fd`.
+        """
+        if deescalate_landlock_add_path(ruleset_fd, parent_fd, allowed_access) == -1:
+            raise OSError(errno, "landlock_add_rule failed: %s" % os.strerror(errno))
+
+    def landlock_restrict_self(int ruleset_fd):
+        """
+        Enforce a ruleset on the calling thread. `no_new_privs` must be set (or `CAP_SYS_ADMIN` held).
+        """
+        cdef int res
+        with nogil:
+            res = deescalate_landlock_restrict(ruleset_fd)
+        if res == -1:
+            raise OSError(errno, "landlock_restrict_self failed: %s" % os.strerror(errno))
+
+    # openat2 (linux 5.6), for the broker: the structure and the system call number (the same on every
+    # architecture) are defined here, like the Landlock ones
+    cdef extern from *:
+        """
+        #include <fcntl.h>
+
+        #ifndef SYS_openat2
+        #define SYS_openat2 437
+        #endif
+
+        struct deescalate_open_how {
+            uint64_t flags;
+            uint64_t mode;
+            uint64_t resolve;
+        };
+
+        static int deescalate_openat2(const char *path, uint64_t flags, uint64_t mode, uint64_t resolve) {
+            struct deescalate_open_how how;
+            how.flags = flags;
+            how.mode = mode;
+            how.resolve = resolve;
+            return (int) syscall(SYS_openat2, AT_FDCWD, path, &how, sizeof(how));
+        }
+        """
+        int deescalate_openat2(const char *path, unsigned long long flags, unsigned long long mode,
+                               unsigned long long resolve) nogil
+
+    #: openat2 resolve flags
+    RESOLVE_NO_MAGICLINKS = 0x02
+    RESOLVE_NO_SYMLINKS = 0x04
+
+    def openat2(bytes path, unsigned int flags, unsigned int mode, unsigned long long resolve):
+        """
+        Open a file with `openat2`, relative to the current directory.
+
+        Raises
+        ------
+        OSError
+            `ENOSYS` on kernels without openat2, `ELOOP` when `RESOLVE_NO_SYMLINKS` meets a symbolic link
+        """
+        cdef const char *c_path = path
+        cdef int fd
+        with nogil:
+            fd = deescalate_openat2(c_path, flags, mode, resolve)
+        if fd == -1:
+            raise OSError(errno, os.strerror(errno))
+        return fd
+
+    # names of the steps of a lockdown plan, indexed by the value returned by _apply_plan
+    PLAN_STEPS = (None, 'raise_effective', 'set_securebits', 'setgroups', 'setgid', 'setuid', 'drop_bounding',
+                  'capset', 'raise_ambient', 'set_no_new_privs', 'landlock', 'seccomp')
+
+    cdef int _apply_plan(const lockdown_plan_t* plan) noexcept nogil:
+        return _apply_plan_timed(plan, NULL)
+
+    cdef int _apply_plan_timed(const lockdown_plan_t* plan, unsigned long long* times) noexcept nogil:
+        # only raw syscalls here: this runs between fork and exec, or in a signal handler
+        cdef unsigned int i
+        cdef unsigned long long start
+        if plan.raise_effective:
+            start = deescalate_step_begin()
+            if _capset(plan.raise_masks[0], plan.raise_masks[1], plan.raise_masks[2]) == -1:
+                return 1
+            deescalate_step_end(1, start, times)
+        if plan.set_securebits:
+            start = deescalate_step_begin()
+            if deescalate_prctl(PR_SET_SECUREBITS, plan.securebits, 0, 0, 0) == -1:
+                return 2
+            deescalate_step_end(2, start, times)
+        if plan.set_groups:
+            start = deescalate_step_begin()
+            deescalate_count(DEESCALATE_SETGROUPS)
+            if syscall(DEESCALATE_SYS_SETGROUPS, plan.ngroups, plan.groups) == -1:
+                return 3
+            deescalate_step_end(3, start, times)
+        if plan.set_gid:
+            start = deescalate_step_begin()
+            deescalate_count(DEESCALATE_SETGID)
+            if syscall(DEESCALATE_SYS_SETRESGID, plan.gid, plan.gid, plan.gid) == -1:
+                return 4
+            deescalate_step_end(4, start, times)
+        if plan.set_uid:
+            start = deescalate_step_begin()
+            deescalate_count(DEESCALATE_SETUID)
+            if syscall(DEESCALATE_SYS_SETRESUID, plan.uid, plan.uid, plan.uid) == -1:
+                return 5
+            deescalate_step_end(5, start, times)
+        if plan.drop_bounding:
+            start = deescalate_step_begin()
+            for i in range(64):
+                if (plan.drop_bounding >> i) & 1:
+                    if deescalate_prctl(PR_CAPBSET_DROP, i, 0, 0, 0) == -1:
+                        return 6
+            deescalate_step_end(6, start, times)
+        if plan.set_caps:
+            start = deescalate_step_begin()
+            if _capset(plan.masks[0], plan.masks[1], plan.masks[2]) == -1:
+                return 7
+            deescalate_step_end(7, start, times)
+        if plan.raise_ambient:
+            start = deescalate_step_begin()
+            for i in range(64):
+                if (plan.raise_ambient >> i) & 1:
+                    if deescalate_prctl(PR_CAP_AMBIENT, PR_CAP_AMBIENT_RAISE, i, 0, 0) == -1:
+                        return 8
+            deescalate_step_end(8, start, times)
+        if plan.set_no_new_privs:
+            start = deescalate_step_begin()
+            if deescalate_prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) == -1:
+                return 9
+            deescalate_step_end(9, start, times)
+        if plan.set_landlock:
+            start = deescalate_step_begin()
+            if deescalate_landlock_restrict(plan.landlock_fd) == -1:
+                return 10
+            deescalate_step_end(10, start, times)
+        # last: the filter may forbid the system calls of the previous steps
+        if plan.set_seccomp:
+            start = deescalate_step_begin()
+            if deescalate_seccomp(plan.filter_len, plan.filter) == -1:
+                return 11
+            deescalate_step_end(11, start, times)
+        return 0
+
+
+    # Broadcast of a plan to every thread of the process, in the style of the glibc setxid broadcast or libcap psx:
+    # every thread gets a signal at once, applies the plan in the signal handler and waits at a barrier until all
+    # the threads are done.
+    cdef extern from *:
+        """
+        #include <signal.h>
+        #include <errno.h>
+        #include <limits.h>
+        #include <string.h>
+        #include <time.h>
+        #include <unistd.h>
+        #include <sys/syscall.h>
+        #include <linux/futex.h>
+
+        typedef int (*deescalate_apply_fn)(const void *);
+
+        static struct {
+            deescalate_apply_fn apply;
+            const void *plan;
+            pid_t pid;
+            int pending;        /* threads that have not applied the plan yet */
+            int failures;       /* threads that failed to apply the plan */
+            int release;        /* barrier */
+            int installed;      /* signal handled by deescalate_bc_handler, 0 if none */
+            struct sigaction old_action;
+        } deescalate_bc;
+
+        static void deescalate_bc_handler(int sig, siginfo_t *info, void *ctx) {
+            int saved_errno = errno;
+            (void) sig;
+            (void) ctx;
+            if (info->si_code != SI_TKILL || info->si_pid != deescalate_bc.pid) {
+                return;
+            }
+            if (deescalate_bc.apply(deescalate_bc.plan) != 0) {
+                __atomic_add_fetch(&deescalate_bc.failures, 1, __ATOMIC_SEQ_CST);
+            }
+            if (__atomic_sub_fetch(&deescalate_bc.pending, 1, __ATOMIC_SEQ_CST) <= 0) {
+                syscall(SYS_futex, &deescalate_bc.pending, FUTEX_WAKE, INT_MAX, NULL, NULL, 0);
+            }
+            /* no thread goes back to work before every thread has been changed */
+            while (!__atomic_load_n(&deescalate_bc.release, __ATOMIC_SEQ_CST)) {
+                syscall(SYS_futex, &deescalate_bc.release, FUTEX_WAIT, 0, NULL, NULL, 0);
+            }
+            errno = saved_errno;
+        }
+
+        /* EBUSY while the threads of a broadcast that timed out have not all applied its plan */
+        static int deescalate_bc_start(int sig, deescalate_apply_fn apply, const void *plan, int nb_threads) {
+            struct sigaction action;
+            if (deescalate_bc.installed && __atomic_load_n(&deescalate_bc.pending, __ATOMIC_SEQ_CST) > 0) {
+                errno = EBUSY;
+                return -1;
+            }
+            if (deescalate_bc.installed && deescalate_bc.installed != sig) {
+                sigaction(deescalate_bc.installed, &deescalate_bc.old_action, NULL);
+                deescalate_bc.installed = 0;
+            }
+            deescalate_bc.apply = apply;
+            deescalate_bc.plan = plan;
+            deescalate_bc.pid = getpid();
+            deescalate_bc.pending = nb_threads;
+            deescalate_bc.failures = 0;
+            deescalate_bc.release = 0;
+            memset(&action, 0, sizeof(action));
+            action.sa_sigaction = deescalate_bc_handler;
+            action.sa_flags = SA_SIGINFO | SA_RESTART;
+            sigfillset(&action.sa_mask);
+            if (deescalate_bc.installed) {
+                /* still installed after a broadcast that timed out: old_action is the original disposition */
+                return 0;
+            }
+            if (sigaction(sig, &action, &deescalate_bc.old_action) == -1) {
+                return -1;
+            }
+            deescalate_bc.installed = sig;
+            return 0;
+        }
+
+        static int deescalate_bc_signal(int sig, int tid) {
+            if (syscall(SYS_tgkill, deescalate_bc.pid, tid, sig) == 0) {
+                return 0;
+            }
+            /* the thread is gone: do not wait for it */
+            __atomic_sub_fetch(&deescalate_bc.pending, 1, __ATOMIC_SEQ_CST);
+            return -1;
+        }
+
+        /* wait until every signaled thread has applied the plan; return the number of threads still pending */
+        static int deescalate_bc_wait(long long timeout_ns) {
+            struct timespec now, remaining;
+            long long deadline, left;
+            int pending;
+            clock_gettime(CLOCK_MONOTONIC, &now);
+            deadline = now.tv_sec * 1000000000LL + now.tv_nsec + timeout_ns;
+            while ((pending = __atomic_load_n(&deescalate_bc.pending, __ATOMIC_SEQ_CST)) > 0) {
+                clock_gettime(CLOCK_MONOTONIC, &now);
+                left = deadline - (now.tv_sec * 1000000000LL + now.tv_nsec);
+                if (left <= 0) {
+                    break;
+                }
+                remaining.tv_sec = left / 1000000000LL;
+                remaining.tv_nsec = left % 1000000000LL;
+                syscall(SYS_futex, &deescalate_bc.pending, FUTEX_WAIT, pending, &remaining, NULL, 0);
+            }
+            return pending > 0 ? pending : 0;
+        }
+
+        static int deescalate_bc_failures(void) {
+            return __atomic_load_n(&deescalate_bc.failures, __ATOMIC_SEQ_CST);
+        }
+
+        /* open the barrier. The handler is only uninstalled when no signal can still be delivered */
+        static void deescalate_bc_finish(int sig, int restore) {
+            __atomic_store_n(&deescalate_bc.release, 1, __ATOMIC_SEQ_CST);
+            syscall(SYS_futex, &deescalate_bc.release, FUTEX_WAKE, INT_MAX, NULL, NULL, 0);
+            if (restore) {
+                sigaction(sig, &deescalate_bc.old_action, NULL);
+                deescalate_bc.installed = 0;
+            }
+        }
+
+        static int deescalate_gettid(void) {
+            return (int) syscall(SYS_gettid);
+        }
+        """
+        ctypedef int (*deescalate_apply_fn)(const void *) noexcept nogil
+        int deescalate_bc_start(int sig, deescalate_apply_fn apply, const void *plan, int nb_threads) nogil
+        int deescalate_bc_signal(int sig, int tid) nogil
+        int deescalate_bc_wait(long long timeout_ns) nogil
+        int deescalate_bc_failures() nogil
+        void deescalate_bc_finish(int sig, int restore) nogil
+        int deescalate_gettid() nogil
+        int SIGRTMIN
+        int EBUSY
+
+    #: result of `NativePlan.apply_all_threads`
+    BroadcastResult = namedtuple('BroadcastResult', ('threads', 'failures', 'unresponsive', 'elapsed'))
+
+    #: default signal used to broadcast a plan to every thread
+    BROADCAST_SIGNAL = SIGRTMIN + 4
+
+    # maximum number of passes over /proc/self/task, to catch the threads created during a broadcast
+    _BROADCAST_MAX_PASSES = 16
+    _broadcast_lock = threading.Lock()
+    # plan of the broadcast that timed out: the handler is still installed and may apply it later in the threads that
+    # did not answer, so it is kept alive until the next broadcast starts (once all those threads are done)
+    _stranded_plan = None
+
+    cdef int _apply_plan_fn(const void* plan) noexcept nogil:
+        return _apply_plan(<const lockdown_plan_t*> plan)
+
+
+    cdef class NativePlan(object):
+        """
+        A lockdown plan frozen into a C structure (see `LockdownPlan.compile`).
+
+        Notes
+        -----
+        - `apply` runs without the GIL and without allocating: it only performs the syscalls of the plan. It is
+          meant to be used right after a fork, in prefork workers.
+
+        - The plan only uses raw syscalls, so it only changes the calling thread (the libc `setuid` would change
+          every thread of the process).
+        """
+        def __init__(self, operations, caps=0):
+            memset(&self.plan, 0, sizeof(self.plan))
+            for name, args, _ in operations:
+                if name == 'raise_effective':
+                    self.plan.raise_effective = True
+                    self.plan.raise_masks[0], self.plan.raise_masks[1], self.plan.raise_masks[2] = args
+                elif name == 'set_securebits':
+                    self.plan.set_securebits = True
+                    self.plan.securebits = args[0]
+                elif name == 'setgroups':
+                    self._set_groups(args[0])
+                elif name == 'setgid':
+                    self.plan.set_gid = True
+                    self.plan.gid = args[0]
+                elif name == 'setuid':
+                    self.plan.set_uid = True
+                    self.plan.uid = args[0]
+                elif name == 'drop_bounding':
+                    self.plan.drop_bounding = args[0]
+                elif name == 'capset':
+                    self.plan.set_caps = True
+                    self.plan.masks[0], self.plan.masks[1], self.plan.masks[2] = args
+                elif name == 'raise_ambient':
+                    self.plan.raise_ambient = args[0]
+                elif name == 'set_no_new_privs':
+                    self.plan.set_no_new_privs = True
+                elif name == 'landlock':
+                    # the ruleset is kept open as long as the plan
+                    self.landlock = args[0]
+                    self.plan.landlock_fd = args[0].fileno()
+                    self.plan.set_landlock = True
+                elif name == 'seccomp':
+                    self._set_filter(args[0])
+                else:
+                    raise ValueError("unknown lockdown operation: %s" % name)
+            self.caps = CapMask(caps)
+
+        def _set_groups(self, groups):
+            cdef size_t i
+            free(self.plan.groups)
+            self.plan.groups = <unsigned int*> malloc(max(len(groups), 1) * sizeof(unsigned int))
+            if self.plan.groups == NULL:
+                raise MemoryError()
+            for i in range(len(groups)):
+                self.plan.groups[i] = groups[i]
+            self.plan.ngroups = len(groups)
+            self.plan.set_groups = True
+
+        def _set_filter(self, program):
+            cdef bytes data = bytes(getattr(program, 'program', program))
+            if not data or len(data) % 8 or len(data) // 8 > 4096:
+                raise ValueError("invalid seccomp program")
+            free(self.plan.filter)
+            self.plan.filter = malloc(len(data))
+            if self.plan.filter == NULL:
+                raise MemoryError()
+            memcpy(self.plan.filter, <const char*> data, len(data))
+            self.plan.filter_len = len(data) // 8
+            self.plan.set_seccomp = True
+
+        def __dealloc__(self):
+            free(self.plan.groups)
+            free(self.plan.filter)
+
+        def apply(self):
+            """
+            Apply the plan to the calling thread.
+
+            Returns
+            -------
+            CapMask
+                the capabilities that were kept
+
+            Raises
+            ------
+            OSError
+                if a step of the plan fails
+            """
+            cdef int step
+            cdef int err = 0
+            # per step durations (DEESCALATE_NB_STEPS entries), filled while the instrumentation is on
+            cdef unsigned long long times[16]
+            memset(times, 0, sizeof(times))
+            with nogil:
+                step = _apply_plan_timed(&self.plan, times)
+                if step != 0:
+                    err = errno
+            invalidate_thread_cache()
+            if deescalate_counting and stats_hooks:
+                _call_stats_hooks(times)
+            if step != 0:
+                raise OSError(err, "lockdown step %s failed: %s" % (PLAN_STEPS[step], os.strerror(err)))
+            return self.caps
+
+        def apply_all_threads(self, timeout=1.0, signum=None):
+            """
+            Apply the plan to every thread of the process.
+
+            The other threads (found in `/proc/self/task`) are all signaled at once, apply the plan from a signal
+            handler, then wait at a barrier until every signaled thread is done. The barrier is then opened, and the
+            calling thread applies the plan last. Threads created during the broadcast are caught by another pass.
+
+            When some threads do not answer before `timeout` (they block the signal), the handler stays installed:
+            they apply the plan as soon as they unblock it, and the plan is kept alive for them. No other broadcast
+            may start until they all did.
+
+            Parameters
+            ----------
+            timeout: float
+                how long to wait for the other threads, in seconds
+            signum: int, optional
+                the signal to use (default: `BROADCAST_SIGNAL`). It must not be used by the application.
+
+            Returns
+            -------
+            BroadcastResult
+                number of other threads, number of threads that failed, number of threads that did not answer
+                (blocking the signal), and the duration of the broadcast in seconds
+
+            Raises
+            ------
+            OSError
+                if the plan fails in the calling thread, or EBUSY if some threads of a previous broadcast that timed
+                out have not applied its plan yet
+            """
+            global _stranded_plan
+            cdef int sig = BROADCAST_SIGNAL if signum is None else signum
+            cdef long long timeout_ns = <long long> (timeout * 1e9)
+            cdef int pending = 0
+            cdef int step
+            cdef int err = 0
+            cdef int nb_threads = 0
+            cdef int failures = 0
+            with _broadcast_lock:
+                start = time.monotonic()
+                done = {deescalate_gettid()}
+                for _ in range(_BROADCAST_MAX_PASSES):
+                    tids = [tid for tid in (int(name) for name in os.listdir('/proc/self/task')) if tid not in done]
+                    if not tids:
+                        break
+                    if deescalate_bc_start(sig, _apply_plan_fn, &self.plan, len(tids)) == -1:
+                        if errno == EBUSY:
+                            raise OSError(EBUSY, "some threads have not applied the plan of a previous broadcast")
+                        raise OSError(errno, os.strerror(errno))
+                    # every thread of a previous broadcast is done with its plan
+                    _stranded_plan = None
+                    for tid in tids:
+                        deescalate_bc_signal(sig, tid)
+                    with nogil:
+                        pending = deescalate_bc_wait(timeout_ns)
+                    failures += deescalate_bc_failures()
+                    deescalate_bc_finish(sig, pending == 0)
+                    nb_threads += len(tids)
+                    done.update(tids)
+                    if pending:
+                        _stranded_plan = self
+                        break
+                with nogil:
+                    step = _apply_plan(&self.plan)
+                    if step != 0:
+                        err = errno
+                elapsed = time.monotonic() - start
+            global _cache_generation
+            _cache_generation += 1
+            if step != 0:
+                raise OSError(err, "lockdown step %s failed: %s" % (PLAN_STEPS[step], os.strerror(err)))
+            return BroadcastResult(nb_threads, failures, pending, elapsed)
+
+        def __repr__(self):
+            return '<NativePlan uid=%s gid=%s caps=%r>' % (
+                self.plan.uid if self.plan.set_uid else None, self.plan.gid if self.plan.set_gid else None, self.caps
+            )
+
+
+    # Exec trampoline: the child is created with clone(CLONE_VM|CLONE_VFORK), like posix_spawn does, so the parent
+    # memory is not copied. The child shares the memory of the parent until it calls execve: it only applies the
+    # stdio redirections, the working directory and a compiled plan, with raw syscalls.
+    cdef extern from *:
+        """
+        #include <sched.h>
+        #include <signal.h>
+        #include <pthread.h>
+        #include <sys/mman.h>
+        #include <sys/wait.h>
+        #include <fcntl.h>
+        #include <unistd.h>
+        #include <errno.h>
+
+        #define DEESCALATE_SPAWN_STACK (256 * 1024)
+        #define DEESCALATE_SPAWN_DUP2 12
+        #define DEESCALATE_SPAWN_CHDIR 13
+        #define DEESCALATE_SPAWN_EXEC 14
+
+        struct deescalate_spawn_args {
+            int (*apply)(const void *plan);
+            const void *plan;
+            const char *path;
+            char *const *argv;
+            char *const *envp;
+            const char *cwd;
+            int fds[3];
+            /* written by the child before it exits, when something fails */
+            int step;
+            int error;
+            sigset_t mask;
+        };
+
+        static void deescalate_spawn_fail(struct deescalate_spawn_args *args, int step) {
+            args->error = errno;
+            args->step = step;
+            _exit(127);
+        }
+
+        static int deescalate_spawn_child(void *arg) {
+            struct deescalate_spawn_args *args = (struct deescalate_spawn_args *) arg;
+            struct sigaction sa;
+            int sig, i, step;
+            int fds[3];
+            /* the handlers of the parent must not run in the child, and the signals python ignores are restored */
+            for (sig = 1; sig < _NSIG; sig++) {
+                if (sigaction(sig, NULL, &sa) != 0 || sa.sa_handler == SIG_DFL) continue;
+                if (sa.sa_handler == SIG_IGN && sig != SIGPIPE && sig != SIGXFSZ) continue;
+                memset(&sa, 0, sizeof(sa));
+                sa.sa_handler = SIG_DFL;
+                sigaction(sig, &sa, NULL);
+            }
+            sigprocmask(SIG_SETMASK, &args->mask, NULL);
+            /* like _posixsubprocess: a source among 0, 1 and 2 could be overwritten by an earlier dup2, so it is
+               first moved above 2 (the copy is closed at exec). args is shared with the parent: local copy */
+            for (i = 0; i < 3; i++) {
+                fds[i] = args->fds[i];
+                if (fds[i] >= 0 && fds[i] < 3 && fds[i] != i) {
+                    fds[i] = fcntl(fds[i], F_DUPFD_CLOEXEC, 3);
+                    if (fds[i] == -1) deescalate_spawn_fail(args, DEESCALATE_SPAWN_DUP2);
+                }
+            }
+            for (i = 0; i < 3; i++) {
+                if (fds[i] < 0) continue;
+                if (fds[i] == i) {
+                    if (fcntl(i, F_SETFD, 0) == -1) deescalate_spawn_fail(args, DEESCALATE_SPAWN_DUP2);
+                } else if (dup2(fds[i], i) == -1) {
+                    deescalate_spawn_fail(args, DEESCALATE_SPAWN_DUP2);
+                }
+            }
+            if (args->cwd != NULL && chdir(args->cwd) == -1) deescalate_spawn_fail(args, DEESCALATE_SPAWN_CHDIR);
+            step = args->apply(args->plan);
+            if (step != 0) deescalate_spawn_fail(args, step);
+            execve(args->path, args->argv, args->envp);
+            deescalate_spawn_fail(args, DEESCALATE_SPAWN_EXEC);
+            return 127;
+        }
+
+        /* returns the pid of the child, or -1 (args->step and args->error tell what failed) */
+        static int deescalate_spawn(struct deescalate_spawn_args *args) {
+            sigset_t all;
+            char *stack;
+            int pid, status, saved;
+            args->step = 0;
+            args->error = 0;
+            stack = (char *) mmap(NULL, DEESCALATE_SPAWN_STACK, PROT_READ | PROT_WRITE,
+                                  MAP_PRIVATE | MAP_ANONYMOUS | MAP_STACK, -1, 0);
+            if (stack == MAP_FAILED) {
+                args->error = errno;
+                return -1;
+            }
+            /* no signal handler may run in the child before it has reset them */
+            sigfillset(&all);
+            pthread_sigmask(SIG_SETMASK, &all, &args->mask);
+            pid = clone(deescalate_spawn_child, stack + DEESCALATE_SPAWN_STACK, CLONE_VM | CLONE_VFORK | SIGCHLD, args);
+            saved = errno;
+            pthread_sigmask(SIG_SETMASK, &args->mask, NULL);
+            munmap(stack, DEESCALATE_SPAWN_STACK);
+            if (pid == -1) {
+                args->error = saved;
+                return -1;
+            }
+            /* with CLONE_VFORK, the child has called execve or exited by now */
+            if (args->step != 0) {
+                while (waitpid(pid, &status, 0) == -1 && errno == EINTR) ;
+                return -1;
+            }
+            return pid;
+        }
+        """
+        cdef struct deescalate_spawn_args:
+            int (*apply)(const void* plan) noexcept nogil
+            const void* plan
+            const char* path
+            char** argv
+            char** envp
+            const char* cwd
+            int fds[3]
+            int step
+            int error
+        int deescalate_spawn(deescalate_spawn_args* args) nogil
+
+    SPAWN_STEPS = dict(enumerate(PLAN_STEPS))
+    SPAWN_STEPS.update({12: 'dup2', 13: 'chdir', 14: 'execve'})
+
+    cdef char** _c_strings(list strings) except NULL:
+        cdef char** array = <char**> malloc((len(strings) + 1) * sizeof(char*))
+        cdef Py_ssize_t i
+        if array == NULL:
+            raise MemoryError()
+        for i in range(len(strings)):
+            array[i] = <char*> (<bytes> strings[i])
+        array[len(strings)] = NULL
+        return array
+
+    def native_spawn(NativePlan plan, path, argv, env, cwd=None, fds=(-1, -1, -1)):
+        """
+        Start a child that applies `plan` and executes `path`, without forking the parent.
+
+        Parameters
+        ----------
+        plan: NativePlan
+            the lockdown plan of the child
+        path: bytes
+            path of the executable (no PATH lookup)
+        argv: list of bytes
+            arguments, including the program name
+        env: list of bytes
+            environment, as `KEY=value` strings
+        cwd: bytes, optional
+            working directory of the child
+        fds: 3-uple of int
+            file descriptors to use as stdin, stdout and stderr in the child (-1 to inherit)
+
+        Returns
+        -------
+        int
+            pid of the child
+
+        Raises
+        ------
+        OSError
+            if the child could not be started, locked down or could not execute `path`
+        """
+        cdef deescalate_spawn_args args
+        cdef int pid
+        cdef int i
+        argv = [bytes(arg) for arg in argv]
+        env = [bytes(item) for item in env]
+        memset(&args, 0, sizeof(args))
+        args.apply = _apply_plan_fn
+        args.plan = &plan.plan
+        args.path = path
+        if cwd is not None:
+            args.cwd = cwd
+        for i in range(3):
+            args.fds[i] = fds[i]
+        args.argv = _c_strings(argv)
+        try:
+            args.envp = _c_strings(env)
+            try:
+                with nogil:
+                    pid = deescalate_spawn(&args)
+            finally:
+                free(<void*> args.envp)
+        finally:
+            free(<void*> args.argv)
+        if pid == -1:
+            if args.step == 0:
+                raise OSError(args.error, os.strerror(args.error))
+            step = SPAWN_STEPS[args.step]
+            message = "%s failed: %s" % (step, os.strerror(args.error))
+            if step == 'execve':
+                raise OSError(args.error, message, path)
+            if step == 'chdir':
+                raise OSError(args.error, message, cwd)
+            raise OSError(args.error, message)
+        return pid
+
 
     cpdef py_prctl(option, arg2, arg3, arg4, arg5):
-        res = int(prctl(<int> option, <unsigned long> arg2, <unsigned long> arg3, <unsigned long> arg4, <unsigned long> arg5))
+        res = int(deescalate_prctl(<int> option, <unsigned long> arg2, <unsigned long> arg3, <unsigned long> arg4, <unsigned long> arg5))
         if res < 0:
             raise RuntimeError
         return res
 
 ELSE:
 
+    import errno
+
     # fake module so that we can compile and build documentation on mac osx
-    cdef class C_BoundingSet(object):
+    COMPILED_CAP_LAST_CAP = -1
+
+    def probe_capabilities():
+        return []
+
+    cpdef invalidate_thread_cache():
+        pass
+
+    cdef class C_AmbientSet(object):
         def __init__(self):
+            self.cached = True
+            self.cache_hits = 0
+            self.cache_misses = 0
+        def refresh(self):
+            return CapMask(0)
+        cpdef _get_mask(self):
+            return CapMask(0)
+        cpdef _raise_mask(self, unsigned long long mask):
+            pass
+        cpdef _lower_mask(self, unsigned long long mask):
             pass
+        cpdef clear_all(self):
+            pass
+        def __iter__(self):
+            return (x for x in [])
+        def __contains__(self, item):
+            return False
+
+    cdef class C_BoundingSet(object):
+        def __init__(self):
+            self.cached = False
+            self.cache_hits = 0
+            self.cache_misses = 0
+        def refresh(self):
+            return CapMask(0)
         cpdef _remove_one_cap(self, int cap):
             pass
+        cpdef _remove_mask(self, unsigned long long mask):
+            pass
+        cpdef _get_mask(self):
+            return CapMask(0)
         def __iter__(self):
             return (x for x in [])
         def __contains__(self, item):
             return False
 
+    COUNTERS = ()
+    stats_hooks = []
+
+    def enable_counters(bint enabled):
+        pass
+
+    def counters_enabled():
+        return False
+
+    def read_counters():
+        return {}
+
+    def read_step_times():
+        return {}
+
+    def reset_counters():
+        pass
+
+    def count_syscall(name):
+        pass
+
+    def record_step(name, elapsed_ns):
+        pass
+
     cpdef py_prctl(option, arg2, arg3, arg4, arg5):
         return 0
 
+    cpdef py_capget():
+        return CapMask(0), CapMask(0), CapMask(0)
+
+    cpdef py_capset(effective, permitted, inheritable):
+        pass
+
+    def install_seccomp_filter(program):
+        raise OSError(errno.ENOSYS, "seccomp is only available on linux")
+
+    def landlock_abi():
+        return 0
+
+    def landlock_create_ruleset(handled_access_fs, abi):
+        raise OSError(errno.ENOSYS, "Landlock is only available on linux")
+
+    def landlock_add_path_rule(ruleset_fd, parent_fd, allowed_access):
+        raise OSError(errno.ENOSYS, "Landlock is only available on linux")
+
+    def landlock_restrict_self(ruleset_fd):
+        raise OSError(errno.ENOSYS, "Landlock is only available on linux")
+
+    RESOLVE_NO_MAGICLINKS = 0x02
+    RESOLVE_NO_SYMLINKS = 0x04
+
+    def openat2(path, flags, mode, resolve):
+        raise OSError(errno.ENOSYS, "openat2 is only available on linux")
+
+    BroadcastResult = namedtuple('BroadcastResult', ('threads', 'failures', 'unresponsive', 'elapsed'))
+
+    cdef class RaisedCaps(object):
+        def __init__(self, caps, owner=None):
+            self.mask = caps_to_mask(caps)
+        def __enter__(self):
+            return self
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+    cdef class NativePlan(object):
+        def __init__(self, operations, caps=0):
+            self.operations = [
+                (name, args) for name, args, _ in operations if name in ('setgroups', 'setgid', 'setuid')
+            ]
+            self.caps = CapMask(caps)
+        def apply(self):
+            for name, args in self.operations:
+                getattr(os, name)(*args)
+            return self.caps
+        def apply_all_threads(self, timeout=1.0, signum=None):
+            start = time.time()
+            self.apply()
+            return BroadcastResult(0, 0, 0, time.time() - start)
+
+    def native_spawn(NativePlan plan, path, argv, env, cwd=None, fds=(-1, -1, -1)):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # a source among 0, 1 and 2 could be overwritten by an earlier dup2: it is moved above 2 first
+                fds = [os.dup(fd) if 0 <= fd < 3 and fd != i else fd for i, fd in enumerate(fds)]
+                for i, fd in enumerate(fds):
+                    if fd >= 0:
+                        os.dup2(fd, i)
+                if cwd is not None:
+                    os.chdir(cwd)
+                plan.apply()
+                os.execve(path, argv, dict(item.split(b'=', 1) for item in env))
+            finally:
+                os._exit(127)
+        return pid
+
     cdef class C_CapabilitySet(object):
         def __init__(self, capset):
-            pass
+            self.cached = False
+            self.cache_hits = 0
+            self.cache_misses = 0
+        def refresh(self):
+            return CapMask(0)
         cpdef _modify(self, caps_to_modify, flag_value):
             pass
+        cpdef _modify_mask(self, unsigned long long mask, flag_value):
+            pass
+        cpdef _get_mask(self):
+            return CapMask(0)
         def __iter__(self):
             return (x for x in [])
         def __contains__(self, item):
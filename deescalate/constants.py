@@ -2,9 +2,37 @@
 
 __author__ = 'stephane.martin_github@vesperal.eu'
 
-class C(object):
+import os
+import stat
+import threading
+
+# attributes of C that describe the capabilities of the running kernel: they are computed on first use
+_TABLE_ATTRIBUTES = frozenset((
+    'SUPPORTED_CAPS', 'INVERSE_SUPPORTED_CAPS', 'SUPPORTED_CAPS_NAMES', 'UNSUPPORTED_CAPS', 'SUPPORTED_CAPS_VALUES',
+    'SUPPORTED_CAPS_MASK', 'CAPS_BITS'
+))
+_CACHE_FORMAT = b'deescalate-constants 1'
+_table_lock = threading.Lock()
+
+
+class _LazyTable(type):
+    # only called when the attribute is not (yet) defined on the class
+    def __getattr__(cls, name):
+        if name not in _TABLE_ATTRIBUTES:
+            raise AttributeError(name)
+        load_table()
+        return type.__getattribute__(cls, name)
+
+
+class C(_LazyTable('_LazyTableBase', (object,), {})):
     """
     Gather the various constants used by deescalate.
+
+    Notes
+    -----
+    The capabilities supported by the running kernel (`SUPPORTED_CAPS`, `INVERSE_SUPPORTED_CAPS`,
+    `SUPPORTED_CAPS_NAMES`, `SUPPORTED_CAPS_VALUES`, `SUPPORTED_CAPS_MASK`, `CAPS_BITS` and `UNSUPPORTED_CAPS`) are
+    only computed the first time one of them is used (see `load_table`).
     """
     #: List of usual capabilities on Linux
     HARD_CODED_CAPS = [
@@ -13,7 +41,7 @@ class C(object):
         b'net_raw', b'ipc_lock', b'ipc_owner', b'sys_module', b'sys_rawio', b'sys_chroot', b'sys_ptrace',
         b'sys_pacct', b'sys_admin', b'sys_boot', b'sys_nice', b'sys_resource', b'sys_time', b'sys_tty_config',
         b'mknod', b'lease', b'audit_write', b'audit_control', b'setfcap', b'mac_override', b'mac_admin',
-        b'syslog', b'wake_alarm', b'block_suspend'
+        b'syslog', b'wake_alarm', b'block_suspend', b'audit_read', b'perfmon', b'bpf', b'checkpoint_restore'
     ]
 
     #: number of caps in HARD_CODED_CAPS
@@ -32,16 +60,118 @@ class C(object):
     #: SECBIT_KEEP_CAPS_LOCKED securebit
     SECBIT_KEEP_CAPS_LOCKED = 1 << 5
 
-    #: capabilities supported by the running platform
-    SUPPORTED_CAPS = {}
-    INVERSE_SUPPORTED_CAPS = {}
-    SUPPORTED_CAPS_NAMES = set()
-    #: capabilities not supported by the running platform
-    UNSUPPORTED_CAPS = [] + HARD_CODED_CAPS
-    SUPPORTED_CAPS_VALUES = set()
-
     # type of capability sets
     FLAGS = {b'permitted': 1, b'inheritable': 2, b'effective': 0}
     # possible values for each capability
     FLAG_VALUES = {b'clear': 0, b'set': 1}
     PRCTL = {}
+
+
+def _cache_path(cache_dir, compiled_last_cap):
+    release = os.uname()[2]
+    return os.path.join(cache_dir, 'constants-%s-%d' % (release.replace(os.sep, '_'), compiled_last_cap)), release
+
+
+def _read_cache(path, key):
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        st = os.fstat(fd)
+        # the table maps names to bits: never trust a file that someone else could have written
+        if not stat.S_ISREG(st.st_mode) or st.st_uid not in (0, os.geteuid()) or st.st_mode & 0o022:
+            return None
+        content = os.read(fd, 65536)
+    finally:
+        os.close(fd)
+    lines = content.split(b'\n')
+    if lines[0] != key:
+        return None
+    entries = []
+    try:
+        for line in lines[1:]:
+            if line:
+                value, name = line.split(b' ')
+                entries.append((int(value), None if name == b'-' else name))
+    except ValueError:
+        return None
+    return entries
+
+
+def _write_cache(path, key, entries):
+    lines = [key] + [('%d ' % value).encode('ascii') + (name or b'-') for value, name in entries]
+    # the cache directory may be shared: the temporary file is created with O_EXCL and O_NOFOLLOW, and the rename
+    # replaces a symbolic link planted at `path` instead of following it
+    import tempfile
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o755)
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+        try:
+            try:
+                os.write(fd, b'\n'.join(lines) + b'\n')
+                os.fchmod(fd, 0o644)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+
+def load_table(cache_dir=None, force=False):
+    """
+    Compute the table of the capabilities supported by the running kernel, and store it in `C`.
+
+    It is called automatically the first time the table is used, so that importing deescalate costs no syscall.
+
+    Parameters
+    ----------
+    cache_dir: str, optional
+        directory of the on-disk cache of the table (default: the `DEESCALATE_CACHE_DIR` environment variable; no
+        disk cache if unset). Cache files are keyed by the kernel release and by the `CAP_LAST_CAP` deescalate was
+        compiled with.
+    force: bool
+        compute the table again, even if it was already loaded
+    """
+    with _table_lock:
+        if not force and 'CAPS_BITS' in C.__dict__:
+            return
+        from .cd import probe_capabilities, COMPILED_CAP_LAST_CAP
+        cache_dir = cache_dir or os.environ.get('DEESCALATE_CACHE_DIR')
+        entries = None
+        if cache_dir:
+            path, release = _cache_path(cache_dir, COMPILED_CAP_LAST_CAP)
+            key = _CACHE_FORMAT + (' %s %d' % (release, COMPILED_CAP_LAST_CAP)).encode('ascii')
+            entries = _read_cache(path, key)
+        if entries is None:
+            entries = probe_capabilities()
+            if cache_dir:
+                _write_cache(path, key, entries)
+        _set_table(entries)
+
+
+def _set_table(entries):
+    supported = {}
+    inverse = {}
+    unsupported = []
+    bits = {}
+    for value, name in entries:
+        if name is None:
+            unsupported.append(C.HARD_CODED_CAPS[value] if value < C.NB_HARD_CODED else str(value))
+            continue
+        supported[name] = value
+        inverse[value] = name
+        bits[name] = bits[name.decode('ascii')] = 1 << value
+    C.SUPPORTED_CAPS = supported
+    C.INVERSE_SUPPORTED_CAPS = inverse
+    C.SUPPORTED_CAPS_NAMES = set(supported)
+    C.UNSUPPORTED_CAPS = unsupported
+    C.SUPPORTED_CAPS_VALUES = set(inverse)
+    C.SUPPORTED_CAPS_MASK = sum(1 << i for i in inverse)
+    # last: the table is complete when CAPS_BITS is defined
+    C.CAPS_BITS = bits
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import time
+import functools
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .cd import py_capget, py_capset
+from .capmask import caps_to_mask
+
+#: statistics of a `CapabilityExecutor`
+ExecutorStats = namedtuple('ExecutorStats', ('submitted', 'completed', 'failed', 'busy_time', 'elapsed', 'throughput'))
+
+
+class CapabilityExecutor(ThreadPoolExecutor):
+    """
+    Thread pool whose threads keep some capabilities raised in their effective set.
+
+    Capabilities are per-thread: the threads of the pool raise `caps` in their effective set once, when they
+    start, and keep them. Privileged work (sending on a raw socket, binding a low port...) is submitted to the pool,
+    while the other threads of the process keep a minimal effective set.
+
+    Parameters
+    ----------
+    caps: CapMask, bytes or list of bytes
+        the capabilities raised in the pool threads; they must be in the permitted set
+    max_workers: int
+        number of threads in the pool
+    lower_caller: bool
+        if True, also drop `caps` from the effective set of the calling thread
+
+    Raises
+    ------
+    RuntimeError
+        if `caps` are not in the permitted set
+
+    Examples
+    --------
+    >>> pool = CapabilityExecutor(b'net_bind_service', max_workers=1, lower_caller=True)
+    >>> sock = pool.submit(bind_socket, 80).result()
+    >>> sock = await pool.run_in_executor(bind_socket, 80)
+    """
+
+    def __init__(self, caps, max_workers=2, lower_caller=False, thread_name_prefix='deescalate-caps'):
+        self.caps = caps_to_mask(caps)
+        effective, permitted, inheritable = py_capget()
+        missing = self.caps - permitted
+        if missing:
+            raise RuntimeError("capabilities not in the permitted set: %s" % missing)
+        super(CapabilityExecutor, self).__init__(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix, initializer=self._raise_caps
+        )
+        self._stats_lock = threading.Lock()
+        self._submitted = self._completed = self._failed = 0
+        self._busy_time = 0.0
+        self._started = time.monotonic()
+        if lower_caller:
+            py_capset(effective - self.caps, permitted, inheritable)
+
+    def _raise_caps(self):
+        # a pool thread inherits the capabilities of the thread that created it: one capset to get the pool set
+        _, permitted, inheritable = py_capget()
+        py_capset(self.caps, permitted, inheritable)
+
+    def _run(self, fn, args, kwargs):
+        start = time.monotonic()
+        failed = False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            duration = time.monotonic() - start
+            with self._stats_lock:
+                self._completed += 1
+                self._failed += failed
+                self._busy_time += duration
+
+    def submit(self, fn, *args, **kwargs):
+        with self._stats_lock:
+            self._submitted += 1
+        return super(CapabilityExecutor, self).submit(self._run, fn, args, kwargs)
+
+    def run_in_executor(self, fn, *args, **kwargs):
+        """
+        Run `fn` in the pool from asyncio.
+
+        Returns
+        -------
+        asyncio.Future
+            to be awaited in the running event loop
+
+        Raises
+        ------
+        RuntimeError
+            if it is not called from a running event loop
+        """
+        import asyncio
+        return asyncio.get_running_loop().run_in_executor(self, functools.partial(fn, *args, **kwargs))
+
+    def stats(self):
+        """
+        Return the statistics of the pool.
+
+        Returns
+        -------
+        ExecutorStats
+            tasks submitted, completed and failed, total time spent running tasks, seconds since the pool was
+            created, and completed tasks per second
+        """
+        with self._stats_lock:
+            elapsed = time.monotonic() - self._started
+            return ExecutorStats(
+                self._submitted, self._completed, self._failed, self._busy_time, elapsed,
+                self._completed / elapsed if elapsed > 0 else 0.0
+            )
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# JSON messages with file descriptors attached (SCM_RIGHTS), over SOCK_SEQPACKET Unix sockets
+
+import os
+import json
+import array
+import socket
+
+#: largest message
+MAX_MESSAGE = 65536
+#: largest number of file descriptors in one message (SCM_MAX_FD)
+MAX_FDS = 253
+
+
+def ancillary_space(max_fds):
+    return socket.CMSG_SPACE(max_fds * array.array('i').itemsize)
+
+
+def send_message(sock, message, fds=()):
+    data = json.dumps(message).encode('utf-8')
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    sock.sendmsg([data], ancillary)
+
+
+def parse_message(data, ancillary, flags):
+    """
+    Decode a message read with `recvmsg`.
+
+    Returns
+    -------
+    2-uple (message or None at EOF, list of file descriptors)
+
+    Raises
+    ------
+    ValueError
+        if the message or its file descriptors were truncated, or if the message is not valid JSON (the received
+        file descriptors are then closed)
+    """
+    fds = array.array('i')
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - (len(payload) % fds.itemsize)])
+    fds = list(fds)
+    try:
+        if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+            raise ValueError("message too large")
+        return (json.loads(data.decode('utf-8')) if data else None), fds
+    except ValueError:
+        # also UnicodeDecodeError and JSONDecodeError
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def recv_message(sock, max_fds=MAX_FDS):
+    # received file descriptors must not leak into the children
+    data, ancillary, flags, _ = sock.recvmsg(MAX_MESSAGE, ancillary_space(max_fds), socket.MSG_CMSG_CLOEXEC)
+    return parse_message(data, ancillary, flags)
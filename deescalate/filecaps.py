@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# File capabilities: the security.capability extended attribute, read and written natively, and parallel walks of
+# directory trees (python 3 only, so it is not imported by the package).
+
+import os
+import sys
+import json
+import errno
+import struct
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .capmask import CapMask, EMPTY, caps_to_mask
+from .captext import compile_text, to_text
+
+XATTR_NAME = 'security.capability'
+
+VFS_CAP_REVISION_MASK = 0xFF000000
+VFS_CAP_FLAGS_EFFECTIVE = 0x000001
+VFS_CAP_REVISION_1 = 0x01000000
+VFS_CAP_REVISION_2 = 0x02000000
+VFS_CAP_REVISION_3 = 0x03000000
+
+_HEADER = struct.Struct('<I')
+# magic_etc, then (permitted, inheritable) for the low and high 32 bits
+_V2 = struct.Struct('<IIIII')
+# v2, then the UID of the root of the user namespace the capabilities apply to
+_V3 = struct.Struct('<IIIIII')
+_MASK32 = 0xFFFFFFFF
+_ENODATA = getattr(errno, 'ENODATA', 61)
+
+
+class FileCaps(namedtuple('FileCaps', ('permitted', 'inheritable', 'effective', 'rootid'))):
+    """
+    The capabilities of a file.
+
+    Attributes
+    ----------
+    permitted, inheritable: CapMask
+        the file permitted and inheritable sets
+    effective: bool
+        the file effective bit: the permitted capabilities are raised in the effective set at exec
+    rootid: int or None
+        for a namespaced file capability (xattr version 3), the UID of root in the user namespace the capabilities
+        apply to; None for a version 2 file capability
+    """
+    __slots__ = ()
+
+    def __new__(cls, permitted=EMPTY, inheritable=EMPTY, effective=False, rootid=None):
+        return super(FileCaps, cls).__new__(
+            cls, caps_to_mask(permitted), caps_to_mask(inheritable), bool(effective), rootid
+        )
+
+    @property
+    def version(self):
+        return 2 if self.rootid is None else 3
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Parse the value of the `security.capability` xattr (versions 1, 2 and 3).
+
+        Raises
+        ------
+        ValueError
+            if the value is not valid
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError("file capability too short")
+        magic = _HEADER.unpack_from(data)[0]
+        revision = magic & VFS_CAP_REVISION_MASK
+        effective = bool(magic & VFS_CAP_FLAGS_EFFECTIVE)
+        if revision == VFS_CAP_REVISION_1 and len(data) == 12:
+            _, permitted, inheritable = struct.unpack('<III', data)
+            return cls(CapMask(permitted), CapMask(inheritable), effective)
+        if revision == VFS_CAP_REVISION_2 and len(data) == _V2.size:
+            _, permitted_low, inheritable_low, permitted_high, inheritable_high = _V2.unpack(data)
+            rootid = None
+        elif revision == VFS_CAP_REVISION_3 and len(data) == _V3.size:
+            _, permitted_low, inheritable_low, permitted_high, inheritable_high, rootid = _V3.unpack(data)
+        else:
+            raise ValueError("unknown file capability revision 0x%08x (%d bytes)" % (revision, len(data)))
+        return cls(CapMask(permitted_low | (permitted_high << 32)), CapMask(inheritable_low | (inheritable_high << 32)),
+                   effective, rootid)
+
+    def to_bytes(self):
+        """
+        Serialize to the value of the `security.capability` xattr (version 3 if `rootid` is set, else version 2).
+        """
+        magic = (VFS_CAP_REVISION_2 if self.rootid is None else VFS_CAP_REVISION_3) | \
+            (VFS_CAP_FLAGS_EFFECTIVE if self.effective else 0)
+        values = [magic, self.permitted & _MASK32, self.inheritable & _MASK32, self.permitted >> 32,
+                  self.inheritable >> 32]
+        if self.rootid is None:
+            return _V2.pack(*values)
+        return _V3.pack(*(values + [self.rootid]))
+
+    def to_text(self):
+        """
+        The capabilities in the format of `getcap`, such as `cap_net_bind_service,cap_net_raw=ep` (see
+        `captext.to_text`).
+        """
+        # the effective bit is a single flag of the file: libcap shows it on every capability
+        effective = (self.permitted | self.inheritable) if self.effective else 0
+        return to_text(effective, self.permitted, self.inheritable)
+
+    @classmethod
+    def from_text(cls, text, rootid=None):
+        """
+        Parse capabilities in the libcap text format, as given to `setcap`, such as `cap_net_raw+ep` or
+        `cap_net_bind_service,cap_net_raw=ep` (see `compile_text`). The file effective bit is set when some
+        capability has the `e` flag.
+
+        Raises
+        ------
+        ValueError
+            if the text is not valid
+        """
+        caps = compile_text(text)
+        return cls(caps.permitted, caps.inheritable, bool(caps.effective), rootid)
+
+    def __str__(self):
+        return self.to_text()
+
+
+def _file_caps(value):
+    if value is None or isinstance(value, FileCaps):
+        return value
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    return FileCaps.from_text(value)
+
+
+def get_file_caps(path, follow_symlinks=True):
+    """
+    Read the capabilities of a file.
+
+    Returns
+    -------
+    FileCaps or None
+        None if the file has no capability
+    """
+    try:
+        return FileCaps.from_bytes(os.getxattr(path, XATTR_NAME, follow_symlinks=follow_symlinks))
+    except OSError as ex:
+        if ex.errno in (_ENODATA, errno.ENOTSUP):
+            return None
+        raise
+
+
+def set_file_caps(path, caps, follow_symlinks=True):
+    """
+    Set the capabilities of a file (`CAP_SETFCAP` is needed).
+
+    Parameters
+    ----------
+    caps: FileCaps or str
+        the capabilities, or their text form (see `FileCaps.from_text`). None removes them
+    """
+    caps = _file_caps(caps)
+    if caps is None:
+        return remove_file_caps(path, follow_symlinks)
+    os.setxattr(path, XATTR_NAME, caps.to_bytes(), follow_symlinks=follow_symlinks)
+
+
+def remove_file_caps(path, follow_symlinks=True):
+    """
+    Remove the capabilities of a file.
+
+    Returns
+    -------
+    bool
+        False if the file had no capability
+    """
+    try:
+        os.removexattr(path, XATTR_NAME, follow_symlinks=follow_symlinks)
+    except OSError as ex:
+        if ex.errno == _ENODATA:
+            return False
+        raise
+    return True
+
+
+def _scan_directory(path, device, errors):
+    # lists one directory: returns its subdirectories and the capabilities of its regular files. Most files have no
+    # capability: getxattr is called inline, and its ENODATA handled here rather than through get_file_caps
+    subdirectories, found = [], []
+    getxattr = os.getxattr
+    try:
+        entries = os.scandir(path)
+    except OSError as ex:
+        errors.append((path, ex))
+        return subdirectories, found
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    # only regular files can have capabilities
+                    try:
+                        data = getxattr(entry.path, XATTR_NAME, follow_symlinks=False)
+                    except OSError as ex:
+                        if ex.errno in (_ENODATA, errno.ENOTSUP):
+                            continue
+                        raise
+                    found.append((entry.path, FileCaps.from_bytes(data)))
+                elif entry.is_dir(follow_symlinks=False):
+                    if device is None or entry.stat(follow_symlinks=False).st_dev == device:
+                        subdirectories.append(entry.path)
+            except OSError as ex:
+                errors.append((entry.path, ex))
+            except ValueError as ex:
+                errors.append((entry.path, OSError(errno.EINVAL, str(ex))))
+    return subdirectories, found
+
+
+def walk(root, workers=8, one_filesystem=True, onerror=None):
+    """
+    Find every file with capabilities under a directory, like `getcap -r`.
+
+    The directories are listed with `os.scandir` by a thread pool (the listing and the `getxattr` calls release
+    the GIL), and the results are streamed as soon as each directory is done, in no particular order.
+
+    Parameters
+    ----------
+    root: str
+        a directory, or a single file
+    workers: int
+        threads of the pool
+    one_filesystem: bool
+        do not cross filesystem boundaries (`/proc` and `/sys` are skipped when walking `/`)
+    onerror: callable, optional
+        called with the path and the `OSError` of each directory or file that can not be read
+
+    Returns
+    -------
+    iterator of 2-uples (path, FileCaps)
+
+    Examples
+    --------
+    >>> for path, caps in walk('/usr'):
+    ...     print(path, caps)
+    """
+    if not os.path.isdir(root):
+        caps = get_file_caps(root)
+        if caps is not None:
+            yield root, caps
+        return
+    device = os.lstat(root).st_dev if one_filesystem else None
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {pool.submit(_scan_directory, root, device, errors)}
+        # directories waiting for a free slot: the number of tasks in flight stays bounded
+        directories = deque()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirectories, found = future.result()
+                directories.extend(subdirectories)
+                for result in found:
+                    yield result
+            while directories and len(pending) < 4 * workers:
+                pending.add(pool.submit(_scan_directory, directories.pop(), device, errors))
+            if onerror is not None:
+                while errors:
+                    onerror(*errors.pop())
+
+
+def _apply(entry):
+    if not isinstance(entry, dict):
+        return {'path': None, 'op': None, 'error': "invalid manifest entry: %r" % (entry,)}
+    path, operation = entry.get('path'), entry.get('op')
+    if operation is None:
+        operation = 'set' if 'caps' in entry else 'get'
+    result = {'path': path, 'op': operation}
+    try:
+        if operation == 'get':
+            caps = get_file_caps(path)
+        elif operation == 'set':
+            caps = _file_caps(entry.get('caps'))
+            rootid = entry.get('rootid')
+            if caps is not None and rootid is not None:
+                caps = caps._replace(rootid=int(rootid))
+            set_file_caps(path, caps)
+        elif operation == 'remove':
+            remove_file_caps(path)
+            caps = None
+        else:
+            raise ValueError("unknown operation: %r" % operation)
+        result['caps'] = caps.to_text() if caps is not None else None
+        if caps is not None and caps.rootid is not None:
+            result['rootid'] = caps.rootid
+    except (OSError, ValueError, TypeError) as ex:
+        result['error'] = str(ex)
+    return result
+
+
+def apply_manifest(entries, workers=8):
+    """
+    Get, set or remove the capabilities of many files.
+
+    Parameters
+    ----------
+    entries: iterable of dict
+        `{"path": ..., "op": "get"}`, `{"path": ..., "caps": "cap_net_raw=ep"}` (`op` defaults to `set` when
+        `caps` is given; a null `caps` removes them, and an optional `rootid` makes a version 3 file capability)
+        or `{"path": ..., "op": "remove"}`
+    workers: int
+        threads of the pool
+
+    Returns
+    -------
+    iterator of dict
+        one result per entry, in order: `path`, `op`, `caps` (the text form, after the operation) and `error`
+        when it failed
+    """
+    entries = iter(entries)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = deque()
+        for entry in entries:
+            pending.append(pool.submit(_apply, entry))
+            if len(pending) >= 64 * workers:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for entry in entries:
+                pending.append(pool.submit(_apply, entry))
+                break
+            yield result
+
+
+def main(argv=None):
+    """
+    Entry point of `deescalate filecaps`.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='deescalate filecaps', description="get and set file capabilities")
+    parser.add_argument('-w', '--workers', type=int, default=8, help="threads used for the file operations")
+    commands = parser.add_subparsers(dest='action')
+    get = commands.add_parser('get', help="print the capabilities of files, like getcap")
+    get.add_argument('-r', '--recursive', action='store_true', help="walk the directories")
+    get.add_argument('--cross-filesystems', action='store_true', help="do not stay on the filesystem of each path")
+    get.add_argument('-j', '--json', action='store_true', help="JSON lines output")
+    get.add_argument('paths', nargs='+')
+    apply_parser = commands.add_parser('apply', help="apply a JSON lines manifest ('-' for stdin)")
+    apply_parser.add_argument('manifest')
+    args = parser.parse_args(argv)
+    if args.action is None:
+        parser.error("an action is required")
+
+    def onerror(path, ex):
+        sys.stderr.write("%s: %s\n" % (path, ex.strerror or ex))
+
+    status = 0
+    if args.action == 'get':
+        for path in args.paths:
+            if args.recursive:
+                results = walk(path, args.workers, not args.cross_filesystems, onerror)
+            else:
+                try:
+                    caps = get_file_caps(path)
+                except OSError as ex:
+                    onerror(path, ex)
+                    status = 1
+                    continue
+                results = [(path, caps)] if caps is not None else []
+            for found, caps in results:
+                if args.json:
+                    sys.stdout.write(json.dumps({'path': found, 'caps': caps.to_text(), 'rootid': caps.rootid}) + '\n')
+                else:
+                    sys.stdout.write('%s %s\n' % (found, caps.to_text()))
+        return status
+
+    def decode(line):
+        # an invalid line is reported by apply_manifest, like the other invalid entries
+        try:
+            return json.loads(line)
+        except ValueError:
+            return line.strip()
+
+    stream = sys.stdin if args.manifest == '-' else open(args.manifest)
+    try:
+        entries = (decode(line) for line in stream if line.strip() and not line.startswith('#'))
+        for result in apply_manifest(entries, args.workers):
+            if 'error' in result:
+                status = 1
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return status
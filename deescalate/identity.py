@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import pwd
+import grp
+import time
+import threading
+from collections import namedtuple, OrderedDict
+
+from .utils import nss_name
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class Identity(namedtuple('Identity', ('name', 'uid', 'gid', 'groups', 'home'))):
+    """
+    A user resolved once: everything a lockdown needs, without any further NSS lookup.
+
+    Attributes
+    ----------
+    name: str or None
+        login name (None for a UID unknown to the user database)
+    uid: int or None
+        UID (None when only a group was given)
+    gid: int or None
+        primary GID
+    groups: tuple of int or None
+        supplementary GIDs (the `initgroups` list of the user, including `gid`; only `gid` when no user was given),
+        or None to leave the supplementary groups alone
+    home: str or None
+        home directory
+    """
+    __slots__ = ()
+
+
+class IdentityCache(object):
+    """
+    Cache of the resolved identities.
+
+    With sssd or LDAP, each NSS lookup can take milliseconds. The resolved identities are kept `ttl` seconds, and
+    the `maxsize` most recently used ones are kept.
+
+    Parameters
+    ----------
+    ttl: float
+        seconds an identity (or a preloaded database) stays valid
+    maxsize: int
+        maximum number of identities kept
+
+    Examples
+    --------
+    >>> cache = IdentityCache(ttl=60)
+    >>> cache.preload()
+    >>> cache.resolve('www-data')
+    Identity(name='www-data', uid=33, gid=33, groups=(33,), home='/var/www')
+    """
+
+    def __init__(self, ttl=300.0, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._files = None
+
+    def preload(self, passwd='/etc/passwd', group='/etc/group'):
+        """
+        Load the whole user and group databases from files, with two reads.
+
+        The users and groups found in the files are then resolved without NSS, until the preload expires. The
+        others still go through NSS.
+
+        Returns
+        -------
+        2-uple of int
+            number of users and groups loaded
+        """
+        users, users_by_uid = {}, {}
+        with open(passwd) as f:
+            for line in f:
+                fields = line.rstrip('\n').split(':')
+                if len(fields) < 7 or not fields[0] or fields[0][0] in '#+-':
+                    continue
+                try:
+                    entry = (fields[0], int(fields[2]), int(fields[3]), fields[5])
+                except ValueError:
+                    continue
+                users[entry[0]] = entry
+                users_by_uid.setdefault(entry[1], entry)
+        groups, groups_by_gid, members = {}, {}, {}
+        with open(group) as f:
+            for line in f:
+                fields = line.rstrip('\n').split(':')
+                if len(fields) < 4 or not fields[0] or fields[0][0] in '#+-':
+                    continue
+                try:
+                    gid = int(fields[2])
+                except ValueError:
+                    continue
+                groups[fields[0]] = gid
+                groups_by_gid.setdefault(gid, fields[0])
+                for member in fields[3].split(','):
+                    if member:
+                        members.setdefault(member, set()).add(gid)
+        with self._lock:
+            self._files = (_clock() + self.ttl, users, users_by_uid, groups, groups_by_gid, members)
+            self._entries.clear()
+        return len(users), len(groups)
+
+    def clear(self):
+        """
+        Forget the resolved identities and the preloaded databases (after a change in the user database).
+        """
+        with self._lock:
+            self._entries.clear()
+            self._files = None
+
+    def resolve(self, user=None, group=None):
+        """
+        Resolve a user and a group.
+
+        Parameters
+        ----------
+        user: Identity, int or str, optional
+            user name, UID or UID as a string
+        group: int or str, optional
+            group name, GID or GID as a string (default: the primary group of `user`)
+
+        Returns
+        -------
+        Identity
+
+        Raises
+        ------
+        KeyError
+            if the user or the group is not known
+        """
+        if isinstance(user, Identity):
+            if group is None:
+                return user
+            return user._replace(gid=self._group(group), groups=None if user.groups is None else tuple(sorted(
+                set(user.groups) - {user.gid} | {self._group(group)}
+            )))
+        key = (user, group)
+        now = _clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        identity = self._resolve(user, group)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, identity)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return identity
+
+    def _preloaded(self):
+        files = self._files
+        if files is not None and files[0] > _clock():
+            return files
+        return None
+
+    def _user(self, user):
+        # (name, uid, gid, home), or None for an unknown numeric UID
+        files = self._preloaded()
+        if isinstance(user, int):
+            if files is not None and user in files[2]:
+                return files[2][user]
+            try:
+                entry = pwd.getpwuid(user)
+            except KeyError:
+                return None
+            return entry.pw_name, entry.pw_uid, entry.pw_gid, entry.pw_dir
+        user = nss_name(user)
+        if files is not None and user in files[1]:
+            return files[1][user]
+        try:
+            entry = pwd.getpwnam(user)
+        except KeyError:
+            if not user.isdigit():
+                raise KeyError("User not known: %s" % user)
+            return self._user(int(user))
+        return entry.pw_name, entry.pw_uid, entry.pw_gid, entry.pw_dir
+
+    def _group(self, group):
+        if isinstance(group, int):
+            return group
+        group = nss_name(group)
+        files = self._preloaded()
+        if files is not None and group in files[3]:
+            return files[3][group]
+        try:
+            return grp.getgrnam(group).gr_gid
+        except KeyError:
+            if not group.isdigit():
+                raise KeyError("Group not known: %s" % group)
+            return int(group)
+
+    def _supplementary(self, name, gid):
+        files = self._preloaded()
+        if files is not None and name in files[1]:
+            return tuple(sorted(files[5].get(name, set()) | {gid}))
+        if hasattr(os, 'getgrouplist'):
+            return tuple(sorted(set(os.getgrouplist(name, gid))))
+        return tuple(sorted(set(entry.gr_gid for entry in grp.getgrall() if name in entry.gr_mem) | {gid}))
+
+    def _resolve(self, user, group):
+        gid = self._group(group) if group is not None else None
+        if user is None:
+            # root's supplementary groups must not survive the switch to the group
+            return Identity(None, None, gid, (gid,), None)
+        entry = self._user(user)
+        if entry is None:
+            # a UID unknown to the user database: no primary group nor supplementary groups to look up
+            if gid is None:
+                raise KeyError("User not known: %s" % user)
+            return Identity(None, int(user), gid, (gid,), None)
+        name, uid, primary_gid, home = entry
+        if gid is None:
+            gid = primary_gid
+        return Identity(name, uid, gid, self._supplementary(name, gid), home)
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            hits, misses, number of cached identities and whether the preloaded databases are in use
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                'preloaded': self._preloaded() is not None}
+
+
+#: the cache used by `lockdown_account`, `plan_lockdown` and the `deescalate` command
+identities = IdentityCache()
+
+
+def resolve_identity(user=None, group=None):
+    """
+    Resolve a user and a group with the default `IdentityCache` (see `IdentityCache.resolve`).
+
+    Returns
+    -------
+    Identity
+    """
+    return identities.resolve(user, group)
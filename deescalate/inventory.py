@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Host-wide inventory of the capabilities of every process and thread, read from /proc
+
+import os
+import sys
+import json
+import errno
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import C
+from .capmask import CapMask
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_MASK_KEYS = (b'CapInh', b'CapPrm', b'CapEff', b'CapBnd', b'CapAmb')
+_STATUS_KEYS = tuple((key, b'\n' + key + b':\t') for key in (
+    b'Uid', b'Gid', b'CapInh', b'CapPrm', b'CapEff', b'CapBnd', b'CapAmb', b'NoNewPrivs', b'Seccomp'
+))
+# below this number of masks, int(value, 16) is faster than numpy
+_NUMPY_THRESHOLD = 64
+
+if numpy is not None:
+    _HEX_DIGITS = numpy.full(256, 255, dtype=numpy.uint8)
+    for _i, _c in enumerate(b'0123456789abcdef'):
+        _HEX_DIGITS[_c] = _i
+    for _i, _c in enumerate(b'ABCDEF', 10):
+        _HEX_DIGITS[_c] = _i
+    _SHIFTS = numpy.arange(60, -4, -4, dtype=numpy.uint64)
+
+
+class TaskCaps(namedtuple('TaskCaps', ('pid', 'tid', 'name', 'uids', 'gids', 'inheritable', 'permitted', 'effective',
+                                       'bounding', 'ambient', 'no_new_privs', 'seccomp'))):
+    """
+    The privileges of one thread, as found in `/proc/PID/task/TID/status`.
+
+    Attributes
+    ----------
+    pid, tid: int
+        process and thread IDs
+    name: str
+        command name
+    uids, gids: 4-uple of int
+        real, effective, saved and filesystem IDs
+    inheritable, permitted, effective, bounding, ambient: CapMask
+        the capability sets (the ambient set is empty on kernels without it)
+    no_new_privs: bool or None
+    seccomp: int or None
+        0 (disabled), 1 (strict) or 2 (filter)
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """
+        JSON friendly form: the capability sets are given as lists of names.
+        """
+        record = self._asdict()
+        record['uids'], record['gids'] = list(self.uids), list(self.gids)
+        for field in ('inheritable', 'permitted', 'effective', 'bounding', 'ambient'):
+            record[field] = mask_names(record[field])
+        return record
+
+
+_masks = {}
+_names = {}
+
+
+def _cap_mask(value):
+    # few distinct masks exist on a host: share the CapMask objects
+    mask = _masks.get(value)
+    if mask is None:
+        if len(_masks) > 4096:
+            _masks.clear()
+        mask = _masks[value] = CapMask(value)
+    return mask
+
+
+def mask_names(mask):
+    """
+    Names of the capabilities of a mask, from `C.INVERSE_SUPPORTED_CAPS` (memoized).
+
+    Returns
+    -------
+    list of str
+        the names; bits unknown to the running kernel are given as their number
+    """
+    names = _names.get(mask)
+    if names is None:
+        if len(_names) > 4096:
+            _names.clear()
+        inverse = C.INVERSE_SUPPORTED_CAPS
+        names = _names[mask] = [
+            inverse[i].decode('ascii') if i in inverse else str(i) for i in range(64) if (mask >> i) & 1
+        ]
+    return list(names)
+
+
+def decode_masks(values, use_numpy=None):
+    """
+    Decode many hexadecimal masks at once.
+
+    Parameters
+    ----------
+    values: list of bytes
+        hexadecimal masks, as in `/proc/PID/status` (16 digits each)
+    use_numpy: bool, optional
+        force or forbid the vectorized NumPy decoder (default: when NumPy is installed and there are enough masks)
+
+    Returns
+    -------
+    list of int
+
+    Raises
+    ------
+    ValueError
+        if a value is not a valid mask
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(values) >= _NUMPY_THRESHOLD
+    if not use_numpy or not values:
+        return [int(value, 16) for value in values]
+    if numpy is None:
+        raise ValueError("numpy is not installed")
+    data = b''.join(values)
+    if len(data) != 16 * len(values):
+        data = b''.join(value.rjust(16, b'0') for value in values)
+        if len(data) != 16 * len(values):
+            raise ValueError("invalid capability mask")
+    digits = _HEX_DIGITS[numpy.frombuffer(data, dtype=numpy.uint8)].reshape(len(values), 16)
+    if digits.max() > 15:
+        raise ValueError("invalid capability mask")
+    # the nibbles do not overlap: the sum is a bitwise or
+    return (digits.astype(numpy.uint64) << _SHIFTS).sum(axis=1, dtype=numpy.uint64).tolist()
+
+
+def parse_status(content):
+    """
+    Extract the fields used by the inventory from the content of a `/proc/PID/task/TID/status` file.
+
+    Returns
+    -------
+    dict
+        bytes field names (`Name`, `Uid`, `CapEff`...) to their raw bytes values
+    """
+    # a few bytes.find, in the order of the lines written by the kernel, are much faster than a regular expression
+    # over the 50 lines of the status file
+    fields = {}
+    if content.startswith(b'Name:\t'):
+        fields[b'Name'] = content[6:content.find(b'\n')]
+    start = 0
+    for key, marker in _STATUS_KEYS:
+        index = content.find(marker, start)
+        if index == -1:
+            continue
+        index += len(marker)
+        end = content.find(b'\n', index)
+        fields[key] = content[index:end] if end != -1 else content[index:]
+        start = end if end != -1 else start
+    return fields
+
+
+def read_file(path):
+    """
+    Read a whole file of /proc.
+
+    Returns
+    -------
+    bytes or None
+        the content, or None if the task exited
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+    except OSError:
+        # the task exited meanwhile
+        return None
+    finally:
+        os.close(fd)
+
+
+def _list_numeric(path):
+    try:
+        return [int(entry.name) for entry in os.scandir(path) if entry.name.isdigit()]
+    except OSError as ex:
+        if ex.errno in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+            return []
+        raise
+
+
+def _scan_pids(root, pids, threads, use_numpy):
+    # one chunk of processes: read every status file, then decode all the masks of the chunk at once
+    rows = []
+    hex_values = []
+    for pid in pids:
+        base = os.path.join(root, str(pid))
+        tids = sorted(_list_numeric(os.path.join(base, 'task'))) if threads else []
+        paths = [(tid, os.path.join(base, 'task', str(tid), 'status')) for tid in tids] or \
+                [(pid, os.path.join(base, 'status'))]
+        for tid, path in paths:
+            content = read_file(path)
+            if content is None:
+                continue
+            fields = parse_status(content)
+            if b'Uid' not in fields or b'CapEff' not in fields:
+                continue
+            # CapAmb is missing before linux 4.3
+            hex_values.extend(fields.get(key, b'0000000000000000') for key in _MASK_KEYS)
+            rows.append((pid, tid, fields))
+    decoded = decode_masks(hex_values, use_numpy)
+    records = []
+    for index, (pid, tid, fields) in enumerate(rows):
+        masks = [_cap_mask(value) for value in decoded[5 * index:5 * index + 5]]
+        no_new_privs, seccomp = fields.get(b'NoNewPrivs'), fields.get(b'Seccomp')
+        records.append(TaskCaps(
+            pid, tid, fields.get(b'Name', b'').decode('utf-8', 'replace'),
+            tuple(int(i) for i in fields[b'Uid'].split()), tuple(int(i) for i in fields.get(b'Gid', b'').split()),
+            masks[0], masks[1], masks[2], masks[3], masks[4],
+            None if no_new_privs is None else no_new_privs.strip() == b'1',
+            None if seccomp is None else int(seccomp),
+        ))
+    return records
+
+
+def scan(root='/proc', threads=True, workers=None, chunk_size=64, use_numpy=None):
+    """
+    Scan the capabilities of every process (and thread) of the host.
+
+    The status files are read and parsed by a thread pool, one chunk of processes per task, and the masks of each
+    chunk are decoded together (see `decode_masks`). The results are streamed in the order of the PIDs, with a
+    bounded number of chunks in flight.
+
+    Parameters
+    ----------
+    root: str
+        the proc filesystem (or a copy of it)
+    threads: bool
+        if True, report every thread (`/proc/PID/task/TID/status`), else only the processes
+    workers: int, optional
+        threads of the pool (default: 4, or 1 to scan in the calling thread)
+    chunk_size: int
+        processes per task of the pool
+    use_numpy: bool, optional
+        see `decode_masks`
+
+    Returns
+    -------
+    iterator of TaskCaps
+        tasks that exit during the scan, or whose status can not be read, are skipped
+
+    Examples
+    --------
+    >>> privileged = [task for task in scan() if task.effective and task.uids[1] != 0]
+    """
+    pids = sorted(_list_numeric(root))
+    chunks = [pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size)]
+    workers = 4 if workers is None else workers
+    if workers <= 1:
+        for chunk in chunks:
+            for record in _scan_pids(root, chunk, threads, use_numpy):
+                yield record
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        remaining = iter(chunks)
+        for chunk in remaining:
+            pending.append(pool.submit(_scan_pids, root, chunk, threads, use_numpy))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            records = pending.popleft().result()
+            for chunk in remaining:
+                pending.append(pool.submit(_scan_pids, root, chunk, threads, use_numpy))
+                break
+            for record in records:
+                yield record
+
+
+def summarize(records, field='effective'):
+    """
+    Aggregate the capabilities held by each user.
+
+    Parameters
+    ----------
+    records: iterable of TaskCaps
+    field: str
+        the capability set to aggregate
+
+    Returns
+    -------
+    dict
+        effective UID -> (number of tasks, {capability name: number of tasks holding it})
+    """
+    summary = {}
+    for record in records:
+        entry = summary.get(record.uids[1])
+        if entry is None:
+            entry = summary[record.uids[1]] = [0, {}]
+        entry[0] += 1
+        mask = getattr(record, field)
+        if mask:
+            caps = entry[1]
+            for name in mask_names(mask):
+                caps[name] = caps.get(name, 0) + 1
+    return dict((uid, tuple(entry)) for uid, entry in summary.items())
+
+
+def format_table(summary, all_caps_threshold=None):
+    """
+    Format a `summarize` result as a text table, one line per user.
+
+    Parameters
+    ----------
+    all_caps_threshold: int, optional
+        above this number of capabilities, a line shows `(N capabilities)` instead of the names
+    """
+    import pwd
+    lines = ['%-16s %8s  %s' % ('USER', 'TASKS', 'CAPABILITIES (TASKS)')]
+    for uid in sorted(summary):
+        tasks, caps = summary[uid]
+        try:
+            user = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            user = str(uid)
+        if all_caps_threshold is not None and len(caps) > all_caps_threshold:
+            held = '(%d capabilities)' % len(caps)
+        else:
+            held = ' '.join('%s(%d)' % (name, caps[name]) for name in sorted(caps)) or '-'
+        lines.append('%-16s %8d  %s' % (user, tasks, held))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Entry point of `deescalate inventory`.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='deescalate inventory',
+                                     description="list the capabilities of every process and thread")
+    parser.add_argument('--proc', default='/proc', help="proc filesystem to scan")
+    parser.add_argument('-f', '--format', choices=('json', 'table'), default='table',
+                        help="JSON lines (one per thread), or a table of the capabilities held by each user")
+    parser.add_argument('--set', default='effective',
+                        choices=('effective', 'permitted', 'inheritable', 'bounding', 'ambient'),
+                        help="capability set aggregated in the table")
+    parser.add_argument('--processes', action='store_true', help="only scan the processes, not every thread")
+    parser.add_argument('--privileged', action='store_true',
+                        help="only report the tasks with a non empty permitted or ambient set")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="threads used for the scan")
+    args = parser.parse_args(argv)
+
+    records = scan(args.proc, threads=not args.processes, workers=args.workers)
+    if args.privileged:
+        records = (record for record in records if record.permitted or record.ambient)
+    if args.format == 'json':
+        write = sys.stdout.write
+        for record in records:
+            write(json.dumps(record.to_dict(), sort_keys=True) + '\n')
+    else:
+        sys.stdout.write(format_table(summarize(records, args.set), all_caps_threshold=16) + '\n')
+    sys.stdout.flush()
+    return 0
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Landlock filesystem rulesets, built once in a master and enforced by its workers
+
+import os
+import stat
+import time
+import errno
+
+from .cd import landlock_abi, landlock_create_ruleset, landlock_add_path_rule, landlock_restrict_self
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+#: filesystem access rights, in the order of their bits (linux/landlock.h)
+ACCESS_FS = (
+    'execute', 'write_file', 'read_file', 'read_dir', 'remove_dir', 'remove_file', 'make_char', 'make_dir',
+    'make_reg', 'make_sock', 'make_fifo', 'make_block', 'make_sym', 'refer', 'truncate', 'ioctl_dev',
+)
+ACCESS_FS_BITS = dict((name, 1 << bit) for bit, name in enumerate(ACCESS_FS))
+
+# rights that apply to a file (the others only make sense beneath a directory)
+_FILE_ACCESS = (ACCESS_FS_BITS['execute'] | ACCESS_FS_BITS['write_file'] | ACCESS_FS_BITS['read_file'] |
+                ACCESS_FS_BITS['truncate'] | ACCESS_FS_BITS['ioctl_dev'])
+
+# rights known to each ABI version: refer came with ABI 2, truncate with ABI 3, ioctl_dev with ABI 5
+_ABI_ACCESS = {1: (1 << 13) - 1, 2: (1 << 14) - 1, 3: (1 << 15) - 1, 4: (1 << 15) - 1}
+
+
+def _abi_access(abi):
+    if abi <= 0:
+        return 0
+    return _ABI_ACCESS.get(abi, (1 << 16) - 1)
+
+
+#: the Landlock ABI version of the running kernel, detected at import (0: Landlock is not available)
+ABI = landlock_abi()
+#: the filesystem rights the running kernel can restrict
+SUPPORTED_ACCESS = _abi_access(ABI)
+
+_SHORTHANDS = {
+    'r': ('read_file', 'read_dir'),
+    'w': ('write_file', 'truncate', 'remove_dir', 'remove_file', 'make_char', 'make_dir', 'make_reg', 'make_sock',
+          'make_fifo', 'make_block', 'make_sym', 'refer'),
+    'x': ('execute',),
+}
+
+
+def access_mask(access):
+    """
+    Normalize some filesystem rights.
+
+    Parameters
+    ----------
+    access: int, str or iterable of str
+        a mask, a combination of `r` (read files and list directories), `w` (write, truncate, create, remove and
+        rename) and `x` (execute) such as `rx`, or names of `ACCESS_FS` (comma-separated in a string)
+
+    Returns
+    -------
+    int
+
+    Raises
+    ------
+    ValueError
+        unknown right
+    """
+    if isinstance(access, int):
+        return access
+    if isinstance(access, str):
+        if access and set(access) <= set('rwx'):
+            return sum(ACCESS_FS_BITS[name] for name in set(name for c in access for name in _SHORTHANDS[c]))
+        access = [name for name in access.split(',') if name.strip()]
+    mask = 0
+    for name in access:
+        bit = ACCESS_FS_BITS.get(name.strip().lower())
+        if bit is None:
+            raise ValueError("unknown Landlock access right: %s" % name)
+        mask |= bit
+    return mask
+
+
+class LandlockRuleset(object):
+    """
+    Filesystem rules, turned into a Landlock ruleset file descriptor.
+
+    Build the ruleset once in the master process, where opening the paths is the expensive part: the file
+    descriptor is inherited by the forked workers, which only need a single `landlock_restrict_self` after
+    `no_new_privs` (see `lockdown_account(..., landlock=ruleset)`).
+
+    The rights not supported by the running kernel (see `ABI`) are ignored: the ruleset restricts as much as the
+    kernel can.
+
+    Parameters
+    ----------
+    handled: int, str or iterable, optional
+        the rights the ruleset restricts (default: every right the kernel supports). The rights not handled stay
+        allowed everywhere
+    required: bool
+        if False, a kernel without Landlock is not an error: the ruleset is then empty and the lockdown skips it
+
+    Attributes
+    ----------
+    build_time: float or None
+        seconds spent in `build`
+    restrict_time: float or None
+        seconds spent in the last `restrict` of this process
+
+    Examples
+    --------
+    >>> ruleset = LandlockRuleset()
+    >>> ruleset.allow('/usr', 'rx').allow('/etc/ssl', 'r').allow('/var/lib/app', 'rw')
+    >>> ruleset.build()
+    >>> for i in range(workers):
+    ...     if os.fork() == 0:
+    ...         lockdown_account('app', caps_to_keep='', landlock=ruleset)
+    ...         serve()
+    """
+
+    def __init__(self, handled=None, required=True):
+        self.handled = (SUPPORTED_ACCESS if handled is None else access_mask(handled)) & SUPPORTED_ACCESS
+        self.required = required
+        self.rules = []
+        self.build_time = None
+        self.restrict_time = None
+        self._fd = None
+
+    def allow(self, path, access='r', optional=False):
+        """
+        Allow some rights beneath a path.
+
+        Parameters
+        ----------
+        path: str
+            a directory (the rights apply to everything beneath it) or a file
+        access: int, str or iterable of str
+            see `access_mask`
+        optional: bool
+            ignore the rule if the path does not exist when the ruleset is built
+        """
+        if self._fd is not None:
+            raise ValueError("the ruleset is already built")
+        self.rules.append((path, access_mask(access), optional))
+        return self
+
+    @classmethod
+    def from_dict(cls, rules):
+        """
+        Build a ruleset from a dictionary.
+
+        Examples
+        --------
+        >>> LandlockRuleset.from_dict({
+        ...     'rules': [{'path': '/usr', 'access': 'rx'}, {'path': '/run/app', 'access': 'rw', 'optional': True}],
+        ... })
+        """
+        ruleset = cls(rules.get('handled'), rules.get('required', True))
+        for rule in rules.get('rules', ()):
+            ruleset.allow(rule['path'], rule.get('access', 'r'), rule.get('optional', False))
+        return ruleset
+
+    @property
+    def enabled(self):
+        """
+        True if the ruleset restricts something on this kernel.
+        """
+        return ABI > 0 and bool(self.handled)
+
+    def build(self):
+        """
+        Create the ruleset file descriptor (once: the next calls do nothing).
+
+        Raises
+        ------
+        OSError
+            if the kernel does not support Landlock (and the ruleset is required), or if a path can not be opened
+        """
+        if self._fd is not None or (not self.enabled and not self.required):
+            return self
+        if ABI <= 0:
+            raise OSError(errno.EOPNOTSUPP, "Landlock is not supported by the running kernel")
+        started = _clock()
+        fd = landlock_create_ruleset(self.handled, ABI)
+        try:
+            for path, access, optional in self.rules:
+                try:
+                    parent_fd = os.open(path, getattr(os, 'O_PATH', 0o10000000) | os.O_CLOEXEC)
+                except OSError as ex:
+                    if optional and ex.errno == errno.ENOENT:
+                        continue
+                    raise
+                try:
+                    access &= self.handled
+                    if not stat.S_ISDIR(os.fstat(parent_fd).st_mode):
+                        access &= _FILE_ACCESS
+                    if access:
+                        landlock_add_path_rule(fd, parent_fd, access)
+                finally:
+                    os.close(parent_fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self.build_time = _clock() - started
+        return self
+
+    def fileno(self):
+        """
+        The ruleset file descriptor (the ruleset is built if needed), or -1 when the ruleset is disabled.
+        """
+        self.build()
+        return -1 if self._fd is None else self._fd
+
+    def restrict(self):
+        """
+        Enforce the ruleset on the calling thread. `no_new_privs` must be set (or `CAP_SYS_ADMIN` held).
+
+        Returns
+        -------
+        float
+            seconds spent in `landlock_restrict_self`
+        """
+        fd = self.fileno()
+        if fd == -1:
+            return 0.0
+        started = _clock()
+        landlock_restrict_self(fd)
+        self.restrict_time = _clock() - started
+        return self.restrict_time
+
+    def close(self):
+        """
+        Close the ruleset file descriptor (the processes already restricted stay restricted).
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            ABI version, handled rights, number of rules, build and restrict times in seconds
+        """
+        return {
+            'abi': ABI, 'handled': [name for name in ACCESS_FS if self.handled & ACCESS_FS_BITS[name]],
+            'rules': len(self.rules), 'build_time': self.build_time, 'restrict_time': self.restrict_time,
+        }
+
+    def __repr__(self):
+        return '<LandlockRuleset abi=%d rules=%d fd=%s>' % (ABI, len(self.rules), self._fd)
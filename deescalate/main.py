@@ -3,13 +3,16 @@
 __author__ = 'stephane.martin_github@vesperal.eu'
 
 import os
-import platform
+import sys
 
-from deescalate.cd import py_prctl, C_CapabilitySet, C_BoundingSet
+from deescalate.cd import py_prctl, py_capget, py_capset, C_CapabilitySet, C_BoundingSet, C_AmbientSet, RaisedCaps
+from deescalate.cd import invalidate_thread_cache
+from deescalate.cd import enable_counters, counters_enabled, read_counters, read_step_times, reset_counters, stats_hooks
 from .constants import C
-from .utils import normalize_uid, normalize_gid, normalize_list_of_caps, capset_string_to_flag
+from .capmask import CapMask, caps_to_mask
+from .utils import capset_string_to_flag
 
-is_linux = platform.system().lower().strip().startswith('linux')
+is_linux = sys.platform.startswith('linux')
 
 
 class CapabilitySet(C_CapabilitySet):
@@ -35,6 +38,21 @@ class CapabilitySet(C_CapabilitySet):
         inheritable += b'setuid, setgid'
         inheritable -= [b'sys_chroot', b'sys_ptrace']
 
+    - To raise capabilities from the permitted set into the effective set for the duration of a block::
+
+        with effective.raised(b'net_admin'):
+            ...
+
+    - The content of the set is also available as a `CapMask`, and masks are accepted wherever a list of
+      capabilities is::
+
+        effective.mask
+        permitted.set(CapMask.from_caps(b'net_raw') | effective.mask)
+
+    - In cached mode (see `enable_cache`), reads are served from the last known capabilities of the calling
+      thread. `cache_hits` and `cache_misses` count how the reads were served, and `refresh()` reads the
+      capabilities again.
+
     References
     ----------
     - `Capabilities manual page <http://man7.org/linux/man-pages/man7/capabilities.7.html>`_
@@ -44,6 +62,38 @@ class CapabilitySet(C_CapabilitySet):
     def __init__(self, capset):
 
         super(CapabilitySet, self).__init__(capset)
+        self._raised = {}
+
+    def raised(self, caps):
+        """
+        Return a context manager that raises `caps` in the effective set, and drops them on exit.
+
+        Parameters
+        ----------
+        caps: CapMask, bytes or list of bytes
+            capabilities to raise; they must be in the permitted set
+
+        Returns
+        -------
+        RaisedCaps
+            reentrant and nestable context manager; each transition costs a single capset
+
+        Examples
+        --------
+        >>> with effective.raised(b'net_admin'):
+        ...     configure_interface()
+        """
+        if self.flag != C.FLAGS[b'effective']:
+            raise ValueError("only the effective set can be raised")
+        try:
+            context = self._raised.get(caps)
+        except TypeError:
+            return RaisedCaps(caps, self)
+        if context is None:
+            if len(self._raised) >= 1024:
+                self._raised.clear()
+            context = self._raised[caps] = RaisedCaps(caps, self)
+        return context
 
     def remove_all_except(self, caps_to_keep):
         """
@@ -51,26 +101,47 @@ class CapabilitySet(C_CapabilitySet):
 
         Parameters
         ----------
-        caps_to_keep: bytes or list of bytes
+        caps_to_keep: CapMask, bytes or list of bytes
             Do not drop these capabilities
         """
-        caps_to_drop = C.SUPPORTED_CAPS_VALUES.difference(normalize_list_of_caps(caps_to_keep))
-        self.__isub__(caps_to_drop)
+        self.__isub__(CapMask(C.SUPPORTED_CAPS_MASK) - caps_to_mask(caps_to_keep))
 
     def set(self, caps):
-        caps_to_keep = normalize_list_of_caps(caps)
-        caps_to_clear = C.SUPPORTED_CAPS_VALUES.difference(caps_to_keep)
-        self._modify(caps_to_keep, C.FLAG_VALUES[b'set'])
-        self._modify(caps_to_clear, C.FLAG_VALUES[b'clear'])
+        """
+        Make the set contain exactly `caps`.
+
+        Parameters
+        ----------
+        caps: CapMask, bytes or list of bytes
+            the capabilities the set should contain
+
+        Raises
+        ------
+        RuntimeError
+            if the kernel refuses the new set (nothing is changed then)
+        """
+        caps = caps_to_mask(caps)
+        masks = list(py_capget())
+        if masks[self.flag] != caps:
+            # a single capset: the set is never left half changed
+            masks[self.flag] = caps
+            py_capset(*masks)
+
+    @property
+    def mask(self):
+        """
+        The capabilities currently in the set, as a `CapMask`.
+        """
+        return self._get_mask()
 
     def __iadd__(self, caps_to_add):
-        caps_to_add = normalize_list_of_caps(caps_to_add).difference(set(self))
-        self._modify(caps_to_add, C.FLAG_VALUES[b'set'])
+        caps_to_add = caps_to_mask(caps_to_add) - self._get_mask()
+        self._modify_mask(caps_to_add, C.FLAG_VALUES[b'set'])
         return self
 
     def __isub__(self, caps_to_drop):
-        caps_to_drop = normalize_list_of_caps(caps_to_drop).intersection(set(self))
-        self._modify(caps_to_drop, C.FLAG_VALUES[b'clear'])
+        caps_to_drop = caps_to_mask(caps_to_drop) & self._get_mask()
+        self._modify_mask(caps_to_drop, C.FLAG_VALUES[b'clear'])
         return self
 
     @classmethod
@@ -107,6 +178,8 @@ class BoundingSet(C_BoundingSet):
 
         bounding_set -= b'net_admin,mac_override'
         bounding_set -= [b'syslog', b'wake_alarm']
+
+    - Like `CapabilitySet`, the bounding set supports the cached mode (see `enable_cache`).
     """
     instance = None
 
@@ -114,12 +187,18 @@ class BoundingSet(C_BoundingSet):
         super(BoundingSet, self).__init__()
 
     def __isub__(self, caps_to_drop):
-        [self._remove_one_cap(i) for i in normalize_list_of_caps(caps_to_drop)]
+        self._remove_mask(caps_to_mask(caps_to_drop))
         return self
 
     def remove_all_except(self, caps_to_keep):
-        caps_to_drop = set(self).difference(normalize_list_of_caps(caps_to_keep))
-        self.__isub__(caps_to_drop)
+        self._remove_mask(self._get_mask() - caps_to_mask(caps_to_keep))
+
+    @property
+    def mask(self):
+        """
+        The capabilities currently in the bounding set, as a `CapMask`.
+        """
+        return self._get_mask()
 
     @classmethod
     def get_instance(cls):
@@ -130,6 +209,78 @@ class BoundingSet(C_BoundingSet):
             cls.instance = cls()
         return cls.instance
 
+class AmbientSet(C_AmbientSet):
+    """
+    Represents the ambient capability set.
+
+    Notes
+    -----
+    - Ambient capabilities are kept across the `execve` of a program that has no file capabilities, even when the
+      program does not run as root. A capability can only be ambient if it is both permitted and inheritable.
+
+    - AmbientSet is iterable, and supports membership tests::
+
+        b'net_bind_service' in ambient
+
+    - Capabilities are raised and lowered with arithmetic operators (one `prctl` per capability), and `clear_all`
+      empties the set with a single `prctl`::
+
+        inheritable += b'net_bind_service'
+        ambient += b'net_bind_service'
+        ambient -= b'net_bind_service'
+        ambient.clear_all()
+
+    - Reading the ambient set costs one `prctl` per supported capability: the ambient set is always cached, and
+      the cache is kept up to date by the modifications made through deescalate. Use `refresh()` to read it
+      again.
+
+    References
+    ----------
+    - `Capabilities manual page <http://man7.org/linux/man-pages/man7/capabilities.7.html>`_
+    """
+    instance = None
+
+    def __init__(self):
+        super(AmbientSet, self).__init__()
+
+    def __iadd__(self, caps_to_add):
+        self._raise_mask(caps_to_mask(caps_to_add) - self._get_mask())
+        return self
+
+    def __isub__(self, caps_to_drop):
+        self._lower_mask(caps_to_mask(caps_to_drop) & self._get_mask())
+        return self
+
+    def set(self, caps):
+        """
+        Make the ambient set contain exactly `caps`.
+
+        Parameters
+        ----------
+        caps: CapMask, bytes or list of bytes
+            the ambient capabilities; they must be permitted and inheritable
+        """
+        caps = caps_to_mask(caps)
+        current = self._get_mask()
+        self._lower_mask(current - caps)
+        self._raise_mask(caps - current)
+
+    @property
+    def mask(self):
+        """
+        The capabilities currently in the ambient set, as a `CapMask`.
+        """
+        return self._get_mask()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        AmbientSet factory (class method).
+        """
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
 permitted = CapabilitySet.get_instance(C.FLAGS[b'permitted'])
 """Permitted capability set"""
 inheritable = CapabilitySet.get_instance(C.FLAGS[b'inheritable'])
@@ -138,6 +289,157 @@ effective = CapabilitySet.get_instance(C.FLAGS[b'effective'])
 """Effective capability set"""
 bounding_set = BoundingSet.get_instance()
 """Capability bounding set"""
+ambient = AmbientSet.get_instance()
+"""Ambient capability set"""
+
+
+def enable_cache(enabled=True):
+    """
+    Turn on (or off) the cached mode of `permitted`, `inheritable`, `effective` and `bounding_set`.
+
+    Parameters
+    ----------
+    enabled: bool
+        whether the sets should use the cache
+
+    Notes
+    -----
+    - Capabilities are per-thread, and only change when the thread itself changes them. In cached mode, the sets
+      keep the last capabilities read for the calling thread, and only read them again after their own
+      modifications (write-through) or after an explicit `refresh()`.
+
+    - Capabilities changed behind the back of deescalate (by another library, or by a `setuid` without the
+      `no_setuid_fixup` securebit) are not seen until `refresh()` is called.
+    """
+    for capset in (permitted, inheritable, effective, bounding_set):
+        capset.cached = bool(enabled)
+    if not enabled:
+        invalidate_thread_cache()
+
+
+def enable_stats(enabled=True):
+    """
+    Turn on (or off) the instrumentation: system call counters and durations of the lockdown steps.
+
+    Parameters
+    ----------
+    enabled: bool
+        whether the calls and the steps should be recorded
+
+    Notes
+    -----
+    - The counters are kept by the C extension and updated with atomic increments. When the instrumentation is off,
+      each instrumented call only tests a flag.
+
+    - The steps of `LockdownPlan.apply` and `NativePlan.apply` are timed with the monotonic clock. The steps of
+      `NativePlan.apply_all_threads` and of `spawn` children are counted too, but the hooks are not called for
+      them.
+
+    See `get_stats` and `add_stats_hook`.
+    """
+    enable_counters(bool(enabled))
+
+
+def get_stats():
+    """
+    Return the counters and the step timings recorded since the last `reset_stats`.
+
+    Returns
+    -------
+    dict
+        - `enabled`: whether the instrumentation is on
+        - `syscalls`: number of system calls by kind (`capget`, `capset`, `capbset_read`, `capbset_drop`,
+          `ambient`, `securebits`, `no_new_privs`, `prctl_other`, `setgroups`, `setgid`, `setuid`, `landlock`,
+          `seccomp`), and `prctl` for the total of the `prctl` calls
+        - `steps`: for each lockdown step that ran, its `count`, and its `total` and `max` durations in seconds
+
+    Examples
+    --------
+    >>> enable_stats()
+    >>> lockdown_account('www-data', 'www-data', 'net_bind_service')
+    >>> get_stats()['syscalls']['prctl']
+    """
+    syscalls = read_counters()
+    syscalls['prctl'] = sum(syscalls.get(name, 0) for name in (
+        'capbset_read', 'capbset_drop', 'ambient', 'securebits', 'no_new_privs', 'prctl_other'
+    ))
+    steps = dict(
+        (name, {'count': count, 'total': total / 1e9, 'max': maximum / 1e9})
+        for name, (count, total, maximum) in read_step_times().items()
+    )
+    return {'enabled': counters_enabled(), 'syscalls': syscalls, 'steps': steps}
+
+
+def reset_stats():
+    """
+    Reset the counters and the step timings.
+    """
+    reset_counters()
+
+
+def add_stats_hook(hook):
+    """
+    Call `hook(step, seconds)` for each step of the lockdown plans applied while the instrumentation is on.
+
+    The hooks are called once the whole plan is applied (or has failed), in the thread that applied it, so that
+    they can export the timings to a metrics pipeline without running between two privilege changes.
+
+    Parameters
+    ----------
+    hook: callable
+        called with the name of the step (see `Operation`) and its duration in seconds
+    """
+    if hook not in stats_hooks:
+        stats_hooks.append(hook)
+
+
+def remove_stats_hook(hook):
+    """
+    Remove a hook added by `add_stats_hook`.
+    """
+    if hook in stats_hooks:
+        stats_hooks.remove(hook)
+
+
+def get_capabilities():
+    """
+    Return the effective, permitted and inheritable sets of the calling thread, read at once.
+
+    Returns
+    -------
+    3-uple of CapMask (effective, permitted, inheritable)
+    """
+    return py_capget()
+
+
+def set_capabilities(effective=None, permitted=None, inheritable=None):
+    """
+    Set the effective, permitted and inheritable sets of the calling thread atomically, with a single `capset`.
+
+    Parameters
+    ----------
+    effective: CapMask, bytes or list of bytes, optional
+        the new effective set (unchanged if None)
+    permitted: CapMask, bytes or list of bytes, optional
+        the new permitted set (unchanged if None)
+    inheritable: CapMask, bytes or list of bytes, optional
+        the new inheritable set (unchanged if None)
+
+    Raises
+    ------
+    RuntimeError
+        if the kernel refuses the new sets (nothing is changed then)
+
+    Examples
+    --------
+    >>> set_capabilities(effective=b'net_raw', permitted=b'net_raw', inheritable=b'')
+    """
+    if effective is None or permitted is None or inheritable is None:
+        current = py_capget()
+        effective = current[0] if effective is None else effective
+        permitted = current[1] if permitted is None else permitted
+        inheritable = current[2] if inheritable is None else inheritable
+    py_capset(caps_to_mask(effective), caps_to_mask(permitted), caps_to_mask(inheritable))
 
 
 def get_securebits():
@@ -227,7 +529,8 @@ def set_no_setuid_fixup(locked=True):
         raise RuntimeError("set_no_setuid_fixup failed")
 
 
-def lockdown_account(uid=None, gid=None, caps_to_keep=None):
+def lockdown_account(uid=None, gid=None, caps_to_keep=None, all_threads=False, ambient=False, seccomp=None,
+                     landlock=None):
     """
     Deescalate the privileges of the running process.
 
@@ -235,20 +538,43 @@ def lockdown_account(uid=None, gid=None, caps_to_keep=None):
 
     - set the secure bits `noroot`, `keep_caps`, `no_setuid_fixup` and their locked companions
 
-    - perform a `setgid` and a `setuid`
+    - set the supplementary groups of the user, and perform a `setgid` and a `setuid`
 
     - restrict the 3 cap sets and the bounding set to the list given in `caps_to_keep`
 
+    - optionally, raise the kept capabilities in the ambient set
+
     - set `no_new_privs`
 
+    - optionally, enforce a Landlock ruleset and install a seccomp filter
+
+    Only the operations that change something are performed (see `plan_lockdown`).
+
     Parameters
     ----------
-    uid: int or string, optional
-        switch to this UID
+    uid: Identity, int or string, optional
+        switch to this user (see `resolve_identity`)
     gid: int or string, optional
-        switch to this GID
-    caps_to_keep: list of bytes, optional
+        switch to this GID (default: the primary group of the user)
+    caps_to_keep: CapMask or list of bytes, optional
         a list of capabilities to keep
+    all_threads: bool, optional
+        capabilities and securebits are per-thread: by default only the calling thread is locked down. If True,
+        every thread of the process is locked down (see `NativePlan.apply_all_threads`)
+    ambient: bool, optional
+        if True, also raise the kept capabilities in the ambient set, so that they survive the `execve` of a
+        program without file capabilities
+    seccomp: SeccompPolicy or SeccompProgram, optional
+        a seccomp filter to install last (see `deescalate.seccomp`). It must allow the system calls the process
+        still needs, including `execve` when the lockdown precedes one
+    landlock: LandlockRuleset, optional
+        filesystem rules enforced after `no_new_privs` (see `deescalate.landlock`). Build the ruleset once before
+        forking the workers
+
+    Returns
+    -------
+    CapMask
+        the capabilities that were kept
 
     Raises
     ------
@@ -266,45 +592,16 @@ def lockdown_account(uid=None, gid=None, caps_to_keep=None):
     >>> lockdown_account('www-data', 'www-data', 'net_bind_service')
     >>> lockdown_account('scapy', 'scapy', ['net_admin', 'net_raw'])
     """
-    caps_to_keep = normalize_list_of_caps(caps_to_keep)
-    global effective, inheritable, permitted, is_linux
-    if is_linux:
-        if b"setpcap" not in effective:
-            if b"setpcap" not in permitted:
-                raise RuntimeError("the current process doesn't have the setpcap capability")
-            else:
-                effective += b"setpcap"
-        if uid is not None:
-            if b'setuid' not in effective:
-                if b'setuid' not in permitted:
-                    raise RuntimeError("the current process doesn't have the setuid capability")
-                else:
-                    effective += b"setuid"
-        if gid is not None:
-            if b'setgid' not in effective:
-                if b'setgid' not in permitted:
-                    raise RuntimeError("the current process doesn't have the setgid capability")
-                else:
-                    effective += b"setgid"
-
-        set_noroot()
-        set_keep_caps()
-        set_no_setuid_fixup()
-
-    if uid is not None:
-        os.setgid(normalize_gid(uid, gid))
-        os.setuid(normalize_uid(uid))
-
-    if is_linux:
-        capset = set(permitted).intersection(caps_to_keep)
-        effective += b'setpcap'
-
-        bounding_set.remove_all_except(capset)
-        inheritable.set(capset)
-        effective.set(capset)
-        permitted.set(capset)
-
-        set_no_new_privs()
+    from .plan import plan_lockdown
+    plan = plan_lockdown(uid, gid, caps_to_keep, ambient, seccomp, landlock)
+    if not all_threads:
+        return plan.apply()
+    result = plan.compile().apply_all_threads()
+    if result.failures or result.unresponsive:
+        raise RuntimeError("lockdown failed in %s thread(s), %s thread(s) did not answer" % (
+            result.failures, result.unresponsive
+        ))
+    return plan.caps
 
 
 def set_no_new_privs():
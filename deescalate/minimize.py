@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Search of the smallest capability set a command needs, by delta debugging over locked down children
+
+import os
+import sys
+import time
+import errno
+from collections import namedtuple
+
+from .capmask import CapMask
+
+#: result of `minimize`
+MinimizeResult = namedtuple('MinimizeResult', ('caps', 'start', 'runs', 'cached', 'rounds', 'elapsed'))
+
+
+class Runner(object):
+    """
+    Run a test command in locked down children, many at once, and cache the outcome of each capability set.
+
+    Each child is started by `spawn` with the lockdown of `lockdown_account(identity, None, caps, ambient)`.
+
+    Parameters
+    ----------
+    args: list of str
+        the test command: it passes when it exits with status 0
+    identity: Identity, optional
+        the user and group of the children (default: unchanged)
+    ambient: bool
+        raise the capabilities in the ambient set, so that they survive the `execve` of the command (needed unless
+        the program has file capabilities)
+    jobs: int, optional
+        maximum number of children running at once (default: number of CPUs)
+    timeout: float, optional
+        seconds after which a child is killed, and its capability set considered as failing
+    env: dict, optional
+        environment of the children
+    quiet: bool
+        send the output of the children to /dev/null
+    """
+
+    def __init__(self, args, identity=None, ambient=True, jobs=None, timeout=None, env=None, quiet=True):
+        self.args = args
+        self.identity = identity
+        self.ambient = ambient
+        self.jobs = max(1, jobs or (os.cpu_count() if hasattr(os, 'cpu_count') else 1) or 1)
+        self.timeout = timeout
+        self.env = env
+        self.quiet = quiet
+        self.cache = {}
+        self.runs = self.cached = 0
+
+    def run(self, masks):
+        """
+        Test some capability sets concurrently.
+
+        Returns
+        -------
+        list of bool
+            whether the command passed, for each mask
+        """
+        from .process import spawn, DEVNULL
+        masks = [CapMask(mask) for mask in masks]
+        pending = []
+        for mask in masks:
+            if mask in self.cache:
+                self.cached += 1
+            elif mask not in pending:
+                pending.append(mask)
+        running = {}
+        pending.reverse()
+        delay = 0.0005
+        try:
+            while pending or running:
+                while pending and len(running) < self.jobs:
+                    mask = pending.pop()
+                    output = DEVNULL if self.quiet else None
+                    child = spawn(self.args, uid=self.identity, caps_to_keep=mask, ambient=self.ambient, env=self.env,
+                                  stdin=DEVNULL, stdout=output, stderr=output)
+                    self.runs += 1
+                    running[child] = (mask, time.time())
+                finished = False
+                for child in list(running):
+                    mask, started = running[child]
+                    if child.poll() is None:
+                        if self.timeout is None or time.time() - started < self.timeout:
+                            continue
+                        child.kill()
+                        child.wait()
+                        self.cache[mask] = False
+                    else:
+                        self.cache[mask] = child.returncode == 0
+                    del running[child]
+                    finished = True
+                if finished:
+                    delay = 0.0005
+                elif running:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.01)
+        finally:
+            # spawn failed, or the caller was interrupted: do not leave the children behind
+            for child in running:
+                child.kill()
+                child.wait()
+        return [self.cache[mask] for mask in masks]
+
+
+def _split(bits, n):
+    size, extra = divmod(len(bits), n)
+    chunks, start = [], 0
+    for index in range(n):
+        end = start + size + (1 if index < extra else 0)
+        chunks.append(bits[start:end])
+        start = end
+    return [chunk for chunk in chunks if chunk]
+
+
+def _mask(bits):
+    value = 0
+    for bit in bits:
+        value |= 1 << bit
+    return CapMask(value)
+
+
+def minimize(runner, start, verbose=None):
+    """
+    Find a minimal capability set the test command passes with, with delta debugging (ddmin).
+
+    The set is split in `n` chunks; every chunk and every complement of a chunk is tested, `runner.jobs` at a
+    time. The search goes on with the first passing chunk (then complement), or with twice as many chunks when
+    none passes. It ends when the chunks are single capabilities: removing any one capability of the result makes
+    the command fail (1-minimal). Each capability set is run once (`Runner.cache`).
+
+    Parameters
+    ----------
+    runner: Runner
+    start: CapMask or list
+        the starting set, the command must pass with it
+    verbose: callable, optional
+        called with a message at each round
+
+    Returns
+    -------
+    MinimizeResult
+
+    Raises
+    ------
+    ValueError
+        if the command does not pass with the starting set
+    """
+    from .capmask import caps_to_mask
+    started = time.time()
+    start = caps_to_mask(start)
+    rounds = 0
+    empty, full = runner.run([CapMask(0), start])
+    if not full:
+        raise ValueError("the command fails with the starting set %s" % ','.join(_names(start)))
+    bits = [] if empty else list(start)
+    n = 2
+    while len(bits) >= 2:
+        rounds += 1
+        chunks = _split(bits, n)
+        complements = [[bit for bit in bits if bit not in chunk] for chunk in chunks]
+        # with 2 chunks, the complements are the chunks
+        candidates = chunks + (complements if n > 2 else [])
+        if verbose is not None:
+            verbose("round %d: %d capabilities, %d chunks" % (rounds, len(bits), len(chunks)))
+        found = None
+        # test the candidates in order, a batch of `jobs` at a time, until one passes
+        for index in range(0, len(candidates), runner.jobs):
+            batch = candidates[index:index + runner.jobs]
+            results = runner.run([_mask(candidate) for candidate in batch])
+            if any(results):
+                found = index + results.index(True)
+                break
+        if found is None:
+            if n >= len(bits):
+                break
+            n = min(len(bits), 2 * n)
+        elif found < len(chunks):
+            bits, n = candidates[found], 2
+        else:
+            bits, n = candidates[found], max(n - 1, 2)
+    return MinimizeResult(_mask(bits), start, runner.runs, runner.cached, rounds, time.time() - started)
+
+
+def _names(mask):
+    from .inventory import mask_names
+    return mask_names(mask)
+
+
+def main(argv=None):
+    """
+    Entry point of `deescalate minimize`.
+    """
+    import json
+    import argparse
+    from .script import prepare_command
+    parser = argparse.ArgumentParser(prog='deescalate minimize',
+                                     description="find the smallest set of capabilities a test command passes with")
+    parser.add_argument("-u", "--user", help="run the test command as user")
+    parser.add_argument("-g", "--group", help="run the test command with this primary group")
+    parser.add_argument("-c", "--capabilities",
+                        help="comma-separated starting set (default: the permitted set of the tool)")
+    parser.add_argument('--no-ambient', action='store_true',
+                        help="do not raise the capabilities in the ambient set (for programs with file capabilities)")
+    parser.add_argument('-s', '--shell', action='store_true', help="run the test command using a shell")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="maximum number of test commands running at once (default: number of CPUs)")
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help="seconds after which a test command is killed and considered as failing")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the output of the test commands")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="the test command (exit status 0: pass)")
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error("the test command is required")
+    try:
+        identity, start, command_arguments, env = prepare_command(
+            args.user, args.group, args.capabilities, [' '.join(command)] if args.shell else command, args.shell
+        )
+    except ValueError as ex:
+        sys.stderr.write("%s\n" % ex)
+        return 1
+
+    if args.capabilities is None:
+        from .main import permitted
+        start = permitted.mask
+    runner = Runner(command_arguments, identity, not args.no_ambient, args.jobs, args.timeout, env,
+                    quiet=not args.verbose)
+    progress = (lambda message: sys.stderr.write(message + '\n')) if args.verbose else None
+    try:
+        result = minimize(runner, start, progress)
+    except (ValueError, RuntimeError) as ex:
+        sys.stderr.write("%s\n" % ex)
+        return 1
+    except OSError as ex:
+        sys.stderr.write("%s\n" % (ex.strerror if ex.errno == errno.ENOENT else ex))
+        return 1
+    report = {
+        'capabilities': _names(result.caps), 'start': _names(result.start), 'runs': result.runs,
+        'cached': result.cached, 'rounds': result.rounds, 'jobs': runner.jobs, 'elapsed': round(result.elapsed, 6),
+    }
+    if args.json:
+        sys.stdout.write(json.dumps(report, sort_keys=True) + '\n')
+    else:
+        sys.stdout.write("minimal set: %s\n" % (','.join(report['capabilities']) or '(none)'))
+        sys.stdout.write("%d of %d capabilities kept, %d runs (%d cached), %d rounds, %d jobs, %.3f s\n" % (
+            len(result.caps), len(result.start), result.runs, result.cached, result.rounds, runner.jobs,
+            result.elapsed
+        ))
+    return 0
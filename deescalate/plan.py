@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import time
+from collections import namedtuple
+
+from .cd import py_prctl, py_capset, invalidate_thread_cache, NativePlan
+from .cd import counters_enabled, count_syscall, record_step, stats_hooks
+from .constants import C
+from .capmask import CapMask, caps_to_mask
+from .state import snapshot
+from .identity import resolve_identity
+from .main import is_linux
+
+#: all the securebits set by a lockdown
+LOCKDOWN_SECUREBITS = (
+    C.SECBIT_NOROOT | C.SECBIT_NOROOT_LOCKED | C.SECBIT_KEEP_CAPS | C.SECBIT_KEEP_CAPS_LOCKED |
+    C.SECBIT_NO_SETUID_FIXUP | C.SECBIT_NO_SETUID_FIXUP_LOCKED
+)
+
+_clock = getattr(time, 'perf_counter', time.time)
+# the steps whose system calls are made by the os module, outside of the extension counters
+_OS_SYSCALLS = ('setgroups', 'setgid', 'setuid')
+
+
+class Operation(namedtuple('Operation', ('name', 'args', 'syscalls'))):
+    """
+    One step of a `LockdownPlan`.
+
+    Attributes
+    ----------
+    name: str
+        `raise_effective`, `set_securebits`, `setgroups`, `setgid`, `setuid`, `drop_bounding`, `capset`,
+        `raise_ambient`, `set_no_new_privs`, `landlock` or `seccomp`
+    args: tuple
+        arguments of the step
+    syscalls: int
+        number of syscalls the step costs
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        if self.name in ('raise_effective', 'capset'):
+            args = 'effective=%s permitted=%s inheritable=%s' % tuple(str(mask) or '-' for mask in self.args)
+        elif self.name in ('drop_bounding', 'raise_ambient'):
+            args = str(self.args[0])
+        elif self.name == 'set_securebits':
+            args = '0x%x' % self.args[0]
+        elif self.name == 'setgroups':
+            args = ','.join(str(gid) for gid in self.args[0]) or '-'
+        elif self.name == 'landlock':
+            args = '%d rules, fd %d' % (len(self.args[0].rules), self.args[0].fileno())
+        elif self.name == 'seccomp':
+            args = '%s, %d instructions, %s' % (self.args[0].method, self.args[0].instructions,
+                                                 self.args[0].digest[:12])
+        else:
+            args = ' '.join(str(arg) for arg in self.args)
+        return '%-16s %s (%d syscall%s)' % (self.name, args, self.syscalls, 's' if self.syscalls > 1 else '')
+
+
+class LockdownPlan(object):
+    """
+    Ordered list of the operations that bring the calling thread to a locked down state.
+
+    Build it with `plan_lockdown`.
+
+    Attributes
+    ----------
+    state: CapState
+        the state the plan was computed from
+    caps: CapMask
+        the capabilities kept at the end
+    groups: tuple of int or None
+        the supplementary groups at the end (None: left alone)
+    operations: tuple of Operation
+        the operations, in order
+    """
+
+    def __init__(self, state, uid, gid, caps, operations, groups=None):
+        self.state = state
+        self.uid = uid
+        self.gid = gid
+        self.groups = groups
+        self.caps = caps
+        self.operations = tuple(operations)
+
+    @property
+    def syscall_count(self):
+        """
+        Number of syscalls `apply` will perform.
+        """
+        return sum(operation.syscalls for operation in self.operations)
+
+    def dry_run(self):
+        """
+        Describe the plan without executing it.
+
+        Returns
+        -------
+        str
+        """
+        lines = ['lockdown plan: uid=%s gid=%s groups=%s caps=%s (%d operations, %d syscalls)' % (
+            self.uid, self.gid, '-' if self.groups is None else ','.join(str(gid) for gid in self.groups),
+            self.caps or '-', len(self.operations), self.syscall_count
+        )]
+        lines.extend('  %d. %s' % (idx, operation) for idx, operation in enumerate(self.operations, 1))
+        return '\n'.join(lines)
+
+    def apply(self):
+        """
+        Execute the plan.
+
+        Returns
+        -------
+        CapMask
+            the capabilities that were kept
+
+        Raises
+        ------
+        RuntimeError
+            if some capability operation fails
+        OSError
+            operation not permitted
+        """
+        if counters_enabled():
+            return self._apply_instrumented()
+        for operation in self.operations:
+            _APPLY[operation.name](*operation.args)
+        return self.caps
+
+    def _apply_instrumented(self):
+        times = []
+        try:
+            for operation in self.operations:
+                start = _clock()
+                _APPLY[operation.name](*operation.args)
+                elapsed = _clock() - start
+                if operation.name in _OS_SYSCALLS:
+                    count_syscall(operation.name)
+                record_step(operation.name, int(elapsed * 1e9))
+                times.append((operation.name, elapsed))
+        finally:
+            for name, elapsed in times:
+                for hook in stats_hooks:
+                    hook(name, elapsed)
+        return self.caps
+
+    def compile(self):
+        """
+        Freeze the plan into a `NativePlan`.
+
+        Compile the plan once in a prefork master, and apply it in every worker: the native plan does not resolve
+        users or normalize capabilities again, and `NativePlan.apply` runs in C, without the GIL.
+
+        Returns
+        -------
+        NativePlan
+        """
+        return NativePlan(self.operations, self.caps)
+
+    def __repr__(self):
+        return '<LockdownPlan uid=%s gid=%s caps=%r (%d syscalls)>' % (
+            self.uid, self.gid, self.caps, self.syscall_count
+        )
+
+
+def _apply_capset(effective, permitted, inheritable):
+    py_capset(effective, permitted, inheritable)
+
+
+def _apply_securebits(securebits):
+    py_prctl(C.PRCTL[b'set_securebits'], securebits, 0, 0, 0)
+
+
+def _apply_setgroups(groups):
+    os.setgroups(list(groups))
+
+
+def _apply_setgid(gid):
+    os.setgid(gid)
+
+
+def _apply_setuid(uid):
+    os.setuid(uid)
+    invalidate_thread_cache()
+
+
+def _apply_drop_bounding(mask):
+    for i in mask:
+        py_prctl(C.PRCTL[b'capbset_drop'], i, 0, 0, 0)
+    invalidate_thread_cache()
+
+
+def _apply_raise_ambient(mask):
+    from .main import ambient
+    ambient._raise_mask(mask)
+
+
+def _apply_no_new_privs():
+    py_prctl(C.PRCTL[b'set_no_new_privs'], 1, 0, 0, 0)
+
+
+def _apply_landlock(ruleset):
+    ruleset.restrict()
+
+
+def _apply_seccomp(program):
+    program.install()
+
+
+_APPLY = {
+    'raise_effective': _apply_capset,
+    'capset': _apply_capset,
+    'set_securebits': _apply_securebits,
+    'setgroups': _apply_setgroups,
+    'setgid': _apply_setgid,
+    'setuid': _apply_setuid,
+    'drop_bounding': _apply_drop_bounding,
+    'raise_ambient': _apply_raise_ambient,
+    'set_no_new_privs': _apply_no_new_privs,
+    'landlock': _apply_landlock,
+    'seccomp': _apply_seccomp,
+}
+
+
+def _require(state, caps):
+    missing = caps - state.permitted
+    if missing:
+        raise RuntimeError("the current process doesn't have the %s capability" % ','.join(
+            name.decode('ascii') for name in missing.names()
+        ))
+
+
+def plan_lockdown(uid=None, gid=None, caps_to_keep=None, ambient=False, seccomp=None, landlock=None):
+    """
+    Compute the minimal sequence of operations that `lockdown_account` needs to perform.
+
+    The current state is read once (see `snapshot`). The plan then only contains the operations that actually
+    change something: the securebits are written with a single `PR_SET_SECUREBITS`, the three capability sets with
+    a single `capset`, and only the capabilities still in the bounding set are dropped from it.
+
+    The user and the group are resolved through the identity cache (see `resolve_identity`). When a user is given,
+    the supplementary groups are set to the groups of the user with a single `setgroups`, like `initgroups` does.
+    When only a group is given, the supplementary groups are reduced to that group.
+
+    Parameters
+    ----------
+    uid: Identity, int or string, optional
+        switch to this user
+    gid: int or string, optional
+        switch to this GID (default: the primary group of the user)
+    caps_to_keep: CapMask or list of bytes, optional
+        a list of capabilities to keep
+    ambient: bool
+        if True, the kept capabilities are also raised in the ambient set
+    seccomp: SeccompPolicy or SeccompProgram, optional
+        a seccomp filter installed at the end of the lockdown, after `no_new_privs` (the policy is compiled once,
+        see `compile_policy`)
+    landlock: LandlockRuleset, optional
+        a Landlock ruleset enforced after `no_new_privs` (it is built now if needed, and must stay open as long as
+        the plan is used)
+
+    Returns
+    -------
+    LockdownPlan
+
+    Raises
+    ------
+    RuntimeError
+        if the process lacks a capability needed by the lockdown
+    ValueError
+        if the seccomp policy can not be compiled
+    OSError
+        if the Landlock ruleset can not be built
+
+    Examples
+    --------
+    >>> plan = plan_lockdown('www-data', 'www-data', 'net_bind_service')
+    >>> print(plan.dry_run())
+    >>> plan.apply()
+    """
+    caps_to_keep = caps_to_mask(caps_to_keep)
+    identity = resolve_identity(uid, gid) if (uid is not None or gid is not None) else None
+    target_uid = identity.uid if identity is not None else None
+    target_gid = identity.gid if identity is not None else None
+    target_groups = identity.groups if identity is not None else None
+    operations = []
+
+    if not is_linux:
+        if target_groups is not None:
+            operations.append(Operation('setgroups', (target_groups,), 1))
+        if target_gid is not None:
+            operations.append(Operation('setgid', (target_gid,), 1))
+        if target_uid is not None:
+            operations.append(Operation('setuid', (target_uid,), 1))
+        return LockdownPlan(None, target_uid, target_gid, caps_to_keep, operations, target_groups)
+
+    state = snapshot()
+    caps = state.permitted & caps_to_keep
+    securebits = state.securebits | LOCKDOWN_SECUREBITS
+    bounding_to_drop = state.bounding - caps
+    set_groups = target_groups is not None and tuple(sorted(set(os.getgroups()))) != target_groups
+    set_gid = target_gid is not None and state.gids != (target_gid,) * 4
+    set_uid = target_uid is not None and state.uids != (target_uid,) * 4
+
+    needed = CapMask(0)
+    if securebits != state.securebits or bounding_to_drop:
+        needed |= b'setpcap'
+    if set_uid:
+        needed |= b'setuid'
+    if set_gid or set_groups:
+        needed |= b'setgid'
+    _require(state, needed)
+
+    effective = state.effective
+    if needed - effective:
+        effective = effective | needed
+        operations.append(Operation('raise_effective', (effective, state.permitted, state.inheritable), 1))
+    if securebits != state.securebits:
+        operations.append(Operation('set_securebits', (securebits,), 1))
+    if set_groups:
+        operations.append(Operation('setgroups', (target_groups,), 1))
+    if set_gid:
+        operations.append(Operation('setgid', (target_gid,), 1))
+    if set_uid:
+        operations.append(Operation('setuid', (target_uid,), 1))
+    if bounding_to_drop:
+        operations.append(Operation('drop_bounding', (bounding_to_drop,), len(bounding_to_drop)))
+    if (effective, state.permitted, state.inheritable) != (caps, caps, caps):
+        operations.append(Operation('capset', (caps, caps, caps), 1))
+    # the capset lowers the ambient capabilities that are not kept; the kept ones still missing are raised
+    ambient_to_raise = (caps - state.ambient) if ambient else CapMask(0)
+    if ambient_to_raise:
+        operations.append(Operation('raise_ambient', (ambient_to_raise,), len(ambient_to_raise)))
+    if not state.no_new_privs:
+        operations.append(Operation('set_no_new_privs', (), 1))
+    if landlock is not None and landlock.fileno() != -1:
+        operations.append(Operation('landlock', (landlock,), 1))
+    if seccomp is not None:
+        if not hasattr(seccomp, 'program'):
+            seccomp = seccomp.compile()
+        operations.append(Operation('seccomp', (seccomp,), 1))
+    return LockdownPlan(state, target_uid, target_gid, caps, operations, target_groups)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import sys
+import time
+import errno
+import signal
+
+from .cd import native_spawn, NativePlan
+
+try:
+    from subprocess import TimeoutExpired
+except ImportError:
+    # python 2
+    class TimeoutExpired(Exception):
+        """
+        Raised by `SpawnedProcess.wait` when the timeout expires (`subprocess.TimeoutExpired` on python 3).
+        """
+        def __init__(self, cmd, timeout):
+            super(TimeoutExpired, self).__init__(cmd, timeout)
+            self.cmd = cmd
+            self.timeout = timeout
+
+        def __str__(self):
+            return "Command '%s' timed out after %s seconds" % (self.cmd, self.timeout)
+
+# same values as subprocess.PIPE and subprocess.DEVNULL
+PIPE = -1
+DEVNULL = -3
+
+
+def _fs_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode(sys.getfilesystemencoding())
+
+
+def _find_executable(program, env):
+    # same lookup as os.execvpe, done in the parent so that the child only calls execve
+    program = _fs_bytes(program)
+    if b'/' in program:
+        return program
+    path = env.get(b'PATH', _fs_bytes(os.defpath))
+    for directory in path.split(b':'):
+        candidate = os.path.join(directory or b'.', program)
+        if os.access(candidate, os.X_OK) and not os.path.isdir(candidate):
+            return candidate
+    raise OSError(errno.ENOENT, "%s not found in PATH" % program.decode('utf-8', 'replace'))
+
+
+class SpawnedProcess(object):
+    """
+    A child started by `spawn`.
+
+    Attributes
+    ----------
+    pid: int
+        PID of the child
+    args: list
+        the command
+    stdin, stdout, stderr: file or None
+        the parent end of the pipes, when `PIPE` was requested
+    returncode: int or None
+        exit status of the child once it is terminated (`-N` when killed by signal `N`), else None
+    """
+
+    def __init__(self, pid, args, stdin=None, stdout=None, stderr=None):
+        self.pid = pid
+        self.args = args
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def _set_status(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+    def poll(self):
+        """
+        Check if the child has terminated.
+
+        Returns
+        -------
+        int or None
+            the `returncode`
+        """
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self._set_status(status)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """
+        Wait for the child to terminate.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            seconds to wait at most
+
+        Returns
+        -------
+        int
+            the `returncode`
+
+        Raises
+        ------
+        TimeoutExpired
+            if the child is still running after `timeout` seconds (`subprocess.TimeoutExpired` on python 3)
+        """
+        if self.returncode is not None:
+            return self.returncode
+        if timeout is None:
+            return self._set_status(os.waitpid(self.pid, 0)[1])
+        deadline = time.time() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def __repr__(self):
+        return '<SpawnedProcess pid=%s returncode=%s args=%r>' % (self.pid, self.returncode, self.args)
+
+
+def _stdio(value, index, parent_ends, child_ends):
+    if value is None:
+        return -1
+    if value == DEVNULL:
+        fd = os.open(os.devnull, os.O_RDWR)
+        child_ends.append(fd)
+        return fd
+    if value == PIPE:
+        read_end, write_end = os.pipe()
+        parent, child = (write_end, read_end) if index == 0 else (read_end, write_end)
+        parent_ends[index] = parent
+        child_ends.append(child)
+        return child
+    if hasattr(value, 'fileno'):
+        return value.fileno()
+    return int(value)
+
+
+def spawn(args, plan=None, uid=None, gid=None, caps_to_keep=None, ambient=False, env=None, cwd=None, stdin=None,
+          stdout=None, stderr=None):
+    """
+    Run a command in a locked down child, without `preexec_fn` and without forking the parent.
+
+    The child is created with `clone(CLONE_VM|CLONE_VFORK)`: it does not copy the memory of the parent, and only
+    runs a small C trampoline that applies the stdio redirections, the working directory and the compiled lockdown
+    plan, then executes the command. It is safe to call from a multithreaded parent.
+
+    Parameters
+    ----------
+    args: list of str or bytes
+        the command and its arguments; the program is looked up in the PATH of `env`
+    plan: NativePlan or LockdownPlan, optional
+        the lockdown of the child. Compute it once with `plan_lockdown(...).compile()` to spawn many children. If
+        not given, the plan is computed from `uid`, `gid`, `caps_to_keep` and `ambient` (see `lockdown_account`)
+    uid, gid, caps_to_keep, ambient: optional
+        see `lockdown_account`
+    env: dict, optional
+        environment of the child (default: the environment of the parent)
+    cwd: str, optional
+        working directory of the child
+    stdin, stdout, stderr: None, PIPE, DEVNULL, file descriptor or file object
+        standard streams of the child (None: inherited from the parent)
+
+    Returns
+    -------
+    SpawnedProcess
+
+    Raises
+    ------
+    OSError
+        if the program can not be found or executed, or if the lockdown failed in the child
+    RuntimeError
+        if the process lacks a capability needed by the lockdown
+
+    Examples
+    --------
+    >>> plan = plan_lockdown('www-data', 'www-data', 'net_bind_service').compile()
+    >>> child = spawn(['nginx', '-g', 'daemon off;'], plan=plan)
+    >>> child.wait()
+    """
+    if plan is None:
+        from .plan import plan_lockdown
+        plan = plan_lockdown(uid, gid, caps_to_keep, ambient)
+    if not isinstance(plan, NativePlan):
+        plan = plan.compile()
+    environ = os.environ if env is None else env
+    env_bytes = dict((_fs_bytes(key), _fs_bytes(value)) for key, value in environ.items())
+    argv = [_fs_bytes(arg) for arg in args]
+    path = _find_executable(argv[0], env_bytes)
+
+    parent_ends = [None, None, None]
+    child_ends = []
+    try:
+        fds = tuple(
+            _stdio(value, index, parent_ends, child_ends) for index, value in enumerate((stdin, stdout, stderr))
+        )
+        pid = native_spawn(
+            plan, path, argv, [key + b'=' + value for key, value in env_bytes.items()],
+            None if cwd is None else _fs_bytes(cwd), fds
+        )
+    except BaseException:
+        for fd in parent_ends:
+            if fd is not None:
+                os.close(fd)
+        raise
+    finally:
+        for fd in child_ends:
+            os.close(fd)
+    return SpawnedProcess(
+        pid, list(args),
+        os.fdopen(parent_ends[0], 'wb') if parent_ends[0] is not None else None,
+        os.fdopen(parent_ends[1], 'rb') if parent_ends[1] is not None else None,
+        os.fdopen(parent_ends[2], 'rb') if parent_ends[2] is not None else None,
+    )
@@ -2,76 +2,340 @@
 
 __author__ = 'stephane.martin_github@vesperal.eu'
 
-import argparse
-import sys
-import pwd
-import grp
-import shlex
+# The command line tool: only the modules needed by the requested mode are imported, so that the tool starts
+# fast (see benchmarks/bench_cli.py).
+
 import os
+import sys
+
+try:
+    _STRING_TYPES = (basestring,)
+except NameError:
+    _STRING_TYPES = (str,)
+
+USAGE = "Deescalade current privileges to a given list of capabilities and run a command"
+
+
+def _parser():
+    import argparse
+    parser = argparse.ArgumentParser(usage=USAGE)
+    parser.add_argument("-u", "--user", help="run the specified command as user")
+    parser.add_argument("-g", "--group", help="run the specified command with this primary group")
+    parser.add_argument("-c", "--capabilities", help="comma-separated list of capabilities to keep")
+    parser.add_argument('-a', '--ambient', action='store_true',
+                        help="keep the capabilities across the exec of the command (ambient capabilities)")
+    parser.add_argument('-s', '--shell', action='store_true', help="run the command using a shell")
+    parser.add_argument('-d', '--dropenv', action='store_true',
+                        help="do not pass the environment variables to command")
+    parser.add_argument('--no-set-home', action='store_true', help="do not set the HOME env to the home dir of user")
+    parser.add_argument('-m', '--manifest',
+                        help="run the commands described in this JSON lines file ('-' for stdin) in parallel, and "
+                             "report their exit status as JSON lines on stdout (the output of the commands goes "
+                             "to stderr); the other options give the default values of the entries")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="maximum number of commands running at once in manifest mode (default: number of CPUs)")
+    parser.add_argument('-Z', '--zygote', metavar='SOCKET',
+                        help="run a zygote: listen on this Unix socket and start locked down processes on request")
+    parser.add_argument('--preload', help="comma-separated list of modules imported by the zygote at startup")
+    parser.add_argument('--seccomp', metavar='POLICY',
+                        help="JSON seccomp policy installed at the end of the lockdown (see deescalate.seccomp); it "
+                             "must allow execve")
+    parser.add_argument('--landlock', metavar='RULES',
+                        help="JSON Landlock ruleset enforced at the end of the lockdown (see deescalate.landlock); it "
+                             "must allow the execution of the command")
+    parser.add_argument('--files', action='store_true',
+                        help="resolve the users and groups from /etc/passwd and /etc/group, loaded at once, before "
+                             "falling back to NSS")
+    parser.add_argument("command", nargs='?', help="run the specified command")
+    return parser
+
+
+def _resolve(user, group):
+    if user is None and group is None:
+        return None
+    from .identity import resolve_identity
+    try:
+        return resolve_identity(user, group)
+    except KeyError as ex:
+        raise ValueError(ex.args[0])
+
 
-from . import lockdown_account, C
-
-parser = argparse.ArgumentParser(
-    usage="Deescalade current privileges to a given list of capabilities and run a command"
-)
-parser.add_argument("-u", "--user", help="run the specified command as user")
-parser.add_argument("-g", "--group", help="run the specified command with this primary group")
-caps_argument = parser.add_argument("-c", "--capabilities", help="comma-separated list of capabilities to keep")
-parser.add_argument('-s', '--shell', action='store_true', help="run the command using a shell")
-parser.add_argument('-d', '--dropenv', action='store_true', help="do not pass the environment variables to command")
-parser.add_argument('--no-set-home', action='store_true', help="do not set the HOME env to the home dir of user")
-parser.add_argument("command", help="run the specified command")
-args = parser.parse_args()
-
-supported_caps = C.SUPPORTED_CAPS_NAMES
-capabilities = set([cap.strip().lower() for cap in args.capabilities.split(',')]) if args.capabilities else set()
-user, group, command = args.user, args.group, args.command.strip()
-
-if not capabilities.issubset(supported_caps):
-    unsupported_caps = capabilities.difference(supported_caps)
-    sys.stderr.write("Capabilities not supported: %s\n" % ','.join(unsupported_caps))
-    sys.exit(1)
-
-user_obj = None
-if user is not None:
+def _capabilities(capabilities):
+    from .capmask import caps_to_mask
+    if isinstance(capabilities, list):
+        capabilities = ','.join(capabilities)
     try:
-        user_obj = pwd.getpwnam(user)
-    except KeyError:
+        return caps_to_mask(capabilities or '', strict=True)
+    except ValueError:
+        from .constants import C
+        tokens = (cap.strip().lower() for cap in capabilities.split(','))
+        unsupported = [cap for cap in tokens if cap and cap.encode('ascii') not in C.SUPPORTED_CAPS_NAMES]
+        raise ValueError("Capabilities not supported: %s" % ','.join(unsupported))
+
+
+def _check_type(field, value, types, lists=False):
+    if value is None:
+        return
+    if lists and isinstance(value, list):
+        if all(isinstance(item, types) and not isinstance(item, bool) for item in value):
+            return
+        raise ValueError("%s must be a list of strings" % field)
+    if isinstance(value, bool) or not isinstance(value, types):
+        raise ValueError("invalid type of %s: %s" % (field, type(value).__name__))
+
+
+def prepare_command(user, group, capabilities, command, shell=False, dropenv=False, no_set_home=False):
+    """
+    Resolve everything a command needs before its lockdown.
+
+    Returns
+    -------
+    4-uple (Identity or None, capabilities as a CapMask, command arguments, environment)
+
+    Raises
+    ------
+    ValueError
+        unknown user or group, unsupported capability, empty command, or a value of the wrong type
+    """
+    _check_type('user', user, _STRING_TYPES + (int,))
+    _check_type('group', group, _STRING_TYPES + (int,))
+    _check_type('capabilities', capabilities, _STRING_TYPES, lists=True)
+    _check_type('command', command, _STRING_TYPES, lists=True)
+    identity = _resolve(user, group)
+    caps = _capabilities(capabilities)
+
+    new_env = {} if dropenv else os.environ.copy()
+    if (not no_set_home) and identity is not None and identity.home is not None:
+        new_env['HOME'] = identity.home
+    if identity is not None and identity.name is not None:
+        new_env['USER'] = new_env['USERNAME'] = new_env['LOGNAME'] = identity.name
+    new_env.pop('MAIL', None)       # can be set incorrectly by sudo...
+
+    if isinstance(command, list):
+        command_arguments = [str(argument) for argument in command]
+    else:
+        import shlex
+        command_arguments = shlex.split((command or '').strip())
+    if not command_arguments:
+        raise ValueError("No command to run")
+    if shell:
+        command_arguments = ["/bin/sh", "-c"] + command_arguments
+    return identity, caps, command_arguments, new_env
+
+
+def _spawn(plan, command_arguments, env):
+    # the child reports a failed lockdown or exec through a close-on-exec pipe
+    import fcntl
+    read_end, write_end = os.pipe()
+    fcntl.fcntl(write_end, fcntl.F_SETFD, fcntl.fcntl(write_end, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    pid = os.fork()
+    if pid == 0:
         try:
-            user_obj = pwd.getpwuid(int(user))
-        except (KeyError, TypeError, ValueError):
-            sys.stderr.write("User not known: %s\n" % user)
-            sys.exit(1)
+            os.close(read_end)
+            # stdout is reserved to the JSON lines report
+            os.dup2(2, 1)
+            plan.apply()
+            os.execvpe(command_arguments[0], command_arguments, env)
+        except BaseException as ex:
+            try:
+                os.write(write_end, str(ex).encode('utf-8', 'replace'))
+            finally:
+                os._exit(127)
+    os.close(write_end)
+    return pid, read_end
+
 
-group_obj = None
-if group is not None:
+def _read_entries(path):
+    import json
+    entries = []
+    stream = sys.stdin if path == '-' else open(path)
     try:
-        group_obj = grp.getgrnam(group)
-    except KeyError:
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as ex:
+                raise ValueError("invalid manifest entry at line %d: %s" % (number, ex))
+            if not isinstance(entry, dict):
+                raise ValueError("invalid manifest entry at line %d: not an object" % number)
+            entries.append(entry)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    return entries
+
+
+def run_manifest(path, jobs=None, defaults=None):
+    """
+    Run the commands of a manifest in parallel, each one in its own locked down child process.
+
+    Parameters
+    ----------
+    path: str
+        JSON lines file, one command per line, or '-' for stdin. Each entry is an object with a `command` (string
+        or list of arguments) and optionally `name`, `user`, `group`, `capabilities` (string or list), `ambient`,
+        `shell`, `dropenv` and `no_set_home`
+    jobs: int, optional
+        maximum number of children running at once (default: number of CPUs)
+    defaults: dict, optional
+        default values of the entry fields
+
+    Returns
+    -------
+    int
+        0 if every command was started and exited with status 0, 1 otherwise
+
+    Raises
+    ------
+    ValueError
+        if the manifest is not valid (nothing is started then)
+
+    Notes
+    -----
+    - A JSON line is written on stdout when each child terminates, with the entry `index` and `name`, the `pid`,
+      the `returncode` (or the `signal` that killed the child), the `error` that prevented the command from
+      starting, and the `started` and `elapsed` times in seconds.
+
+    - Each distinct (user, group) is resolved once, and the lockdown plan of each distinct (user, group,
+      capabilities) is computed once (see `plan_lockdown`) and applied in the children right after the fork.
+    """
+    import json
+    import time
+    from .plan import plan_lockdown
+
+    entries = _read_entries(path)
+    jobs = max(1, jobs or (os.cpu_count() if hasattr(os, 'cpu_count') else 1) or 1)
+    defaults = defaults or {}
+    plans = {}
+    running = {}
+    origin = time.time()
+    failures = [0]
+
+    def report(record):
+        if record.get('error') or record.get('returncode') != 0:
+            failures[0] += 1
+        sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    def reap():
+        pid, status = os.wait()
+        if pid not in running:
+            return
+        index, name, command_arguments, started, read_end = running.pop(pid)
+        chunks = []
+        while True:
+            chunk = os.read(read_end, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(read_end)
+        record = {
+            'index': index, 'name': name, 'pid': pid, 'command': command_arguments,
+            'started': round(started - origin, 6), 'elapsed': round(time.time() - started, 6),
+            'returncode': os.WEXITSTATUS(status) if os.WIFEXITED(status) else None,
+            'signal': os.WTERMSIG(status) if os.WIFSIGNALED(status) else None,
+            'error': b''.join(chunks).decode('utf-8', 'replace') or None,
+        }
+        report(record)
+
+    for index, entry in enumerate(entries):
+        while len(running) >= jobs:
+            reap()
+        options = dict(defaults)
+        options.update(entry)
+        name = options.get('name')
         try:
-            group_obj = grp.getgrgid(int(group))
-        except (KeyError, TypeError, ValueError):
-            sys.stderr.write("Group not known: %s\n" % group)
-            sys.exit(1)
-
-lockdown_account(
-    user_obj.pw_uid if user_obj is not None else None,
-    group_obj.gr_gid if group_obj is not None else None,
-    capabilities
-)
-
-new_env = {} if args.dropenv else os.environ.copy()
-if (not args.no_set_home) and (user_obj is not None):
-    new_env['HOME'] = user_obj.pw_dir
-if user_obj is not None:
-    new_env['USER'] = new_env['USERNAME'] = new_env['LOGNAME'] = user_obj.pw_name
-try:
-    del new_env['MAIL']             # can be set incorrectly by sudo...
-except KeyError:
-    pass
+            identity, caps, command_arguments, env = prepare_command(
+                options.get('user'), options.get('group'), options.get('capabilities'), options.get('command'),
+                options.get('shell', False), options.get('dropenv', False), options.get('no_set_home', False)
+            )
+            key = (identity, caps, bool(options.get('ambient')))
+            plan = plans.get(key)
+            if plan is None:
+                plan = plans[key] = plan_lockdown(identity, None, caps, key[2]).compile()
+        except (ValueError, RuntimeError, OSError) as ex:
+            report({'index': index, 'name': name, 'error': str(ex)})
+            continue
+        started = time.time()
+        pid, read_end = _spawn(plan, command_arguments, env)
+        running[pid] = (index, name, command_arguments, started, read_end)
+
+    while running:
+        reap()
+    return 1 if failures[0] else 0
+
+
+def main(argv=None):
+    """
+    Entry point of the `deescalate` command.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'inventory':
+        from .inventory import main as inventory_main
+        return inventory_main(argv[1:])
+    if argv and argv[0] == 'filecaps':
+        from .filecaps import main as filecaps_main
+        return filecaps_main(argv[1:])
+    if argv and argv[0] == 'minimize':
+        from .minimize import main as minimize_main
+        return minimize_main(argv[1:])
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.files:
+        from .identity import identities
+        identities.preload()
+
+    if args.zygote:
+        from .zygote import Zygote
+        zygote = Zygote(args.zygote, preload=[module for module in (args.preload or '').split(',') if module])
+        try:
+            zygote.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            zygote.close()
+        return 0
+
+    if args.manifest:
+        defaults = {
+            'user': args.user, 'group': args.group, 'capabilities': args.capabilities, 'ambient': args.ambient,
+            'shell': args.shell, 'dropenv': args.dropenv, 'no_set_home': args.no_set_home
+        }
+        try:
+            return run_manifest(args.manifest, args.jobs, defaults)
+        except (ValueError, IOError) as ex:
+            sys.stderr.write("%s\n" % ex)
+            return 1
+
+    if not args.command:
+        parser.error("the command is required")
+    try:
+        identity, caps, command_arguments, new_env = prepare_command(
+            args.user, args.group, args.capabilities, args.command, args.shell, args.dropenv, args.no_set_home
+        )
+        seccomp = None
+        if args.seccomp:
+            import json
+            from .seccomp import SeccompPolicy
+            with open(args.seccomp) as f:
+                seccomp = SeccompPolicy.from_dict(json.load(f))
+        landlock = None
+        if args.landlock:
+            import json
+            from .landlock import LandlockRuleset
+            with open(args.landlock) as f:
+                landlock = LandlockRuleset.from_dict(json.load(f)).build()
+    except (ValueError, IOError) as ex:
+        sys.stderr.write("%s\n" % ex)
+        return 1
+
+    from .main import lockdown_account
+    lockdown_account(identity, None, caps, ambient=args.ambient, seccomp=seccomp, landlock=landlock)
+    os.execvpe(command_arguments[0], command_arguments, new_env)
 
-command_arguments = shlex.split(command)
-if args.shell:
-    command_arguments = ["/bin/sh", "-c"] + command_arguments
-os.execvpe(command_arguments[0], command_arguments, new_env)
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Compiler of seccomp policies into classic BPF programs
+
+import json
+import errno
+import struct
+import hashlib
+from collections import namedtuple
+
+from .syscalls import AUDIT_ARCHES, machine, syscall_number
+
+SECCOMP_RET_KILL_PROCESS = 0x80000000
+SECCOMP_RET_KILL_THREAD = 0x00000000
+SECCOMP_RET_TRAP = 0x00030000
+SECCOMP_RET_ERRNO = 0x00050000
+SECCOMP_RET_LOG = 0x7ffc0000
+SECCOMP_RET_ALLOW = 0x7fff0000
+
+# the instructions used by the compiler (linux/bpf_common.h)
+BPF_LD_W_ABS = 0x20
+BPF_JMP_JA = 0x05
+BPF_JMP_JEQ_K = 0x15
+BPF_JMP_JGE_K = 0x35
+BPF_RET_K = 0x06
+BPF_MAXINSNS = 4096
+
+# offsets in struct seccomp_data
+_OFFSET_NR = 0
+_OFFSET_ARCH = 4
+# system calls of the x32 ABI on x86_64: same AUDIT_ARCH, with this bit set in the number
+_X32_SYSCALL_BIT = 0x40000000
+_MAX_NR = 0xFFFFFFFF
+
+# struct sock_filter
+_INSTRUCTION = struct.Struct('=HBBI')
+
+_ACTIONS = {
+    'allow': SECCOMP_RET_ALLOW,
+    'kill': SECCOMP_RET_KILL_PROCESS,
+    'kill_process': SECCOMP_RET_KILL_PROCESS,
+    'kill_thread': SECCOMP_RET_KILL_THREAD,
+    'trap': SECCOMP_RET_TRAP,
+    'log': SECCOMP_RET_LOG,
+    'errno': SECCOMP_RET_ERRNO | errno.EPERM,
+}
+
+#: relative frequencies of the system calls of an I/O heavy worker: the decision tree tests the frequent ones first
+DEFAULT_FREQUENCIES = {
+    'read': 1000, 'write': 1000, 'recvfrom': 800, 'sendto': 800, 'epoll_wait': 600, 'epoll_pwait': 600,
+    'futex': 500, 'recvmsg': 400, 'sendmsg': 400, 'readv': 300, 'writev': 300, 'pread64': 300, 'pwrite64': 300,
+    'poll': 200, 'ppoll': 200, 'io_uring_enter': 200, 'close': 150, 'openat': 100, 'fstat': 100,
+    'newfstatat': 100, 'statx': 100, 'lseek': 100, 'accept4': 80, 'epoll_ctl': 80, 'fcntl': 50, 'ioctl': 50,
+    'mmap': 30, 'munmap': 30, 'madvise': 30, 'brk': 20, 'getpid': 20, 'clock_gettime': 20, 'gettimeofday': 20,
+    'clock_nanosleep': 20, 'nanosleep': 20, 'sched_yield': 20, 'rt_sigprocmask': 20, 'getrandom': 10,
+}
+
+_programs = {}
+
+
+def action_value(action):
+    """
+    The return value of a filter for an action.
+
+    Parameters
+    ----------
+    action: str or int
+        `allow`, `kill` (the process), `kill_thread`, `trap`, `log`, `errno` (EPERM), `errno:NAME` or
+        `errno:NUMBER` (such as `errno:ENOSYS`), or a raw `SECCOMP_RET_*` value
+
+    Returns
+    -------
+    int
+
+    Raises
+    ------
+    ValueError
+        unknown action
+    """
+    if isinstance(action, int):
+        return action
+    action = action.strip().lower()
+    value = _ACTIONS.get(action)
+    if value is not None:
+        return value
+    name, _, code = action.partition(':')
+    if name == 'errno' and code:
+        number = int(code) if code.isdigit() else getattr(errno, code.upper(), None)
+        if number is not None and 0 <= number <= 0xFFFF:
+            return SECCOMP_RET_ERRNO | number
+    raise ValueError("unknown seccomp action: %s" % action)
+
+
+def _syscalls(syscalls):
+    if isinstance(syscalls, (int, str)):
+        syscalls = [syscalls] if isinstance(syscalls, int) else syscalls.replace(',', ' ').split()
+    return list(syscalls)
+
+
+class SeccompPolicy(object):
+    """
+    The action taken for each system call.
+
+    Parameters
+    ----------
+    default: str or int
+        the action for the system calls without a rule (see `action_value`)
+    frequencies: dict, optional
+        system call name -> relative frequency, used to order the decision tree (default: `DEFAULT_FREQUENCIES`).
+        A profile of the workers, such as the `calls` column of `strace -c -f`, gives the best trees
+    arch: str, optional
+        the architecture of the filter (default: the running one)
+
+    Examples
+    --------
+    >>> policy = SeccompPolicy(default='errno')
+    >>> policy.allow('read,write,close,exit_group,futex,epoll_wait')
+    >>> policy.deny('ptrace', action='kill')
+    >>> lockdown_account('www-data', caps_to_keep='net_bind_service', seccomp=policy)
+    """
+
+    def __init__(self, default='kill', frequencies=None, arch=None):
+        self.default = action_value(default)
+        self.frequencies = dict(DEFAULT_FREQUENCIES if frequencies is None else frequencies)
+        self.arch = arch or machine()
+        if self.arch not in AUDIT_ARCHES:
+            raise ValueError("unsupported architecture: %s" % self.arch)
+        self._rules = {}
+        self._digests = {}
+
+    def add(self, syscalls, action):
+        """
+        Set the action of some system calls.
+
+        Parameters
+        ----------
+        syscalls: str, int or iterable
+            names (a string may hold several, separated by commas or spaces) or numbers
+        action: str or int
+            see `action_value`
+
+        Raises
+        ------
+        ValueError
+            unknown system call or action
+        """
+        value = action_value(action)
+        for syscall in _syscalls(syscalls):
+            self._rules[syscall_number(syscall, self.arch)] = value
+        self._digests.clear()
+        return self
+
+    def allow(self, syscalls):
+        return self.add(syscalls, 'allow')
+
+    def deny(self, syscalls, action='errno'):
+        return self.add(syscalls, action)
+
+    @classmethod
+    def from_dict(cls, rules):
+        """
+        Build a policy from a dictionary.
+
+        Examples
+        --------
+        >>> SeccompPolicy.from_dict({
+        ...     'default': 'errno',
+        ...     'allow': ['read', 'write', 'exit_group'],
+        ...     'deny': {'ptrace': 'kill', 'mount': 'errno:EPERM'},
+        ... })
+        """
+        policy = cls(rules.get('default', 'kill'), rules.get('frequencies'), rules.get('arch'))
+        policy.allow(rules.get('allow', ()))
+        deny = rules.get('deny', ())
+        if isinstance(deny, dict):
+            for syscall, action in deny.items():
+                policy.deny(syscall, action)
+        else:
+            policy.deny(deny, rules.get('deny_action', 'errno'))
+        return policy
+
+    @property
+    def rules(self):
+        """
+        System call number -> return value of the filter.
+        """
+        return dict(self._rules)
+
+    def digest(self, method='tree'):
+        """
+        Hash of everything the compiled program depends on: the key of the program cache (computed once until
+        the policy changes).
+        """
+        digest = self._digests.get(method)
+        if digest is None:
+            weights = sorted(self._weights().items()) if method == 'tree' else []
+            canonical = json.dumps([self.arch, method, self.default, sorted(self._rules.items()), weights])
+            digest = self._digests[method] = hashlib.sha256(canonical.encode('ascii')).hexdigest()
+        return digest
+
+    def _weights(self):
+        weights = {}
+        for name, frequency in self.frequencies.items():
+            try:
+                number = syscall_number(name, self.arch)
+            except ValueError:
+                continue
+            weights[number] = weights.get(number, 0) + frequency
+        return weights
+
+    def compile(self, method='tree'):
+        """
+        See `compile_policy`.
+        """
+        return compile_policy(self, method)
+
+    def __repr__(self):
+        return '<SeccompPolicy arch=%s default=0x%08x (%d rules)>' % (self.arch, self.default, len(self._rules))
+
+
+class SeccompProgram(namedtuple('SeccompProgram', ('program', 'digest', 'method', 'arch', 'instructions'))):
+    """
+    A compiled seccomp filter.
+
+    Attributes
+    ----------
+    program: bytes
+        the `struct sock_filter` array
+    digest: str
+        the digest of the policy (see `SeccompPolicy.digest`)
+    method: str
+        'tree' or 'linear'
+    arch: str
+    instructions: int
+        length of the program
+    """
+    __slots__ = ()
+
+    def install(self):
+        """
+        Install the filter on the calling thread. `no_new_privs` must be set (or `CAP_SYS_ADMIN` held).
+
+        Raises
+        ------
+        OSError
+            if the kernel refuses the filter
+        """
+        from .cd import install_seccomp_filter
+        install_seccomp_filter(self.program)
+
+    def disassemble(self):
+        """
+        The program, one instruction per line.
+
+        Returns
+        -------
+        str
+        """
+        lines = []
+        for index in range(self.instructions):
+            code, jt, jf, k = _INSTRUCTION.unpack_from(self.program, index * _INSTRUCTION.size)
+            if code == BPF_LD_W_ABS:
+                text = 'ld [%d]' % k
+            elif code == BPF_JMP_JA:
+                text = 'ja %d' % (index + 1 + k)
+            elif code in (BPF_JMP_JEQ_K, BPF_JMP_JGE_K):
+                text = '%s #0x%x, %d, %d' % ('jeq' if code == BPF_JMP_JEQ_K else 'jge', k, index + 1 + jt,
+                                             index + 1 + jf)
+            elif code == BPF_RET_K:
+                text = 'ret #0x%08x' % k
+            else:
+                text = 'code 0x%02x %d %d 0x%x' % (code, jt, jf, k)
+            lines.append('%4d: %s' % (index, text))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<SeccompProgram %s %s %d instructions %s>' % (self.arch, self.method, self.instructions,
+                                                              self.digest[:12])
+
+
+def _intervals(rules, default, last):
+    # sorted (first, last, action) covering [0, last], adjacent intervals with the same action merged
+    intervals = []
+    previous = 0
+    for number in sorted(rules):
+        if number > last:
+            break
+        if number > previous:
+            intervals.append([previous, number - 1, default])
+        intervals.append([number, number, rules[number]])
+        previous = number + 1
+    if previous <= last:
+        intervals.append([previous, last, default])
+    merged = [intervals[0]]
+    for interval in intervals[1:]:
+        if interval[2] == merged[-1][2]:
+            merged[-1][1] = interval[1]
+        else:
+            merged.append(interval)
+    return merged
+
+
+def _tree(intervals):
+    # weight-balanced binary search over the intervals: the split point halves the total frequency, so that a
+    # system call of frequency p is found after about log2(1/p) comparisons
+    cumulated = [0]
+    for interval in intervals:
+        cumulated.append(cumulated[-1] + interval[3])
+
+    def emit(first, last):
+        if first == last:
+            return [(BPF_RET_K, 0, 0, intervals[first][2])]
+        total = cumulated[last + 1] - cumulated[first]
+        split, best = first + 1, None
+        for index in range(first + 1, last + 1):
+            balance = abs(2 * (cumulated[index] - cumulated[first]) - total)
+            if best is None or balance < best:
+                split, best = index, balance
+        left, right = emit(first, split - 1), emit(split, last)
+        if len(left) <= 255:
+            return [(BPF_JMP_JGE_K, len(left), 0, intervals[split][0])] + left + right
+        # conditional jumps are limited to 255 instructions
+        return [(BPF_JMP_JGE_K, 0, 1, intervals[split][0]), (BPF_JMP_JA, 0, 0, len(left))] + left + right
+
+    return emit(0, len(intervals) - 1)
+
+
+def compile_policy(policy, method='tree'):
+    """
+    Compile a policy into a classic BPF program.
+
+    The program checks the architecture, then finds the action of the system call:
+
+    - `tree`: the rules are merged into ranges of consecutive system calls with the same action, and the ranges
+      are searched by a binary tree of comparisons, balanced with the frequencies of the policy: the frequent
+      system calls need 2 or 3 comparisons, and the others about log2 of the number of ranges
+
+    - `linear`: one comparison per rule, in the order of the system call numbers, as a baseline (see
+      benchmarks/bench_seccomp.py)
+
+    The programs are cached by the digest of the policy: prefork workers and repeated lockdowns reuse them.
+
+    Parameters
+    ----------
+    policy: SeccompPolicy
+    method: str
+        'tree' or 'linear'
+
+    Returns
+    -------
+    SeccompProgram
+
+    Raises
+    ------
+    ValueError
+        if the program is too long for the kernel
+    """
+    digest = policy.digest(method)
+    program = _programs.get(digest)
+    if program is not None:
+        return program
+    instructions = [
+        (BPF_LD_W_ABS, 0, 0, _OFFSET_ARCH),
+        (BPF_JMP_JEQ_K, 1, 0, AUDIT_ARCHES[policy.arch]),
+        (BPF_RET_K, 0, 0, SECCOMP_RET_KILL_PROCESS),
+        (BPF_LD_W_ABS, 0, 0, _OFFSET_NR),
+    ]
+    last = _MAX_NR
+    if policy.arch == 'x86_64':
+        instructions.extend([(BPF_JMP_JGE_K, 0, 1, _X32_SYSCALL_BIT), (BPF_RET_K, 0, 0, SECCOMP_RET_KILL_PROCESS)])
+        last = _X32_SYSCALL_BIT - 1
+    rules = policy.rules
+    if method == 'linear':
+        for number in sorted(rules):
+            instructions.extend([(BPF_JMP_JEQ_K, 0, 1, number), (BPF_RET_K, 0, 0, rules[number])])
+        instructions.append((BPF_RET_K, 0, 0, policy.default))
+    elif method == 'tree':
+        weights = policy._weights()
+        intervals = _intervals(rules, policy.default, last)
+        for interval in intervals:
+            # every range weighs at least 1: the rare system calls still get a balanced tree
+            interval.append(1 + sum(weight for number, weight in weights.items()
+                                    if interval[0] <= number <= interval[1]))
+        instructions.extend(_tree(intervals))
+    else:
+        raise ValueError("unknown compilation method: %s" % method)
+    if len(instructions) > BPF_MAXINSNS:
+        raise ValueError("seccomp program too long: %d instructions" % len(instructions))
+    program = SeccompProgram(
+        b''.join(_INSTRUCTION.pack(*instruction) for instruction in instructions), digest, method, policy.arch,
+        len(instructions)
+    )
+    if len(_programs) >= 64:
+        _programs.clear()
+    _programs[digest] = program
+    return program
+
+
+def evaluate(program, number, arch=None):
+    """
+    Run a program on a system call number, in Python: the action the kernel would take.
+
+    Returns
+    -------
+    2-uple (int, int)
+        the return value of the filter, and the number of instructions executed
+    """
+    audit_arch = AUDIT_ARCHES[arch or program.arch]
+    accumulator, index, executed = 0, 0, 0
+    while True:
+        code, jt, jf, k = _INSTRUCTION.unpack_from(program.program, index * _INSTRUCTION.size)
+        executed += 1
+        index += 1
+        if code == BPF_LD_W_ABS:
+            accumulator = number if k == _OFFSET_NR else audit_arch
+        elif code == BPF_JMP_JA:
+            index += k
+        elif code == BPF_JMP_JEQ_K:
+            index += jt if accumulator == k else jf
+        elif code == BPF_JMP_JGE_K:
+            index += jt if accumulator >= k else jf
+        elif code == BPF_RET_K:
+            return k, executed
+        else:
+            raise ValueError("unknown instruction 0x%02x" % code)
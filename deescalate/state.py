@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import struct
+import binascii
+from collections import namedtuple
+
+from .cd import py_prctl, py_capget
+from .constants import C
+from .capmask import CapMask
+
+_FIELDS = ('effective', 'permitted', 'inheritable', 'bounding', 'ambient', 'securebits', 'no_new_privs', 'uids', 'gids')
+_MASK_FIELDS = ('effective', 'permitted', 'inheritable', 'bounding', 'ambient')
+# version, 5 masks, securebits, no_new_privs, 4 uids, 4 gids
+_STRUCT = struct.Struct('<B5QIB8I')
+_VERSION = 1
+
+_STATUS_FIELDS = {
+    b'CapInh': 'inheritable', b'CapPrm': 'permitted', b'CapEff': 'effective', b'CapBnd': 'bounding',
+    b'CapAmb': 'ambient', b'NoNewPrivs': 'no_new_privs', b'Uid': 'uids', b'Gid': 'gids'
+}
+
+
+class CapState(namedtuple('CapState', _FIELDS)):
+    """
+    Immutable snapshot of every privilege attribute of a thread.
+
+    Attributes
+    ----------
+    effective, permitted, inheritable, bounding, ambient: CapMask
+        the capability sets
+    securebits: int
+        the securebits
+    no_new_privs: bool
+        the `no_new_privs` flag
+    uids: 4-uple of int
+        real, effective, saved and filesystem UIDs
+    gids: 4-uple of int
+        real, effective, saved and filesystem GIDs
+
+    Notes
+    -----
+    - A CapState is hashable, and two states can be compared with `==` or `diff`.
+
+    - `to_bytes` and `to_text` give a stable compact serialization (78 bytes), read back by `from_bytes` and
+      `from_text`.
+    """
+    __slots__ = ()
+
+    def diff(self, other):
+        """
+        Compare with another state.
+
+        Returns
+        -------
+        dict
+            field name -> (value in self, value in other), only for the fields that differ
+        """
+        if self == other:
+            return {}
+        return {field: (mine, theirs) for field, mine, theirs in zip(_FIELDS, self, other) if mine != theirs}
+
+    def to_bytes(self):
+        return _STRUCT.pack(
+            _VERSION, self.effective, self.permitted, self.inheritable, self.bounding, self.ambient,
+            self.securebits, self.no_new_privs, *(tuple(self.uids) + tuple(self.gids))
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = _STRUCT.unpack(data)
+        if values[0] != _VERSION:
+            raise ValueError("unknown CapState serialization version: %s" % values[0])
+        return cls(
+            *([CapMask(mask) for mask in values[1:6]] + [values[6], bool(values[7]), values[8:12], values[12:16]])
+        )
+
+    def to_text(self):
+        return binascii.hexlify(self.to_bytes()).decode('ascii')
+
+    @classmethod
+    def from_text(cls, text):
+        return cls.from_bytes(binascii.unhexlify(text))
+
+
+def _parse_status(content):
+    values = {}
+    for line in content.split(b'\n'):
+        key, _, value = line.partition(b':')
+        field = _STATUS_FIELDS.get(key)
+        if field is None:
+            continue
+        if field in _MASK_FIELDS:
+            values[field] = CapMask(int(value, 16))
+        elif field == 'no_new_privs':
+            values[field] = value.strip() == b'1'
+        else:
+            values[field] = tuple(int(i) for i in value.split())
+    return values
+
+
+def _read_status():
+    try:
+        fd = os.open('/proc/thread-self/status', os.O_RDONLY)
+    except OSError:
+        return {}
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return _parse_status(b''.join(chunks))
+
+
+def _read_ambient():
+    ambient = 0
+    try:
+        for i in C.SUPPORTED_CAPS_VALUES:
+            if py_prctl(C.PRCTL[b'cap_ambient'], C.PRCTL[b'cap_ambient_is_set'], i, 0, 0) == 1:
+                ambient |= 1 << i
+    except RuntimeError:
+        # kernel without ambient capabilities
+        return CapMask(0)
+    return CapMask(ambient)
+
+
+def snapshot():
+    """
+    Take a snapshot of the privileges of the calling thread.
+
+    The capability sets, the `no_new_privs` flag and the IDs are all read from `/proc/thread-self/status`, plus
+    one `prctl` for the securebits. Without `/proc`, the same information is gathered with syscalls.
+
+    Returns
+    -------
+    CapState
+    """
+    values = _read_status()
+    if 'effective' not in values:
+        values['effective'], values['permitted'], values['inheritable'] = py_capget()
+    if 'bounding' not in values:
+        from .main import bounding_set
+        values['bounding'] = bounding_set._get_mask()
+    if 'ambient' not in values:
+        values['ambient'] = _read_ambient()
+    if 'no_new_privs' not in values:
+        values['no_new_privs'] = py_prctl(C.PRCTL[b'get_no_new_privs'], 0, 0, 0, 0) == 1
+    if 'uids' not in values:
+        ruid, euid, suid = os.getresuid()
+        values['uids'] = (ruid, euid, suid, euid)
+    if 'gids' not in values:
+        rgid, egid, sgid = os.getresgid()
+        values['gids'] = (rgid, egid, sgid, egid)
+    values['securebits'] = py_prctl(C.PRCTL[b'get_securebits'], 0, 0, 0, 0)
+    return CapState(**values)
@@ -5,6 +5,7 @@ __author__ = 'stephane.martin_github@vesperal.eu'
 import pwd
 import grp
 from .constants import C
+from .capmask import caps_to_mask
 
 try:
     basestring
@@ -17,32 +18,31 @@ except NameError:
     unicode = str
 
 def normalize_list_of_caps(list_of_caps):
-    if list_of_caps is None:
-        return set()
-    if isinstance(list_of_caps, basestring):
-        list_of_caps = list_of_caps.lower().strip()
-        if not list_of_caps:
-            return set()
-        list_of_caps = list_of_caps.split(',')
-    list_of_caps = {cap.encode('ascii') if isinstance(cap, unicode) else cap for cap in list_of_caps}
-    list_of_caps = {cap.lower().strip() if isinstance(cap, bytes) else cap for cap in list_of_caps}
-    list_of_caps = {C.SUPPORTED_CAPS.get(cap) if isinstance(cap, bytes) else cap for cap in list_of_caps}
-    list_of_caps = {None if isinstance(cap, int) and cap not in C.SUPPORTED_CAPS_VALUES else cap for cap in list_of_caps}
-    list_of_caps = {cap for cap in list_of_caps if cap is not None}
-    return set(list_of_caps)
+    return set(caps_to_mask(list_of_caps))
+
+
+def nss_name(name):
+    """
+    Convert a user or group name to the native string type that `pwd` and `grp` want.
+    """
+    if isinstance(name, bytes) and not isinstance(name, str):
+        return name.decode('utf-8')
+    if isinstance(name, unicode) and not isinstance(name, str):
+        return name.encode('utf-8')
+    return name
 
 
 def normalize_uid(uid):
-    return uid if isinstance(uid, int) else pwd.getpwnam(bytes(uid)).pw_uid
+    return uid if isinstance(uid, int) else pwd.getpwnam(nss_name(uid)).pw_uid
 
 
 def normalize_gid(uid, gid):
     if gid is not None:
-        return gid if isinstance(gid, int) else grp.getgrnam(bytes(gid)).gr_gid
+        return gid if isinstance(gid, int) else grp.getgrnam(nss_name(gid)).gr_gid
     elif isinstance(uid, int):
         return pwd.getpwuid(uid).pw_gid
     else:
-        return pwd.getpwnam(bytes(uid)).pw_gid
+        return pwd.getpwnam(nss_name(uid)).pw_gid
 
 
 def capset_string_to_flag(capset):
@@ -57,3 +57,21 @@ def capset_string_to_flag(capset):
         return C.FLAGS[capset.lower().strip()]
     raise ValueError()
 
+
+def percentiles(samples):
+    """
+    Summarize latency samples.
+
+    Returns
+    -------
+    4-uple of float
+        mean, median, 99th percentile and maximum (zeros without samples)
+    """
+    if not samples:
+        return 0.0, 0.0, 0.0, 0.0
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+    return (
+        float(sum(ordered)) / len(ordered), ordered[last // 2], ordered[min(last, int(round(last * 0.99)))],
+        ordered[last]
+    )
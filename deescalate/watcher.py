@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Watcher of the capability changes, driven by the kernel proc connector (python 3 only, so it is not imported by
+# the package).
+
+import os
+import time
+import errno
+import socket
+import struct
+import asyncio
+from collections import namedtuple, deque
+
+from .capmask import CapMask, caps_to_mask
+from .inventory import parse_status, read_file, mask_names
+from .utils import percentiles
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+NLMSG_DONE = 3
+
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_UID = 0x00000004
+PROC_EVENT_GID = 0x00000040
+
+_EVENT_KINDS = {PROC_EVENT_FORK: 'fork', PROC_EVENT_EXEC: 'exec', PROC_EVENT_UID: 'uid', PROC_EVENT_GID: 'gid'}
+_NLMSGHDR = struct.Struct('=IHHII')
+_CN_MSG = struct.Struct('=IIIIHH')
+# what, cpu, timestamp_ns, then the first 4 words of the event data
+_PROC_EVENT = struct.Struct('=IIQIIII')
+_HEADER_SIZE = _NLMSGHDR.size + _CN_MSG.size
+
+#: statistics of a `Watcher` (the latencies are in seconds, from the kernel event to the checked `CapEvent`)
+WatcherStats = namedtuple('WatcherStats', ('events', 'checked', 'violations', 'vanished', 'overruns', 'mean', 'p50',
+                                           'p99', 'max'))
+
+
+class CapEvent(namedtuple('CapEvent', ('kind', 'pid', 'tgid', 'executable', 'uids', 'effective', 'permitted',
+                                       'bounding', 'violations', 'latency'))):
+    """
+    A task that executed a program, changed its UID or GID, or was forked, with its capabilities at that time.
+
+    Attributes
+    ----------
+    kind: str
+        'exec', 'uid', 'gid' or 'fork'
+    pid, tgid: int
+        thread and process IDs (of the child, for a fork)
+    executable: str or None
+        the program of the process, when the policy has rules per executable (None if it could not be read, as
+        in a child that has not executed a program yet)
+    uids: 4-uple of int
+    effective, permitted, bounding: CapMask
+    violations: dict
+        capability set name -> names of the capabilities the policy does not allow (empty if the task complies)
+    latency: float
+        seconds between the kernel event and the end of its check
+    """
+    __slots__ = ()
+
+
+class WatchPolicy(object):
+    """
+    The capabilities allowed in the effective and bounding sets, per executable or per user.
+
+    The rule of the executable is used first, then the rule of the effective UID, then the default rule. A task
+    without a rule is not checked.
+
+    Examples
+    --------
+    >>> policy = WatchPolicy(default={'effective': '', 'bounding': None})
+    >>> policy.allow(executable='/usr/sbin/nginx', effective='net_bind_service')
+    >>> policy.allow(user=0, effective=None)
+    """
+
+    def __init__(self, default=None):
+        self._executables = {}
+        self._users = {}
+        self._default = self._rule(**default) if default is not None else None
+
+    @staticmethod
+    def _rule(effective=None, bounding=None):
+        # None: anything is allowed
+        return (None if effective is None else caps_to_mask(effective),
+                None if bounding is None else caps_to_mask(bounding))
+
+    def allow(self, executable=None, user=None, effective=None, bounding=None):
+        """
+        Add a rule.
+
+        Parameters
+        ----------
+        executable: str, optional
+            absolute path of the program
+        user: int or str, optional
+            effective UID or user name
+        effective, bounding: CapMask, str or list, optional
+            the capabilities allowed in each set (None: anything)
+        """
+        rule = self._rule(effective, bounding)
+        if executable is not None:
+            self._executables[executable] = rule
+        elif user is not None:
+            if not isinstance(user, int):
+                from .identity import resolve_identity
+                user = resolve_identity(user).uid
+            self._users[user] = rule
+        else:
+            self._default = rule
+        return self
+
+    @classmethod
+    def from_dict(cls, rules):
+        """
+        Build a policy from a dictionary.
+
+        Examples
+        --------
+        >>> WatchPolicy.from_dict({
+        ...     'default': {'effective': ''},
+        ...     'executables': {'/usr/sbin/nginx': {'effective': 'net_bind_service'}},
+        ...     'users': {'root': {}},
+        ... })
+        """
+        policy = cls(rules.get('default'))
+        for executable, rule in rules.get('executables', {}).items():
+            policy.allow(executable=executable, **rule)
+        for user, rule in rules.get('users', {}).items():
+            policy.allow(user=int(user) if str(user).isdigit() else user, **rule)
+        return policy
+
+    @property
+    def needs_executable(self):
+        return bool(self._executables)
+
+    def check(self, executable, euid, effective, bounding):
+        """
+        Returns
+        -------
+        dict
+            capability set name -> names of the capabilities that are not allowed
+        """
+        rule = self._executables.get(executable) if executable is not None else None
+        if rule is None:
+            rule = self._users.get(euid, self._default)
+        if rule is None:
+            return {}
+        violations = {}
+        for name, allowed, mask in (('effective', rule[0], effective), ('bounding', rule[1], bounding)):
+            if allowed is not None and mask & ~allowed:
+                violations[name] = mask_names(mask & ~allowed)
+        return violations
+
+
+def _subscription(operation):
+    payload = struct.pack('=I', operation)
+    message = _CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0) + payload
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(message), NLMSG_DONE, 0, 0, 0) + message
+
+
+class Watcher(object):
+    """
+    Asynchronous iterator over the capability changes of the tasks of the host.
+
+    The watcher subscribes to the proc connector of the kernel (it needs `CAP_NET_ADMIN`), and for each
+    exec, UID change, GID change or fork event, reads the capabilities of that task only, and checks them with the
+    policy.
+
+    Parameters
+    ----------
+    policy: WatchPolicy, optional
+        the rules (default: no rule, the events are only reported)
+    kinds: iterable of str
+        the events to watch, among 'exec', 'uid', 'gid' and 'fork'
+    only_violations: bool
+        only yield the events of the tasks that break the policy
+    maxsize: int
+        maximum number of checked events waiting for the consumer. When it is reached, the watcher stops reading
+        the netlink socket until the consumer catches up; if the kernel buffer overflows meanwhile, the lost
+        events are counted in `WatcherStats.overruns`
+    proc: str
+        the proc filesystem
+
+    Examples
+    --------
+    >>> async with Watcher(policy, only_violations=True) as watcher:
+    ...     async for event in watcher:
+    ...         print(event.kind, event.pid, event.executable, event.violations)
+    """
+
+    def __init__(self, policy=None, kinds=('exec', 'uid', 'gid', 'fork'), only_violations=False, maxsize=1024,
+                 proc='/proc'):
+        self.policy = policy or WatchPolicy()
+        self._kinds = frozenset(what for what, kind in _EVENT_KINDS.items() if kind in kinds)
+        self._only_violations = only_violations
+        self._maxsize = maxsize
+        self._proc = proc
+        self._sock = None
+        self._loop = None
+        self._queue = deque()
+        self._waiter = None
+        self._reading = False
+        self._error = None
+        self._events = self._checked = self._violations = self._vanished = self._overruns = 0
+        self._latencies = deque(maxlen=4096)
+
+    def start(self):
+        """
+        Subscribe to the proc connector. Must be called from the event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            self._sock.bind((0, CN_IDX_PROC))
+            self._sock.send(_subscription(PROC_CN_MCAST_LISTEN))
+            self._sock.setblocking(False)
+        except BaseException:
+            self._sock.close()
+            self._sock = None
+            raise
+        self._resume()
+        return self
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._pause()
+        try:
+            self._sock.send(_subscription(PROC_CN_MCAST_IGNORE))
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+        self._wake()
+
+    async def __aenter__(self):
+        return self.start()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            if self._sock is None:
+                raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        event = self._queue.popleft()
+        if not self._reading and self._sock is not None and len(self._queue) <= self._maxsize // 2:
+            self._resume()
+        return event
+
+    def stats(self):
+        """
+        Returns
+        -------
+        WatcherStats
+        """
+        return WatcherStats(self._events, self._checked, self._violations, self._vanished, self._overruns,
+                            *percentiles(self._latencies))
+
+    def _pause(self):
+        if self._reading:
+            self._loop.remove_reader(self._sock.fileno())
+            self._reading = False
+
+    def _resume(self):
+        if not self._reading:
+            self._loop.add_reader(self._sock.fileno(), self._on_readable)
+            self._reading = True
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _on_readable(self):
+        while len(self._queue) < self._maxsize:
+            try:
+                data = self._sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as ex:
+                if ex.errno == errno.ENOBUFS:
+                    # the kernel dropped events: the socket buffer overflowed
+                    self._overruns += 1
+                    continue
+                self._error = ex
+                self._pause()
+                break
+            event = self._decode(data)
+            if event is not None:
+                self._queue.append(event)
+        else:
+            # backpressure: stop reading until the consumer catches up
+            self._pause()
+        if self._queue or self._error is not None:
+            self._wake()
+
+    def _decode(self, data):
+        if len(data) < _HEADER_SIZE + _PROC_EVENT.size:
+            return None
+        what, _, timestamp, first, second, third, fourth = _PROC_EVENT.unpack_from(data, _HEADER_SIZE)
+        if what not in self._kinds:
+            return None
+        self._events += 1
+        if what == PROC_EVENT_FORK:
+            pid, tgid = third, fourth
+        else:
+            pid, tgid = first, second
+        return self._check(_EVENT_KINDS[what], pid, tgid, timestamp)
+
+    def _check(self, kind, pid, tgid, timestamp):
+        content = read_file('%s/%d/task/%d/status' % (self._proc, tgid, pid))
+        fields = parse_status(content) if content is not None else {}
+        if b'CapEff' not in fields or b'Uid' not in fields:
+            # the task is already gone
+            self._vanished += 1
+            return None
+        uids = tuple(int(i) for i in fields[b'Uid'].split())
+        effective, permitted, bounding = (
+            CapMask(int(fields.get(key, b'0'), 16)) for key in (b'CapEff', b'CapPrm', b'CapBnd')
+        )
+        executable = None
+        if self.policy.needs_executable:
+            try:
+                executable = os.readlink('%s/%d/exe' % (self._proc, tgid))
+            except OSError:
+                pass
+        violations = self.policy.check(executable, uids[1], effective, bounding)
+        # the kernel timestamps the events with CLOCK_MONOTONIC
+        latency = max(0, time.monotonic_ns() - timestamp) / 1e9
+        self._latencies.append(latency)
+        self._checked += 1
+        if violations:
+            self._violations += 1
+        elif self._only_violations:
+            return None
+        return CapEvent(kind, pid, tgid, executable, uids, effective, permitted, bounding, violations, latency)
+
+
+async def watch(policy=None, **kwargs):
+    """
+    Shortcut: iterate over the events of a started `Watcher`.
+
+    Examples
+    --------
+    >>> async for event in watch(policy, only_violations=True):
+    ...     alert(event)
+    """
+    watcher = Watcher(policy, **kwargs).start()
+    try:
+        async for event in watcher:
+            yield event
+    finally:
+        watcher.close()
@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Zygote: a privileged, pre-warmed launcher that starts locked down processes on request (python 3 only, so it is
+# not imported by the package).
+
+import os
+import sys
+import errno
+import socket
+import struct
+import asyncio
+import selectors
+from collections import namedtuple
+
+from .process import spawn
+from .fdpass import MAX_MESSAGE, ancillary_space, send_message as _send, parse_message as _parse
+from .fdpass import recv_message
+
+_FDS_SPACE = ancillary_space(3)
+
+#: statistics of a `Zygote`
+ZygoteStats = namedtuple('ZygoteStats', ('launches', 'failures', 'running', 'identities'))
+
+
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def _check_request(request):
+    """
+    Check the types of the fields of a launch request.
+
+    Raises
+    ------
+    ValueError
+        if the request is not valid
+    """
+    if not isinstance(request, dict):
+        raise ValueError("the request must be a JSON object")
+    argv = request.get('argv')
+    if argv is not None and not _is_str_list(argv):
+        raise ValueError("argv must be a list of strings")
+    if not request.get('module') and not argv:
+        raise ValueError("No command to run")
+    env = request.get('env')
+    if env is not None and not (isinstance(env, dict) and all(
+            isinstance(key, str) and isinstance(value, str) for key, value in env.items())):
+        raise ValueError("env must be an object of strings")
+    for name in ('cwd', 'module'):
+        if request.get(name) is not None and not isinstance(request[name], str):
+            raise ValueError("%s must be a string" % name)
+    for name in ('user', 'group'):
+        value = request.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, str))):
+            raise ValueError("%s must be a name or an integer" % name)
+    capabilities = request.get('capabilities')
+    if capabilities is not None and not isinstance(capabilities, str) and not _is_str_list(capabilities):
+        raise ValueError("capabilities must be a string or a list of strings")
+
+
+def _pidfd_open(pid):
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+class Zygote(object):
+    """
+    Pre-warmed launcher of locked down processes.
+
+    The zygote listens on a Unix socket. It receives launch requests (argv or python module, user, group,
+    capabilities, environment...) and starts a locked down child for each one. NSS lookups and lockdown plans are
+    computed once per identity, and the modules given in `preload` are imported once in the zygote, so that a
+    python task started with `module` only pays for a fork.
+
+    Parameters
+    ----------
+    path: str
+        path of the Unix socket
+    allowed_uids: iterable of int, optional
+        UIDs of the clients allowed to send requests (default: root and the UID of the zygote)
+    preload: iterable of str
+        modules imported at startup
+    mode: int
+        permissions of the socket file
+
+    Notes
+    -----
+    - The protocol uses a `SOCK_SEQPACKET` socket: each request and each response is one JSON object. A request may
+      carry up to 3 file descriptors (`SCM_RIGHTS`), used as stdin, stdout and stderr of the child.
+
+    - A request has an `id`, and either `argv` (the command is executed) or `module` (the module is run in the
+      forked zygote, with `sys.argv` set to `argv`), and optionally `user`, `group`, `capabilities`, `ambient`,
+      `env` and `cwd`. With `wait`, the response comes when the child terminates and gives its `returncode` (null
+      if the exit status is unknown); otherwise the response gives the `pid` and carries a pidfd of the child.
+
+    - The zygote can give any identity and capability to its children: the socket is only accessible to its
+      owner, and the UID of each client is checked.
+    """
+
+    def __init__(self, path, allowed_uids=None, preload=(), mode=0o600):
+        import importlib
+        self.path = path
+        self.allowed_uids = set(allowed_uids) if allowed_uids is not None else {0, os.geteuid()}
+        for module in preload:
+            importlib.import_module(module)
+        self._mode = mode
+        self._identities = {}
+        self._children = {}
+        self._selector = None
+        self._listener = None
+        self._launches = self._failures = 0
+
+    def bind(self):
+        """
+        Create the listening socket.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        old_umask = os.umask(0o177)
+        try:
+            self._listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.path, self._mode)
+        self._listener.listen(128)
+        self._listener.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ, ('accept', None))
+
+    def serve_forever(self):
+        """
+        Bind the socket if needed, and handle the requests until `close` is called.
+        """
+        if self._listener is None:
+            self.bind()
+        while self._selector is not None:
+            events = self._selector.select(None if self._pidfds_available() else 0.05)
+            for key, _ in events:
+                kind, data = key.data
+                if kind == 'accept':
+                    self._accept()
+                elif kind == 'client':
+                    self._handle(key.fileobj)
+                elif kind == 'child':
+                    self._reap(data)
+            if not self._pidfds_available():
+                for pid in list(self._children):
+                    self._reap(pid)
+
+    def _pidfds_available(self):
+        return hasattr(os, 'pidfd_open')
+
+    def close(self):
+        """
+        Stop serving and remove the socket. The running children are not killed.
+        """
+        if self._selector is None:
+            return
+        for key in list(self._selector.get_map().values()):
+            if key.data[0] != 'child':
+                key.fileobj.close()
+            else:
+                os.close(key.fd)
+        self._selector.close()
+        self._selector = None
+        self._listener = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def clear_cache(self):
+        """
+        Forget the resolved identities and their lockdown plans (after a change in the user database).
+        """
+        from .identity import identities
+        identities.clear()
+        self._identities.clear()
+
+    def stats(self):
+        """
+        Return the statistics of the zygote.
+
+        Returns
+        -------
+        ZygoteStats
+        """
+        return ZygoteStats(self._launches, self._failures, len(self._children), len(self._identities))
+
+    def _accept(self):
+        try:
+            conn, _ = self._listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        if uid not in self.allowed_uids:
+            conn.close()
+            return
+        # a client that does not read its responses must not block the zygote
+        conn.setblocking(False)
+        self._selector.register(conn, selectors.EVENT_READ, ('client', None))
+
+    def _handle(self, conn):
+        try:
+            request, fds = recv_message(conn, 3)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError):
+            request, fds = None, []
+        if request is None:
+            self._drop_client(conn)
+            return
+        try:
+            _check_request(request)
+            self._launch(conn, request, fds)
+        except (OSError, ValueError, RuntimeError, KeyError, TypeError) as ex:
+            self._failures += 1
+            response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': str(ex)}
+            if isinstance(ex, OSError) and ex.errno:
+                response['error'] = ex.strerror
+                response['errno'] = ex.errno
+            self._respond(conn, response)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _drop_client(self, conn):
+        self._selector.unregister(conn)
+        conn.close()
+        for pid, (client, request_id, pidfd) in list(self._children.items()):
+            if client is conn:
+                self._children[pid] = (None, request_id, pidfd)
+
+    def _respond(self, conn, response, fds=()):
+        if conn is None:
+            return
+        try:
+            _send(conn, response, fds)
+        except BlockingIOError:
+            # the client does not read its responses: hang up, it is dropped at the next read
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        except OSError:
+            # the client went away
+            pass
+
+    def _identity(self, request):
+        capabilities = request.get('capabilities')
+        if isinstance(capabilities, list):
+            capabilities = ','.join(capabilities)
+        key = (request.get('user'), request.get('group'), capabilities, bool(request.get('ambient')))
+        identity = self._identities.get(key)
+        if identity is None:
+            from .capmask import caps_to_mask
+            from .identity import resolve_identity
+            from .plan import plan_lockdown
+            resolved = None
+            if key[0] is not None or key[1] is not None:
+                try:
+                    resolved = resolve_identity(key[0], key[1])
+                except KeyError as ex:
+                    raise ValueError(ex.args[0])
+            plan = plan_lockdown(resolved, None, caps_to_mask(capabilities or '', strict=True), key[3]).compile()
+            identity = self._identities[key] = (plan, resolved)
+        return identity
+
+    def _environment(self, request, resolved):
+        env = request.get('env')
+        if env is not None:
+            return env
+        env = os.environ.copy()
+        if resolved is not None and resolved.name is not None:
+            env['HOME'] = resolved.home
+            env['USER'] = env['USERNAME'] = env['LOGNAME'] = resolved.name
+        env.pop('MAIL', None)
+        return env
+
+    def _launch(self, conn, request, fds):
+        plan, resolved = self._identity(request)
+        env = self._environment(request, resolved)
+        argv = request.get('argv') or []
+        stdio = (list(fds) + [None, None, None])[:3]
+        if request.get('module'):
+            pid = self._fork_module(plan, request['module'], argv, env, request.get('cwd'), stdio)
+        else:
+            pid = spawn(argv, plan=plan, env=env, cwd=request.get('cwd'),
+                        stdin=stdio[0], stdout=stdio[1], stderr=stdio[2]).pid
+        self._launches += 1
+        pidfd = _pidfd_open(pid)
+        if pidfd is not None:
+            self._selector.register(pidfd, selectors.EVENT_READ, ('child', pid))
+        if request.get('wait'):
+            self._children[pid] = (conn, request.get('id'), pidfd)
+            return
+        self._children[pid] = (None, None, pidfd)
+        self._respond(conn, {'id': request.get('id'), 'pid': pid}, [pidfd] if pidfd is not None else [])
+
+    def _fork_module(self, plan, module, argv, env, cwd, stdio):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        code = 1
+        try:
+            for key in list(self._selector.get_map().values()):
+                os.close(key.fd)
+            for index, fd in enumerate(stdio):
+                if fd is not None:
+                    os.dup2(fd, index)
+            if cwd is not None:
+                os.chdir(cwd)
+            plan.apply()
+            os.environ.clear()
+            os.environ.update(env)
+            sys.argv = list(argv) or [module]
+            import runpy
+            runpy.run_module(module, run_name='__main__', alter_sys=True)
+            code = 0
+        except SystemExit as ex:
+            if ex.code is None or isinstance(ex.code, int):
+                code = ex.code or 0
+            else:
+                sys.stderr.write('%s\n' % ex.code)
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def _reap(self, pid):
+        try:
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            # reaped by someone else: the exit status is lost
+            reaped, status = pid, None
+        if reaped != pid:
+            return
+        conn, request_id, pidfd = self._children.pop(pid)
+        if pidfd is not None:
+            self._selector.unregister(pidfd)
+            os.close(pidfd)
+        if conn is not None:
+            if status is None:
+                returncode = None
+            else:
+                returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            self._respond(conn, {'id': request_id, 'pid': pid, 'returncode': returncode})
+
+
+class Launched(object):
+    """
+    A child started by a zygote, without waiting for it.
+
+    Attributes
+    ----------
+    pid: int
+        PID of the child
+    pidfd: int or None
+        pidfd of the child (None on kernels without pidfds); it becomes readable when the child terminates
+    """
+
+    def __init__(self, pid, pidfd):
+        self.pid = pid
+        self.pidfd = pidfd
+
+    def fileno(self):
+        return self.pidfd
+
+    def wait(self, timeout=None):
+        """
+        Wait for the child to terminate (the exit status is only known by the zygote).
+
+        Without a pidfd, the child is polled with `waitpid` (when it is a child of the caller) or `kill(pid, 0)`.
+
+        Returns
+        -------
+        bool
+            False if the child is still running after `timeout` seconds
+        """
+        if self.pidfd is None:
+            return self._poll_pid(timeout)
+        import select
+        poller = select.poll()
+        poller.register(self.pidfd, select.POLLIN)
+        return bool(poller.poll(None if timeout is None else int(timeout * 1000)))
+
+    def _poll_pid(self, timeout):
+        import time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            try:
+                if os.waitpid(self.pid, os.WNOHANG)[0] == self.pid:
+                    return True
+            except ChildProcessError:
+                # not our child: the zygote reaps it
+                try:
+                    os.kill(self.pid, 0)
+                except ProcessLookupError:
+                    return True
+                except PermissionError:
+                    pass
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(delay if deadline is None else max(0, min(delay, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.05)
+
+    def close(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def __repr__(self):
+        return '<Launched pid=%s>' % self.pid
+
+
+def _request(request_id, argv, user, group, capabilities, ambient, env, cwd, module, wait):
+    request = {'id': request_id, 'argv': [str(arg) for arg in (argv or [])], 'wait': bool(wait)}
+    for name, value in (('user', user), ('group', group), ('capabilities', capabilities), ('env', env),
+                        ('cwd', cwd), ('module', module)):
+        if value is not None:
+            request[name] = value
+    if ambient:
+        request['ambient'] = True
+    return request
+
+
+def _result(response, fds):
+    if 'error' in response:
+        for fd in fds:
+            os.close(fd)
+        if response.get('errno'):
+            raise OSError(response['errno'], response['error'])
+        raise RuntimeError(response['error'])
+    if 'returncode' in response:
+        return response['returncode']
+    return Launched(response['pid'], fds[0] if fds else None)
+
+
+class ZygoteClient(object):
+    """
+    Client of a `Zygote`.
+
+    Parameters
+    ----------
+    path: str
+        path of the Unix socket of the zygote
+
+    Examples
+    --------
+    >>> client = ZygoteClient('/run/deescalate.sock')
+    >>> client.launch(['/usr/bin/convert', 'a.png', 'a.jpg'], user='nobody', wait=True)
+    0
+    >>> client.launch(['task'], module='tasks.resize', user='worker', stdio=(0, 1, 2)).wait()
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self.sock.connect(path)
+        except BaseException:
+            self.sock.close()
+            raise
+        self._next_id = 0
+
+    def launch(self, argv=None, user=None, group=None, capabilities=None, ambient=False, env=None, cwd=None,
+               module=None, stdio=(), wait=False):
+        """
+        Ask the zygote to start a locked down child.
+
+        Parameters
+        ----------
+        argv: list of str
+            the command, or `sys.argv` of the module
+        user, group, capabilities, ambient: optional
+            the lockdown of the child (see `lockdown_account`)
+        env: dict, optional
+            environment of the child (default: the environment of the zygote, with the HOME and USER of `user`)
+        cwd: str, optional
+            working directory of the child
+        module: str, optional
+            run this python module in the forked zygote instead of executing `argv`
+        stdio: tuple of int
+            file descriptors to use as stdin, stdout and stderr in the child
+        wait: bool
+            wait for the child to terminate
+
+        Returns
+        -------
+        int or Launched
+            the exit status of the child if `wait` (None if the zygote could not get it), else a `Launched` child
+
+        Raises
+        ------
+        OSError
+            if the child could not be started
+        RuntimeError
+            if the zygote refused the request
+        """
+        self._next_id += 1
+        _send(self.sock, _request(self._next_id, argv, user, group, capabilities, ambient, env, cwd, module, wait),
+              stdio)
+        response, fds = recv_message(self.sock, 3)
+        if response is None:
+            raise RuntimeError("the zygote closed the connection")
+        return _result(response, fds)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class AsyncZygoteClient(object):
+    """
+    asyncio client of a `Zygote`: many requests can be in flight on the same connection.
+
+    Examples
+    --------
+    >>> client = await AsyncZygoteClient.connect('/run/deescalate.sock')
+    >>> statuses = await asyncio.gather(*(client.launch(['true'], user='nobody', wait=True) for _ in range(100)))
+    """
+
+    def __init__(self, sock, loop):
+        self.sock = sock
+        self._loop = loop
+        self._pending = {}
+        self._next_id = 0
+        self._writable = None
+        loop.add_reader(sock.fileno(), self._on_readable)
+
+    @classmethod
+    async def connect(cls, path):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.setblocking(False)
+        await loop.sock_connect(sock, path)
+        return cls(sock, loop)
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, ancillary, flags, _ = self.sock.recvmsg(MAX_MESSAGE, _FDS_SPACE, socket.MSG_CMSG_CLOEXEC)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                self._fail_all(ex)
+                return
+            if not data:
+                self._fail_all(RuntimeError("the zygote closed the connection"))
+                return
+            response, fds = _parse(data, ancillary, flags)
+            future = self._pending.pop(response.get('id'), None)
+            if future is None or future.done():
+                for fd in fds:
+                    os.close(fd)
+                continue
+            try:
+                future.set_result(_result(response, fds))
+            except (OSError, RuntimeError) as ex:
+                future.set_exception(ex)
+
+    def _fail_all(self, exception):
+        self._loop.remove_reader(self.sock.fileno())
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    async def _sendmsg(self, request, stdio):
+        while True:
+            try:
+                return _send(self.sock, request, stdio)
+            except (BlockingIOError, InterruptedError):
+                # every sender waits for the same writer callback
+                if self._writable is None or self._writable.done():
+                    self._writable = self._loop.create_future()
+                    self._loop.add_writer(self.sock.fileno(), self._on_writable)
+                await asyncio.shield(self._writable)
+
+    def _on_writable(self):
+        self._loop.remove_writer(self.sock.fileno())
+        if not self._writable.done():
+            self._writable.set_result(None)
+
+    async def launch(self, argv=None, user=None, group=None, capabilities=None, ambient=False, env=None, cwd=None,
+                     module=None, stdio=(), wait=False):
+        """
+        Ask the zygote to start a locked down child (see `ZygoteClient.launch`).
+        """
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._pending[request_id] = self._loop.create_future()
+        try:
+            await self._sendmsg(
+                _request(request_id, argv, user, group, capabilities, ambient, env, cwd, module, wait), stdio
+            )
+        except BaseException:
+            self._pending.pop(request_id, None)
+            raise
+        return await future
+
+    async def wait_exit(self, launched):
+        """
+        Wait for a `Launched` child to terminate, without blocking the event loop.
+        """
+        exited = self._loop.create_future()
+        self._loop.add_reader(launched.pidfd, exited.set_result, None)
+        try:
+            await exited
+        finally:
+            self._loop.remove_reader(launched.pidfd)
+
+    def close(self):
+        self._fail_all(RuntimeError("client closed"))
+        self.sock.close()
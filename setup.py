@@ -9,6 +9,8 @@ import subprocess
 from os.path import dirname, abspath, join, commonprefix, exists
 
 on_rtd = os.environ.get('READTHEDOCS', None) == 'True'
+# build an extension that does not link with libcap (capability names then come from a builtin table)
+without_libcap = os.environ.get('DEESCALATE_WITHOUT_LIBCAP', '') not in ('', '0')
 here = abspath(dirname(__file__))
 
 def check_gcc():
@@ -65,7 +67,7 @@ if __name__ == "__main__":
                 if not check_prctl():
                     sys.stderr.write("You need to install libc development headers (eg libc6-dev)")
                     sys.exit(1)
-                if not check_lipcap():
+                if not without_libcap and not check_lipcap():
                     sys.stderr.write("You need to install libcap development headers (eg libcap-dev)")
                     sys.exit(1)
 
@@ -92,7 +94,8 @@ if __name__ == "__main__":
         deescalate_extension = Extension(
             name="deescalate.cd",
             sources=["deescalate/cd.pyx"],
-            libraries=["cap"] if not dummy else []
+            libraries=["cap"] if not (dummy or without_libcap) else [],
+            define_macros=[('DEESCALATE_WITHOUT_LIBCAP', '1')] if without_libcap else []
         )
         extensions.append(deescalate_extension)
 
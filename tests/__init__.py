@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Most operations change the privileges of the calling process for good: the tests run them in forked children
+# (see `in_child`). Run the suite with `python -m tests` to get the capabilities from a user namespace.
+
+import os
+import pickle
+import unittest
+import traceback
+
+from deescalate import snapshot
+from deescalate.main import is_linux
+
+_NEEDED = (b'setpcap', b'setuid', b'setgid')
+
+
+def _has_privileges():
+    if not is_linux:
+        return False
+    permitted = snapshot().permitted
+    return all(cap in permitted for cap in _NEEDED)
+
+
+#: skip a test unless the process may change its capabilities, UIDs and GIDs
+privileged = unittest.skipUnless(_has_privileges(), "needs CAP_SETPCAP, CAP_SETUID and CAP_SETGID (python -m tests)")
+#: skip a test when not on Linux
+linux_only = unittest.skipUnless(is_linux, "Linux only")
+
+
+class ChildError(AssertionError):
+    """
+    An exception raised in a child started by `in_child`, with its traceback.
+    """
+
+
+def in_child(function, *args, **kwargs):
+    """
+    Call `function` in a forked child, and return its (picklable) result.
+
+    Raises
+    ------
+    ChildError
+        if the function raised, or if the child died
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read_end)
+            try:
+                payload = (True, function(*args, **kwargs))
+            except BaseException:
+                payload = (False, traceback.format_exc())
+            with os.fdopen(write_end, 'wb') as f:
+                pickle.dump(payload, f, 2)
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if not data:
+        raise ChildError("the child died (status %d)" % status)
+    succeeded, result = pickle.loads(data)
+    if not succeeded:
+        raise ChildError("in the child:\n" + result)
+    return result
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the test suite inside a new user namespace, as a mapped root::
+
+    python -m tests [-v] [test names]
+
+Set `DEESCALATE_NO_USERNS=1` to run it in the current namespace (the privileged tests are then skipped unless the
+process has the capabilities).
+"""
+
+import os
+import sys
+import unittest
+
+from .userns import reexec_in_user_namespace
+
+
+def main():
+    reexec_in_user_namespace(['-m', 'tests'] + sys.argv[1:])
+    here = os.path.dirname(os.path.abspath(__file__))
+    argv = [sys.argv[0]] + sys.argv[1:]
+    if not any(not arg.startswith('-') for arg in sys.argv[1:]):
+        argv = [sys.argv[0], 'discover', '-s', here, '-t', os.path.dirname(here)] + sys.argv[1:]
+    unittest.main(module=None, argv=argv)
+
+
+if __name__ == '__main__':
+    main()
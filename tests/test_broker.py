@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import array
+import errno
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+
+from deescalate.broker import Broker, BrokerClient, BrokerPolicy
+from . import linux_only
+
+
+@linux_only
+class TestBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'allowed'), 'w') as f:
+            f.write('hello')
+        policy = BrokerPolicy().allow_open(os.path.join(self.directory, 'allowed'))
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.client = BrokerClient(ours)
+        self.broker = Broker(policy, theirs)
+        self.thread = threading.Thread(target=self.broker.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        shutil.rmtree(self.directory)
+
+    def _send_raw(self, data, count):
+        # send `count` write ends of pipes, and return the read ends: they only reach EOF once the broker closed its
+        # copies
+        read_ends = []
+        write_ends = []
+        for _ in range(count):
+            read_end, write_end = os.pipe()
+            read_ends.append(read_end)
+            write_ends.append(write_end)
+        try:
+            self.client.sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', write_ends))])
+        finally:
+            for fd in write_ends:
+                os.close(fd)
+        return read_ends
+
+    def _assert_closed(self, read_ends):
+        # the broker drops the channel: wait for it, then every copy of the write ends must be closed
+        self.assertEqual(self.client.sock.recv(1), b'')
+        self.thread.join(5)
+        for fd in read_ends:
+            os.set_blocking(fd, False)
+            try:
+                # BlockingIOError if a copy leaked
+                self.assertEqual(os.read(fd, 1), b'')
+            finally:
+                os.close(fd)
+
+    def test_open(self):
+        with self.client.open(os.path.join(self.directory, 'allowed')) as f:
+            self.assertEqual(f.read(), 'hello')
+
+    def test_policy_denied(self):
+        with self.assertRaises(OSError) as raised:
+            self.client.open(os.path.join(self.directory, 'denied'), 'w')
+        self.assertEqual(raised.exception.errno, errno.EACCES)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'denied')))
+        self.assertEqual(self.client.stats().denied, 1)
+        self.assertEqual(self.client.server_stats()['denied'], 1)
+
+    def test_malformed_message(self):
+        self._assert_closed(self._send_raw(b'{not json', 1))
+
+    def test_truncated_fds(self):
+        # the broker accepts one file descriptor per message (two fit in the padding of its ancillary buffer)
+        self._assert_closed(self._send_raw(b'{"id": 1, "op": "channel"}', 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
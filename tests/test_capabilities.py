@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import ctypes
+import unittest
+
+from deescalate import C, CapMask, effective, permitted, inheritable, bounding_set, ambient
+from deescalate import get_capabilities, set_capabilities, get_securebits, set_keep_caps, set_noroot
+from . import privileged, in_child
+
+
+@privileged
+class TestCapabilitySet(unittest.TestCase):
+
+    def test_membership(self):
+        self.assertIn(b'setpcap', permitted)
+        self.assertIn(b'setpcap', effective)
+        self.assertEqual(set(effective), set(effective.mask))
+        self.assertEqual(get_capabilities()[0], effective.mask)
+
+    def test_modify(self):
+        def modify():
+            effective.__isub__(b'net_raw')
+            dropped = b'net_raw' in effective
+            effective.__iadd__(b'net_raw')
+            return dropped, b'net_raw' in effective, b'net_raw' in permitted
+        self.assertEqual(in_child(modify), (False, True, True))
+
+    def test_set(self):
+        def set_inheritable():
+            inheritable.set(b'net_bind_service,kill')
+            return inheritable.mask
+        self.assertEqual(in_child(set_inheritable), CapMask.from_caps(b'net_bind_service,kill'))
+
+    def test_set_single_capset(self):
+        def set_effective():
+            from deescalate import enable_stats, get_stats
+            set_capabilities(effective=b'kill,net_raw', permitted=b'kill,chown,net_raw')
+            enable_stats()
+            effective.set(b'kill,chown')
+            capsets = get_stats()['syscalls']['capset']
+            try:
+                # net_admin is not permitted anymore
+                effective.set(b'net_admin')
+            except RuntimeError:
+                pass
+            return capsets, effective.mask
+        capsets, mask = in_child(set_effective)
+        self.assertEqual(capsets, 1)
+        self.assertEqual(mask, CapMask.from_caps(b'kill,chown'))
+
+    def test_remove_all_except(self):
+        def remove():
+            # the effective set must stay a subset of the permitted set
+            effective.remove_all_except(b'net_raw')
+            permitted.remove_all_except(b'net_raw')
+            return get_capabilities()
+        eff, perm, inh = in_child(remove)
+        self.assertEqual(perm, CapMask.from_caps(b'net_raw'))
+        self.assertEqual(eff, perm)
+
+    def test_raised(self):
+        def raise_cap():
+            effective.__isub__(b'net_admin')
+            with effective.raised(b'net_admin'):
+                inside = b'net_admin' in effective
+            return inside, b'net_admin' in effective
+        self.assertEqual(in_child(raise_cap), (True, False))
+
+    def test_raised_interleaved(self):
+        def interleave():
+            # the with blocks of two asyncio tasks on one thread
+            effective.__isub__(b'net_admin,kill')
+            first, second = effective.raised(b'net_admin'), effective.raised(b'kill')
+            first.__enter__()
+            second.__enter__()
+            first.__exit__(None, None, None)
+            after_first = b'net_admin' in effective, b'kill' in effective
+            second.__exit__(None, None, None)
+            return after_first, b'kill' in effective
+        self.assertEqual(in_child(interleave), ((False, True), False))
+
+    def test_raised_external_capset(self):
+        def external():
+            effective.__isub__(b'kill')
+            with effective.raised(b'kill'):
+                pass
+            # a capset behind the back of deescalate: raised() must not write the old permitted set back
+            libc = ctypes.CDLL(None, use_errno=True)
+            header = (ctypes.c_uint32 * 2)(0x20080522, 0)
+            data = (ctypes.c_uint32 * 6)()
+            libc.capget(header, data)
+            # drop chown (bit 0) from the effective and permitted sets
+            data[0] &= ~1
+            data[1] &= ~1
+            if libc.capset(header, data) != 0:
+                raise OSError(ctypes.get_errno(), "capset")
+            with effective.raised(b'kill'):
+                pass
+            return b'chown' in permitted
+        self.assertFalse(in_child(external))
+
+    def test_set_capabilities(self):
+        def set_all():
+            set_capabilities(b'kill', b'kill,chown', b'')
+            return get_capabilities()
+        self.assertEqual(in_child(set_all), (
+            CapMask.from_caps(b'kill'), CapMask.from_caps(b'kill,chown'), CapMask(0)
+        ))
+
+    def test_set_not_permitted(self):
+        def escalate():
+            set_capabilities(b'', b'', b'')
+            try:
+                permitted.__iadd__(b'net_raw')
+            except RuntimeError:
+                return True
+            return False
+        self.assertTrue(in_child(escalate))
+
+
+@privileged
+class TestBoundingSet(unittest.TestCase):
+
+    def test_drop(self):
+        def drop():
+            bounding_set.__isub__(b'net_raw,sys_module')
+            return b'net_raw' in bounding_set, b'sys_module' in bounding_set, b'chown' in bounding_set
+        self.assertEqual(in_child(drop), (False, False, True))
+
+    def test_remove_all_except(self):
+        def drop():
+            bounding_set.remove_all_except(b'net_bind_service')
+            return bounding_set.mask
+        self.assertEqual(in_child(drop), CapMask.from_caps(b'net_bind_service'))
+
+
+@privileged
+class TestAmbientSet(unittest.TestCase):
+
+    def test_raise_and_lower(self):
+        def change():
+            inheritable.__iadd__(b'net_bind_service')
+            ambient.__iadd__(b'net_bind_service')
+            raised = b'net_bind_service' in ambient
+            ambient.clear_all()
+            ambient.refresh()
+            return raised, ambient.mask
+        raised, after = in_child(change)
+        self.assertTrue(raised)
+        self.assertFalse(after)
+
+
+@privileged
+class TestSecurebits(unittest.TestCase):
+
+    def test_set(self):
+        def change():
+            set_keep_caps(locked=False)
+            set_noroot(locked=True)
+            return get_securebits()[0]
+        bits = in_child(change)
+        self.assertTrue(bits & C.SECBIT_KEEP_CAPS)
+        self.assertFalse(bits & C.SECBIT_KEEP_CAPS_LOCKED)
+        self.assertTrue(bits & C.SECBIT_NOROOT)
+        self.assertTrue(bits & C.SECBIT_NOROOT_LOCKED)
+
+
+if __name__ == '__main__':
+    unittest.main()
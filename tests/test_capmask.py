@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import unittest
+
+from deescalate import CapMask, caps_to_mask, C
+
+
+class TestCapMask(unittest.TestCase):
+
+    def test_from_caps(self):
+        mask = CapMask.from_caps(b'net_raw,net_admin')
+        self.assertEqual(len(mask), 2)
+        self.assertIn(b'net_raw', mask)
+        self.assertIn(b'net_admin', mask)
+        self.assertNotIn(b'setuid', mask)
+        self.assertEqual(caps_to_mask([b'net_admin', b'net_raw']), mask)
+        self.assertEqual(caps_to_mask(u'net_raw, NET_ADMIN'), mask)
+
+    def test_operators(self):
+        raw, admin = CapMask.from_caps(b'net_raw'), CapMask.from_caps(b'net_admin')
+        both = raw | admin
+        self.assertEqual(both - raw, admin)
+        self.assertEqual(both & raw, raw)
+        self.assertEqual(both ^ raw, admin)
+        self.assertTrue(raw.issubset(both))
+        self.assertTrue(both.issuperset(admin))
+        self.assertEqual(both | b'setuid', caps_to_mask(b'net_raw,net_admin,setuid'))
+        self.assertIsInstance(both - b'net_raw', CapMask)
+
+    def test_iteration(self):
+        mask = CapMask.from_caps(b'chown,kill,net_raw')
+        self.assertEqual(list(mask), sorted(mask))
+        self.assertEqual(CapMask.from_caps(list(mask)), mask)
+
+    def test_bounds(self):
+        self.assertRaises(ValueError, CapMask, -1)
+        self.assertRaises(ValueError, CapMask, 1 << 64)
+        self.assertEqual(len(~CapMask(0)), 64)
+        self.assertEqual(caps_to_mask(None), CapMask(0))
+
+    def test_int(self):
+        # a bare int could be a mask or a capability value
+        self.assertRaises(TypeError, caps_to_mask, 13)
+        self.assertEqual(caps_to_mask([13]), CapMask.from_caps(b'net_raw'))
+        self.assertIn(13, caps_to_mask([13]))
+        self.assertEqual(caps_to_mask(CapMask(13)), CapMask(13))
+
+    def test_strict(self):
+        self.assertRaises(ValueError, caps_to_mask, b'net_raw,no_such_cap', True)
+        self.assertEqual(caps_to_mask(b'net_raw,no_such_cap'), CapMask.from_caps(b'net_raw'))
+
+    def test_supported(self):
+        supported = CapMask(C.SUPPORTED_CAPS_MASK)
+        self.assertIn(b'chown', supported)
+        self.assertTrue(CapMask.from_caps(b'net_raw,setuid').issubset(supported))
+
+
+if __name__ == '__main__':
+    unittest.main()
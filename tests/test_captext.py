@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import ctypes
+import ctypes.util
+import unittest
+
+from deescalate import CapText, CapMask, C, compile_text, get_capabilities
+from deescalate import captext
+from . import privileged, linux_only, in_child
+
+_LIBCAP = ctypes.util.find_library('cap')
+
+
+def _mask(*names):
+    return CapMask(0) | [name.encode('ascii') for name in names]
+
+
+@linux_only
+class TestCompile(unittest.TestCase):
+
+    def test_example(self):
+        text = compile_text('cap_net_raw,cap_net_admin=eip cap_sys_chroot+p')
+        both = _mask('net_raw', 'net_admin')
+        self.assertEqual(text, CapText(both, both | b'sys_chroot', both))
+
+    def test_operators(self):
+        self.assertEqual(compile_text('=ep cap_kill-e'), CapText(
+            CapMask(C.SUPPORTED_CAPS_MASK) - b'kill', CapMask(C.SUPPORTED_CAPS_MASK), CapMask(0)
+        ))
+        self.assertEqual(compile_text('cap_kill=ep+i-e'), CapText(CapMask(0), _mask('kill'), _mask('kill')))
+        self.assertEqual(compile_text('all=i cap_chown='), CapText(
+            CapMask(0), CapMask(0), CapMask(C.SUPPORTED_CAPS_MASK) - b'chown'
+        ))
+        self.assertEqual(compile_text(''), CapText(CapMask(0), CapMask(0), CapMask(0)))
+        self.assertEqual(compile_text(b'CAP_KILL,6+p'), compile_text('cap_kill,cap_setgid+p'))
+
+    def test_errors(self):
+        for text in ('cap_kill', 'cap_kill+', 'cap_kill=e=p', 'cap_kill+x', 'cap_nope=e', 'kill=e', '64+e', '+e'):
+            self.assertRaises(ValueError, compile_text, text)
+
+    def test_to_text(self):
+        self.assertEqual(CapText(CapMask(0), CapMask(0), CapMask(0)).to_text(), '=')
+        self.assertEqual(compile_text('cap_net_raw,cap_net_admin=eip cap_sys_chroot+p').to_text(),
+                         'cap_net_admin,cap_net_raw=eip cap_sys_chroot+p')
+        self.assertEqual(compile_text('=eip cap_kill-i').to_text(), '=eip cap_kill-i')
+
+    def test_round_trip(self):
+        texts = ('=', '=eip', 'cap_kill=ep', '=ep cap_setuid,cap_setgid-e cap_chown+i', 'all=p 63+e',
+                 'cap_net_raw,cap_net_admin=eip cap_sys_chroot+p')
+        for text in texts:
+            compiled = compile_text(text)
+            self.assertEqual(compile_text(compiled.to_text()), compiled)
+
+    def test_cache(self):
+        captext.clear_cache()
+        size = captext.CACHE_SIZE
+        captext.CACHE_SIZE = 2
+        try:
+            compile_text('cap_kill=e')
+            compile_text('cap_chown=e')
+            compile_text('cap_kill=e')
+            compile_text('cap_setuid=e')
+            # cap_chown was the least recently used
+            self.assertEqual(captext.cache_info(), {'hits': 1, 'misses': 3, 'size': 2})
+            compile_text('cap_kill=e')
+            compile_text('cap_chown=e')
+            self.assertEqual(captext.cache_info(), {'hits': 2, 'misses': 4, 'size': 2})
+        finally:
+            captext.CACHE_SIZE = size
+            captext.clear_cache()
+
+
+@linux_only
+@unittest.skipUnless(_LIBCAP, "needs libcap")
+class TestLibcap(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.lib = lib = ctypes.CDLL(_LIBCAP)
+        lib.cap_from_text.restype = ctypes.c_void_p
+        lib.cap_from_text.argtypes = (ctypes.c_char_p,)
+        lib.cap_to_text.restype = ctypes.c_void_p
+        lib.cap_to_text.argtypes = (ctypes.c_void_p, ctypes.c_void_p)
+        lib.cap_free.argtypes = (ctypes.c_void_p,)
+
+    def libcap_to_text(self, text):
+        caps = self.lib.cap_from_text(text.encode('ascii'))
+        self.assertTrue(caps)
+        result = self.lib.cap_to_text(caps, None)
+        try:
+            return ctypes.string_at(result).decode('ascii')
+        finally:
+            self.lib.cap_free(result)
+            self.lib.cap_free(caps)
+
+    def test_same_text(self):
+        texts = ('=', '=eip', 'cap_kill=ep', '=ep cap_setuid,cap_setgid-e cap_chown+i', 'all=p 63+e',
+                 'cap_net_raw,cap_net_admin=eip cap_sys_chroot+p', 'cap_chown=i cap_kill+e',
+                 '=ip cap_sys_boot+e cap_net_raw-p cap_kill=', '41,all=p', 'all,41=p')
+        for text in texts:
+            self.assertEqual(compile_text(text).to_text(), self.libcap_to_text(text), text)
+
+
+@privileged
+class TestApply(unittest.TestCase):
+
+    def test_apply(self):
+        def apply():
+            compile_text('cap_kill,cap_chown=ep cap_setuid+p').apply()
+            return get_capabilities(), CapText.current().to_text()
+        (effective, permitted, inheritable), text = in_child(apply)
+        self.assertEqual(effective, _mask('kill', 'chown'))
+        self.assertEqual(permitted, _mask('kill', 'chown', 'setuid'))
+        self.assertEqual(inheritable, CapMask(0))
+        self.assertEqual(text, 'cap_chown,cap_kill=ep cap_setuid+p')
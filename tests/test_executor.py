@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import unittest
+
+from deescalate import effective
+from deescalate.executor import CapabilityExecutor
+from . import privileged, in_child
+
+
+def _has_net_admin():
+    return b'net_admin' in effective
+
+
+@privileged
+class TestCapabilityExecutor(unittest.TestCase):
+
+    def test_pool_threads(self):
+        def run():
+            with CapabilityExecutor(b'net_admin', max_workers=1, lower_caller=True) as pool:
+                in_pool = pool.submit(_has_net_admin).result()
+                stats = pool.stats()
+            return in_pool, _has_net_admin(), stats.submitted, stats.completed
+        self.assertEqual(in_child(run), (True, False, 1, 1))
+
+    def test_run_in_executor(self):
+        def run():
+            import asyncio
+            pool = CapabilityExecutor(b'net_admin', max_workers=1, lower_caller=True)
+
+            async def main():
+                return await pool.run_in_executor(_has_net_admin)
+            try:
+                return asyncio.run(main())
+            finally:
+                pool.shutdown()
+        self.assertTrue(in_child(run))
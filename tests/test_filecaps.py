@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from deescalate import CapMask
+from deescalate.filecaps import FileCaps, get_file_caps, set_file_caps, remove_file_caps, walk
+from . import privileged
+
+
+class TestFormat(unittest.TestCase):
+
+    def test_bytes(self):
+        for caps in (FileCaps(CapMask.from_caps(b'net_raw'), CapMask(0), True),
+                     FileCaps(CapMask.from_caps(b'net_admin,net_raw'), CapMask.from_caps(b'kill'), False),
+                     FileCaps(CapMask.from_caps(b'chown'), CapMask(0), True, 1000)):
+            self.assertEqual(FileCaps.from_bytes(caps.to_bytes()), caps)
+        self.assertEqual(FileCaps(CapMask(1), rootid=5).version, 3)
+        self.assertEqual(FileCaps(CapMask(1)).version, 2)
+
+    def test_text(self):
+        caps = FileCaps.from_text('cap_net_raw,cap_net_admin=ep cap_kill=i')
+        self.assertEqual(caps.permitted, CapMask.from_caps(b'net_raw,net_admin'))
+        self.assertEqual(caps.inheritable, CapMask.from_caps(b'kill'))
+        self.assertTrue(caps.effective)
+        self.assertEqual(FileCaps.from_text(caps.to_text()), caps)
+        self.assertEqual(FileCaps.from_text('cap_net_raw=p').to_text(), 'cap_net_raw=p')
+
+    def test_setcap_text(self):
+        expected = FileCaps(CapMask.from_caps(b'net_raw'), CapMask(0), True)
+        for text in ('cap_net_raw+ep', '= cap_net_raw+ep', 'cap_net_raw=ep'):
+            self.assertEqual(FileCaps.from_text(text), expected)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, FileCaps.from_text, 'cap_net_raw')
+        self.assertRaises(ValueError, FileCaps.from_text, 'cap_net_raw=x')
+        self.assertRaises(ValueError, FileCaps.from_text, 'cap_no_such_cap=p')
+        self.assertRaises(ValueError, FileCaps.from_bytes, b'\x00')
+
+
+@privileged
+class TestFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.directory, name)
+            with open(path, 'w'):
+                pass
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_set_get(self):
+        caps = FileCaps.from_text('cap_net_bind_service=ep')
+        try:
+            set_file_caps(self.paths[0], caps)
+        except OSError as ex:
+            self.skipTest("can't set file capabilities here: %s" % ex)
+        self.assertEqual(get_file_caps(self.paths[0]).permitted, caps.permitted)
+        self.assertIsNone(get_file_caps(self.paths[1]))
+        found = dict((path, found_caps) for path, found_caps in walk(self.directory))
+        self.assertEqual(list(found), [self.paths[0]])
+        remove_file_caps(self.paths[0])
+        self.assertIsNone(get_file_caps(self.paths[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import unittest
+
+from deescalate import CapMask, lockdown_account, plan_lockdown, snapshot, spawn, PIPE
+from deescalate.plan import LOCKDOWN_SECUREBITS
+from . import privileged, in_child
+from .userns import is_mapped
+
+NOBODY = 65534
+
+
+@privileged
+class TestLockdown(unittest.TestCase):
+
+    def check_state(self, state, caps):
+        self.assertEqual(state.permitted, caps)
+        self.assertEqual(state.effective, caps)
+        self.assertEqual(state.inheritable, caps)
+        self.assertEqual(state.bounding, caps)
+        self.assertEqual(state.securebits & LOCKDOWN_SECUREBITS, LOCKDOWN_SECUREBITS)
+        self.assertTrue(state.no_new_privs)
+
+    def test_lockdown(self):
+        def lockdown():
+            kept = lockdown_account(caps_to_keep=b'net_bind_service')
+            return kept, snapshot()
+        kept, state = in_child(lockdown)
+        self.assertEqual(kept, CapMask.from_caps(b'net_bind_service'))
+        self.check_state(state, kept)
+
+    def test_lockdown_nothing(self):
+        self.check_state(in_child(lambda: (lockdown_account(), snapshot())[1]), CapMask(0))
+
+    def test_ambient(self):
+        state = in_child(lambda: (lockdown_account(caps_to_keep=b'net_raw', ambient=True), snapshot())[1])
+        self.assertEqual(state.ambient, CapMask.from_caps(b'net_raw'))
+
+    @unittest.skipUnless(is_mapped(NOBODY), "UID %d is not mapped in the user namespace" % NOBODY)
+    def test_user(self):
+        def lockdown():
+            lockdown_account(NOBODY, NOBODY, b'net_bind_service')
+            return snapshot()
+        state = in_child(lockdown)
+        self.assertEqual(state.uids, (NOBODY,) * 4)
+        self.assertEqual(state.gids, (NOBODY,) * 4)
+        self.check_state(state, CapMask.from_caps(b'net_bind_service'))
+
+    @unittest.skipUnless(is_mapped(NOBODY), "GID %d is not mapped in the user namespace" % NOBODY)
+    def test_group_only(self):
+        # the supplementary groups of root must not survive the switch to another group
+        plan = plan_lockdown(gid=NOBODY)
+        self.assertEqual(plan.groups, (NOBODY,))
+        self.assertIn('setgroups', [operation.name for operation in plan.operations])
+
+    def test_all_threads(self):
+        def lockdown():
+            import threading
+            event = threading.Event()
+            states = []
+            thread = threading.Thread(target=lambda: (event.wait(), states.append(snapshot())))
+            thread.start()
+            lockdown_account(caps_to_keep=b'kill', all_threads=True)
+            event.set()
+            thread.join()
+            return states[0]
+        self.check_state(in_child(lockdown), CapMask.from_caps(b'kill'))
+
+    def test_all_threads_timeout(self):
+        def lockdown():
+            import errno
+            import signal
+            import threading
+            from deescalate.cd import BROADCAST_SIGNAL
+            unblock, unblocked = threading.Event(), threading.Event()
+            states = []
+
+            def blocking():
+                signal.pthread_sigmask(signal.SIG_BLOCK, [BROADCAST_SIGNAL])
+                unblock.wait()
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, [BROADCAST_SIGNAL])
+                states.append(snapshot())
+                unblocked.set()
+            thread = threading.Thread(target=blocking)
+            thread.start()
+            native = plan_lockdown(caps_to_keep=b'kill').compile()
+            unresponsive = native.apply_all_threads(timeout=0.1).unresponsive
+            # the blocking thread has not applied the plan yet
+            busy = False
+            try:
+                native.apply_all_threads(timeout=0.1)
+            except OSError as ex:
+                busy = ex.errno == errno.EBUSY
+            unblock.set()
+            unblocked.wait()
+            thread.join()
+            native = plan_lockdown(caps_to_keep=b'kill').compile()
+            after = native.apply_all_threads(timeout=0.1).unresponsive
+            return unresponsive, busy, after, signal.getsignal(BROADCAST_SIGNAL) == signal.SIG_DFL, states[0]
+        unresponsive, busy, after, restored, state = in_child(lockdown)
+        self.assertEqual((unresponsive, busy, after, restored), (1, True, 0, True))
+        self.check_state(state, CapMask.from_caps(b'kill'))
+
+
+@privileged
+class TestPlan(unittest.TestCase):
+
+    def test_idempotent(self):
+        def plan_twice():
+            plan_lockdown(caps_to_keep=b'kill').apply()
+            return plan_lockdown(caps_to_keep=b'kill').operations
+        self.assertEqual(in_child(plan_twice), ())
+
+    def test_dry_run(self):
+        plan = plan_lockdown(caps_to_keep=b'kill')
+        self.assertIn('drop_bounding', plan.dry_run())
+        self.assertEqual(plan.syscall_count, sum(operation.syscalls for operation in plan.operations))
+
+    def test_native(self):
+        native = plan_lockdown(caps_to_keep=b'chown,kill').compile()
+        state = in_child(lambda: (native.apply(), snapshot())[1])
+        self.assertEqual(state.permitted, CapMask.from_caps(b'chown,kill'))
+        self.assertEqual(state.bounding, state.permitted)
+        self.assertTrue(state.no_new_privs)
+
+    def test_spawn(self):
+        # with the noroot securebit, the capabilities only survive the execve as ambient capabilities
+        native = plan_lockdown(caps_to_keep=b'kill', ambient=True).compile()
+        child = spawn(['grep', '^CapPrm', '/proc/self/status'], plan=native, stdout=PIPE)
+        output = child.stdout.read()
+        child.stdout.close()
+        self.assertEqual(child.wait(), 0)
+        self.assertEqual(int(output.split()[1], 16), CapMask.from_caps(b'kill'))
+
+    def test_spawn_swapped_stdio(self):
+        def swap():
+            import os
+            out_read, out_write = os.pipe()
+            err_read, err_write = os.pipe()
+            os.dup2(out_write, 1)
+            os.dup2(err_write, 2)
+            # the child stdout is our stderr, and its stderr our stdout
+            child = spawn(['sh', '-c', 'echo out; echo err >&2'], plan=plan_lockdown().compile(), stdout=2, stderr=1)
+            child.wait()
+            for fd in (out_write, err_write, 1, 2):
+                os.close(fd)
+            return os.read(out_read, 100), os.read(err_read, 100)
+        self.assertEqual(in_child(swap), (b'err\n', b'out\n'))
+
+    def test_wait_timeout(self):
+        import subprocess
+        child = spawn(['sleep', '5'], plan=plan_lockdown().compile())
+        try:
+            self.assertRaises(subprocess.TimeoutExpired, child.wait, 0.01)
+        finally:
+            child.kill()
+            child.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
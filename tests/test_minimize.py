@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import unittest
+
+from deescalate import CapMask
+from deescalate.minimize import Runner
+from . import privileged, in_child
+
+
+@privileged
+class TestRunner(unittest.TestCase):
+
+    def test_run(self):
+        runner = Runner(['sh', '-c', 'grep -q "^CapEff:.*[1-9a-f]" /proc/self/status'])
+        self.assertEqual(runner.run([CapMask(0), CapMask.from_caps(b'kill'), CapMask(0)]), [False, True, False])
+        self.assertEqual((runner.runs, runner.cached), (2, 0))
+
+    def test_spawn_failure(self):
+        def run():
+            import os
+            from deescalate import bounding_set
+            bounding_set.__isub__(b'net_raw')
+            runner = Runner(['sleep', '5'], jobs=2)
+            try:
+                # the lockdown of the second child cannot keep net_raw
+                runner.run([CapMask.from_caps(b'kill'), CapMask.from_caps(b'net_raw')])
+            except OSError:
+                pass
+            try:
+                os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return runner.runs, False
+            return runner.runs, True
+        self.assertEqual(in_child(run), (1, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
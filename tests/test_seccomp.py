@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import unittest
+
+from deescalate import set_no_new_privs
+from deescalate.main import is_linux
+from deescalate.seccomp import SeccompPolicy, action_value, evaluate, SECCOMP_RET_ALLOW
+from deescalate.syscalls import SYSCALLS, machine, syscall_number
+from . import linux_only, in_child
+
+ARCH = machine() if is_linux else None
+
+
+@unittest.skipUnless(ARCH in SYSCALLS, "unsupported architecture")
+class TestCompiler(unittest.TestCase):
+
+    def policy(self):
+        return SeccompPolicy(default='errno', arch=ARCH).allow(['read', 'write', 'close', 'getppid']).deny(
+            ['mount', 'ptrace'], 'kill'
+        )
+
+    def test_methods_agree(self):
+        tree, linear = self.policy().compile('tree'), self.policy().compile('linear')
+        for number in sorted(SYSCALLS[ARCH].values()) + [1000, 0x40000000]:
+            self.assertEqual(evaluate(tree, number)[0], evaluate(linear, number)[0], number)
+
+    def test_actions(self):
+        program = self.policy().compile()
+        self.assertEqual(evaluate(program, syscall_number('read', ARCH))[0], SECCOMP_RET_ALLOW)
+        self.assertEqual(evaluate(program, syscall_number('mount', ARCH))[0], action_value('kill'))
+        self.assertEqual(evaluate(program, syscall_number('open' if 'open' in SYSCALLS[ARCH] else 'openat', ARCH))[0],
+                         action_value('errno'))
+
+    def test_cache(self):
+        self.assertIs(self.policy().compile(), self.policy().compile())
+        self.assertEqual(self.policy().digest(), self.policy().digest())
+        self.assertNotEqual(self.policy().digest(), self.policy().allow('getpid').digest())
+
+    def test_from_dict(self):
+        policy = SeccompPolicy.from_dict({
+            'default': 'errno', 'arch': ARCH, 'allow': ['read', 'write', 'close', 'getppid'],
+            'deny': {'mount': 'kill', 'ptrace': 'kill'},
+        })
+        self.assertEqual(policy.digest(), self.policy().digest())
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, SeccompPolicy(arch=ARCH).allow, 'no_such_syscall')
+
+
+@linux_only
+@unittest.skipUnless(ARCH in SYSCALLS, "unsupported architecture")
+class TestInstall(unittest.TestCase):
+
+    def test_install(self):
+        policy = SeccompPolicy(default='allow', arch=ARCH).deny('getppid', 'errno')
+
+        def install():
+            set_no_new_privs()
+            policy.compile().install()
+            return os.getppid(), os.getpid() > 0
+        # the filter answers EPERM, and os.getppid returns the -1 of the libc
+        self.assertEqual(in_child(install), (-1, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
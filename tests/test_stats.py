@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import unittest
+
+from deescalate import effective, enable_stats, get_stats, reset_stats, add_stats_hook, remove_stats_hook
+from deescalate import lockdown_account, plan_lockdown
+from . import privileged, in_child
+
+
+@privileged
+class TestStats(unittest.TestCase):
+
+    def tearDown(self):
+        enable_stats(False)
+        reset_stats()
+
+    def test_disabled(self):
+        enable_stats(False)
+        reset_stats()
+        b'net_admin' in effective
+        stats = get_stats()
+        self.assertFalse(stats['enabled'])
+        self.assertEqual(stats['syscalls']['capget'], 0)
+        self.assertEqual(stats['steps'], {})
+
+    def test_counters(self):
+        enable_stats()
+        reset_stats()
+        for _ in range(3):
+            b'net_admin' in effective
+        self.assertEqual(get_stats()['syscalls']['capget'], 3)
+
+    def lockdown(self, native):
+        enable_stats()
+        reset_stats()
+        events = []
+        hook = lambda step, seconds: events.append(step)
+        add_stats_hook(hook)
+        try:
+            if native:
+                plan_lockdown(caps_to_keep=b'kill').compile().apply()
+            else:
+                lockdown_account(caps_to_keep=b'kill')
+        finally:
+            remove_stats_hook(hook)
+        return get_stats(), events
+
+    def check_lockdown(self, stats, events):
+        self.assertIn('drop_bounding', events)
+        self.assertIn('set_no_new_privs', events)
+        self.assertEqual(sorted(events), sorted(stats['steps']))
+        self.assertGreaterEqual(stats['syscalls']['no_new_privs'], 1)
+        # the plan itself reads the securebits and no_new_privs
+        self.assertGreaterEqual(stats['syscalls']['prctl'], stats['syscalls']['capbset_drop'] + 2)
+        self.assertGreater(stats['syscalls']['capbset_drop'], 0)
+        for step in stats['steps'].values():
+            self.assertEqual(step['count'], 1)
+            self.assertGreaterEqual(step['max'], 0)
+
+    def test_lockdown(self):
+        self.check_lockdown(*in_child(self.lockdown, False))
+
+    def test_native(self):
+        self.check_lockdown(*in_child(self.lockdown, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
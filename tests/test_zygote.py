@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+import os
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import unittest
+
+from deescalate.zygote import Zygote, ZygoteClient, AsyncZygoteClient
+from . import privileged
+
+
+@privileged
+class TestZygote(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'zygote.sock')
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                Zygote(self.path).serve_forever()
+            finally:
+                os._exit(1)
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                self.client = ZygoteClient(self.path)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def tearDown(self):
+        self.client.close()
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+        shutil.rmtree(self.directory)
+
+    def test_wait(self):
+        self.assertEqual(self.client.launch(['true'], wait=True), 0)
+        self.assertEqual(self.client.launch(['sh', '-c', 'exit 3'], capabilities='kill', wait=True), 3)
+
+    def test_launched(self):
+        launched = self.client.launch(['sleep', '0.05'])
+        try:
+            self.assertTrue(launched.wait(5))
+        finally:
+            launched.close()
+
+    def test_bad_request(self):
+        self.assertRaises(RuntimeError, self.client.launch)
+        self.assertRaises(RuntimeError, self.client.launch, ['true'], capabilities=5, wait=True)
+        self.assertRaises(RuntimeError, self.client.launch, ['true'], capabilities='no_such_cap', wait=True)
+        self.assertRaises(RuntimeError, self.client.launch, ['true'], user='no-such-user', wait=True)
+        # the connection is still usable
+        self.assertEqual(self.client.launch(['true'], wait=True), 0)
+
+    def test_async_send_failure(self):
+        import asyncio
+
+        async def main():
+            client = await AsyncZygoteClient.connect(self.path)
+            client.sock.shutdown(socket.SHUT_WR)
+            try:
+                with self.assertRaises(OSError):
+                    await client.launch(['true'], wait=True)
+                return dict(client._pending)
+            finally:
+                client.close()
+        self.assertEqual(asyncio.run(main()), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+__author__ = 'stephane.martin_github@vesperal.eu'
+
+# Run the test and benchmark suites as a mapped root inside a new user namespace, where every capability operation
+# works without real root.
+
+import os
+import sys
+import errno
+import ctypes
+
+CLONE_NEWUSER = 0x10000000
+#: set in the environment of the process re-executed inside the user namespace
+ENV_MARKER = 'DEESCALATE_USERNS'
+#: set to 1 in the environment to run the suites in the current namespace
+ENV_DISABLE = 'DEESCALATE_NO_USERNS'
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def _map_from_parent(pid):
+    # a process can only map its own IDs into the namespace it created: a helper left in the parent namespace maps
+    # the whole range, like newuidmap does
+    read_end, write_end = os.pipe()
+    helper = os.fork()
+    if helper == 0:
+        status = 1
+        try:
+            os.close(write_end)
+            if os.read(read_end, 1):
+                _write('/proc/%d/uid_map' % pid, '0 0 4294967295\n')
+                _write('/proc/%d/gid_map' % pid, '0 0 4294967295\n')
+                status = 0
+        finally:
+            os._exit(status)
+    os.close(read_end)
+    return helper, write_end
+
+
+def enter_user_namespace():
+    """
+    Move the calling process into a new user namespace, where it is root with every capability.
+
+    When the caller is root, the whole ID range is mapped onto itself (so `nobody` and the other accounts exist in
+    the namespace); otherwise only the caller's UID and GID are mapped, to 0, and `setgroups` is denied, as the
+    kernel requires.
+
+    Raises
+    ------
+    OSError
+        if the kernel refuses to create the namespace (the process must be single-threaded, and unprivileged user
+        namespaces must be allowed)
+    """
+    uid, gid = os.geteuid(), os.getegid()
+    helper = None
+    if uid == 0:
+        helper, go = _map_from_parent(os.getpid())
+    libc = ctypes.CDLL(None, use_errno=True)
+    result = libc.unshare(CLONE_NEWUSER)
+    code = ctypes.get_errno()
+    if helper is not None:
+        if result == 0:
+            os.write(go, b'x')
+        os.close(go)
+        _, status = os.waitpid(helper, 0)
+        if result == 0 and status != 0:
+            raise OSError(errno.EPERM, "can't write the ID maps of the user namespace")
+    if result != 0:
+        raise OSError(code, "unshare(CLONE_NEWUSER): %s" % os.strerror(code))
+    if helper is None:
+        _write('/proc/self/setgroups', 'deny\n')
+        _write('/proc/self/uid_map', '0 %d 1\n' % uid)
+        _write('/proc/self/gid_map', '0 %d 1\n' % gid)
+
+
+def reexec_in_user_namespace(argv=None):
+    """
+    Re-execute the interpreter with `argv` inside a new user namespace (see `enter_user_namespace`).
+
+    The new process runs as UID 0 of the namespace, and gets every capability from the `execve`. Nothing is done
+    when the process already runs in the namespace, or when `DEESCALATE_NO_USERNS=1` is set.
+
+    Parameters
+    ----------
+    argv: list of str, optional
+        the interpreter arguments (default: `sys.argv`)
+
+    Returns
+    -------
+    bool
+        False when the process was not re-executed (it does not return otherwise)
+    """
+    if os.environ.get(ENV_MARKER) or os.environ.get(ENV_DISABLE, '') not in ('', '0'):
+        return False
+    argv = list(sys.argv if argv is None else argv)
+    try:
+        enter_user_namespace()
+    except (OSError, IOError) as ex:
+        sys.stderr.write("can't create a user namespace (%s): running in the current namespace\n" % ex)
+        return False
+    env = dict(os.environ)
+    env[ENV_MARKER] = '1'
+    os.execve(sys.executable, [sys.executable] + argv, env)
+
+
+def in_user_namespace():
+    """
+    True if the process was re-executed by `reexec_in_user_namespace`.
+    """
+    return bool(os.environ.get(ENV_MARKER))
+
+
+def is_mapped(uid):
+    """
+    True if `uid` exists in the user namespace of the process.
+    """
+    try:
+        with open('/proc/self/uid_map') as f:
+            for line in f:
+                first, _, count = (int(field) for field in line.split())
+                if first <= uid < first + count:
+                    return True
+    except (OSError, IOError) as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+    return False